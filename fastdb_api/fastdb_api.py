@@ -5,6 +5,7 @@ import sys
 import os
 import os.path
 import configparser
+import itertools
 
 URL =  'https://desc-tom-fastdb-dev.lbl.gov/fastdb_dev/'
 #URL = 'http://tom-app.desc-tom-buckley-dev.production.svc.spin.nersc.org/fastdb_dev/'
@@ -20,6 +21,9 @@ UPDATE_DS_PV_SS_URL = URL + 'bulk_update_ds_pv_ss_valid_flag'
 UPDATE_DIA_SOURCE_URL = URL + 'bulk_update_dia_source_valid_flag'
 AUTHENTICATE_USER = URL + 'authenticate_user'
 
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+ARROW_CONTENT_TYPE = 'application/vnd.apache.arrow.stream'
+
 class FASTDBDataAccess(object):
 
     def __init__(self):
@@ -75,13 +79,19 @@ class FASTDBDataAccess(object):
  
         
 
-    def submit_short_query(self, query, subdict=None ):
+    def submit_short_query(self, query, subdict=None, cache=None ):
+
+        # cache : True, or a number of seconds, to let the server return
+        #   (and save) results from its query result cache.  Only use
+        #   this if results a few minutes stale are OK.
 
-        
         if subdict is not None:
-            query = json.dumps([{'csrfmiddlewaretoken': self.csrf_token},{'query':query},{'subdict':subdict},])
+            query = [{'csrfmiddlewaretoken': self.csrf_token},{'query':query},{'subdict':subdict},]
         else:
-            query = json.dumps([{'csrfmiddlewaretoken': self.csrf_token},{'query':query},])
+            query = [{'csrfmiddlewaretoken': self.csrf_token},{'query':query},]
+        if cache is not None:
+            query.append({'cache':cache})
+        query = json.dumps(query)
         res = requests.post(SUBMIT_SHORT_QUERY_URL, json=query, headers=self.headers)
         if res.status_code != 200:
             sys.stderr.write( f"ERROR, got status {res.status_code}\n" )
@@ -171,3 +181,102 @@ class FASTDBDataStore(object):
             
         return r.json()
         
+
+    # data_insert and data_update send all the rows in one JSON document,
+    # which both ends have to hold in memory (more than once).  These send
+    # the rows as a stream instead (with chunked transfer encoding), which
+    # the server reads and writes a chunk at a time, so they're the way to
+    # load millions of rows.
+    #
+    # rows : for format 'ndjson', any iterable of dicts (e.g. a generator,
+    #   so the rows never all have to be in memory here either).  For
+    #   format 'arrow', a pyarrow Table, a pandas DataFrame, or an
+    #   iterable of pyarrow RecordBatches.
+    # chunk_rows : how many rows go into each piece of the stream
+
+    def data_insert_stream(self, table, rows, format='ndjson', chunk_rows=10000):
+
+        if table == 'dia_source':
+            url = DIA_SOURCE_URL
+        elif table == 'ds_to_pv_to_ss':
+            url = DS_PV_SS_URL
+        else:
+            raise ValueError( f"Unknown table {table}" )
+        return self._stream_rows(url, rows, format, chunk_rows)
+
+    def data_update_stream(self, table, rows, format='ndjson', chunk_rows=10000):
+
+        if table == 'dia_source':
+            url = UPDATE_DIA_SOURCE_URL
+        elif table == 'ds_to_pv_to_ss':
+            url = UPDATE_DS_PV_SS_URL
+        else:
+            raise ValueError( f"Unknown table {table}" )
+        return self._stream_rows(url, rows, format, chunk_rows)
+
+    def _stream_rows(self, url, rows, format, chunk_rows):
+
+        if format == 'ndjson':
+            body = self._ndjson_chunks(rows, chunk_rows)
+            content_type = NDJSON_CONTENT_TYPE
+        elif format == 'arrow':
+            body = self._arrow_chunks(rows, chunk_rows)
+            content_type = ARROW_CONTENT_TYPE
+        else:
+            raise ValueError( f"format must be 'ndjson' or 'arrow', not {format}" )
+
+        headers = dict(self.headers)
+        headers['Content-Type'] = content_type
+        r = requests.post(url, data=body, headers=headers)
+        return r.json()
+
+    @staticmethod
+    def _ndjson_chunks(rows, chunk_rows):
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, chunk_rows))
+            if len(chunk) == 0:
+                return
+            yield "".join( json.dumps(row) + "\n" for row in chunk ).encode( 'utf-8' )
+
+    @staticmethod
+    def _arrow_chunks(rows, chunk_rows):
+        import pyarrow
+        import pyarrow.ipc
+
+        if not isinstance(rows, pyarrow.Table) and hasattr(rows, 'to_records'):
+            # pandas DataFrame
+            rows = pyarrow.Table.from_pandas(rows, preserve_index=False)
+        if isinstance(rows, pyarrow.Table):
+            batches = rows.to_batches(max_chunksize=chunk_rows)
+        else:
+            batches = rows
+
+        # The IPC stream writer writes into pieces, and whatever it has
+        # written is sent after each batch
+        class _Pieces:
+            def __init__(self):
+                self.pieces = []
+                self.closed = False
+            def write(self, data):
+                self.pieces.append(bytes(data))
+                return len(data)
+            def flush(self):
+                pass
+            def close(self):
+                self.closed = True
+            def take(self):
+                data = b"".join(self.pieces)
+                self.pieces = []
+                return data
+
+        sink = _Pieces()
+        writer = None
+        for batch in batches:
+            if writer is None:
+                writer = pyarrow.ipc.new_stream(sink, batch.schema)
+            writer.write_batch(batch)
+            yield sink.take()
+        if writer is not None:
+            writer.close()
+            yield sink.take()
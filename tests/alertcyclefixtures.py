@@ -24,6 +24,7 @@ sys.path.insert( 0, "/tom_desc" )
 os.environ["DJANGO_SETTINGS_MODULE"] = "tom_desc.settings"
 import django
 django.setup()
+import django.db
 
 import elasticc2.models
 import fastdb_dev.models
@@ -192,6 +193,38 @@ def classifications_300days_fastdb_dev_ingested( classifications_300days_exist )
 
     yield True
 
+def _check_elasticc2_summaries():
+    # update_elasticc2_sources only folds new rows into the summaries;
+    # make sure that gives what computing them from scratch would.
+    with django.db.connection.cursor() as cursor:
+        for col, table, order in [ ( 'firstsource_id', 'elasticc2_diasource', 'midpointtai, diasource_id' ),
+                                   ( 'latestsource_id', 'elasticc2_diasource',
+                                     'midpointtai DESC, diasource_id DESC' ),
+                                   ( 'latestforcedsource_id', 'elasticc2_diaforcedsource',
+                                     'midpointtai DESC, diaforcedsource_id DESC' ),
+                                   ( 'maxforcedsource_id', 'elasticc2_diaforcedsource',
+                                     'psflux DESC NULLS LAST, diaforcedsource_id' ) ]:
+            idcol = 'diasource_id' if table == 'elasticc2_diasource' else 'diaforcedsource_id'
+            cursor.execute( f"SELECT DISTINCT ON (diaobject_id,filtername) diaobject_id, filtername, {idcol} "
+                            f"FROM {table} ORDER BY diaobject_id, filtername, {order}" )
+            expected = { ( row[0], row[1] ): row[2] for row in cursor.fetchall() }
+            cursor.execute( f"SELECT diaobject_id, filtername, {col} FROM elasticc2_diaobjectinfo "
+                            f"WHERE {col} IS NOT NULL" )
+            assert { ( row[0], row[1] ): row[2] for row in cursor.fetchall() } == expected
+
+        cursor.execute( "SELECT DISTINCT ON (s.diaobject_id,m.classifier_id) "
+                        "  s.diaobject_id, m.classifier_id, m.brokermessage_id "
+                        "FROM elasticc2_brokermessage m "
+                        "INNER JOIN elasticc2_diasource s ON m.diasource_id=s.diasource_id "
+                        "WHERE cardinality(m.classid)>0 "
+                        "ORDER BY s.diaobject_id, m.classifier_id, s.midpointtai DESC, m.brokermessage_id DESC" )
+        expected = { ( row[0], row[1] ): row[2] for row in cursor.fetchall() }
+        assert len( expected ) > 0
+        cursor.execute( "SELECT diaobject_id, classifier_id, latestbrokermessage_id "
+                        "FROM elasticc2_diaobjectclassification" )
+        assert { ( row[0], row[1] ): row[2] for row in cursor.fetchall() } == expected
+
+
 @pytest.fixture( scope="session" )
 def update_elasticc2_diasource_300days( classifications_300days_elasticc2_ingested ):
     result = subprocess.run( [ "python", "manage.py", "update_elasticc2_sources" ],
@@ -213,6 +246,16 @@ def update_elasticc2_diasource_300days( classifications_300days_elasticc2_ingest
     # assert targ.objects.count() == obj.objects.count()
     assert src.objects.count() == 545
     assert frced.objects.count() == 4242
+    assert elasticc2.models.DiaObjectForcedSourceWatermark.objects.count() == obj.objects.count()
+    run = elasticc2.models.ImportPPDBRun.objects.order_by( '-run_id' )[0]
+    assert run.success
+    assert run.incremental
+    assert run.finished >= run.started
+    assert any( s['stage'] == 'Importing new forced sources' and s['rows'] == 4242 for s in run.stages )
+    assert elasticc2.models.ImportPPDBChunk.objects.filter( run_id=run.run_id ).count() > 0
+    assert elasticc2.models.ImportPPDBChunk.objects.filter( run_id=run.run_id, done=False ).count() == 0
+    assert elasticc2.models.ImportPPDBSource.objects.count() == 0
+    _check_elasticc2_summaries()
 
     yield True
 
@@ -242,18 +285,17 @@ def update_fastdb_dev_diasource_300days( classifications_300days_fastdb_dev_inge
     assert lut.objects.first().last_update_time > datetime.datetime.fromtimestamp( 0, tz=datetime.timezone.utc )
     assert lut.objects.first().last_update_time < datetime.datetime.now( tz=datetime.timezone.utc )
 
-    # TODO : right now, load_fastdb.py imports the future -- that is, it imports
-    #   the full ForcedSource lightcure for an object for which we got a source
-    #   the first time that source is seen, and never looks at forcedsources
-    #   again.  Update the tests numbers if/when it simulates not knowing the
-    #   future.
+    # load_fastdb imports forced sources through the latest source of each
+    #   object (and no further), the same as update_elasticc2_sources, so
+    #   these numbers match the elasticc2 ones.
     # (Really, we should probably creat a whole separate simulated PPDB server with
     #  an interface that will look something like the real PPDB interface... when
     #  we actually know what that is.)
 
     assert obj.objects.count() == 102
     assert src.objects.count() == 545
-    assert frced.objects.count() == 15760   # 4242
+    assert frced.objects.count() == 4242
+    assert fastdb_dev.models.DiaObjectForcedSourceWatermark.objects.count() == obj.objects.count()
     assert cfer.objects.count() == 2
     # assert cification.objects.count() == 831  # ???? WHy is this not 545 * 2 ?   LOOK INTO THIS
     #                                           # ---> seems to be non-deterministic!
@@ -367,6 +409,11 @@ def update_elasticc2_diasource_100daysmore( classifications_100daysmore_elasticc
     # assert targ.objects.count() == obj.objects.count()
     assert src.objects.count() == 650
     assert frced.objects.count() == 5765
+    assert elasticc2.models.DiaObjectForcedSourceWatermark.objects.count() == obj.objects.count()
+    run = elasticc2.models.ImportPPDBRun.objects.order_by( '-run_id' )[0]
+    assert run.success
+    assert any( s['stage'] == 'Importing new forced sources' and s['rows'] == 5765 - 4242 for s in run.stages )
+    _check_elasticc2_summaries()
 
     yield True
 
@@ -398,18 +445,17 @@ def update_fastdb_dev_diasource_100daysmore( classifications_100daysmore_fastdb_
     assert lut.objects.first().last_update_time > datetime.datetime.fromtimestamp( 0, tz=datetime.timezone.utc )
     assert lut.objects.first().last_update_time < datetime.datetime.now( tz=datetime.timezone.utc )
 
-    # TODO : right now, load_fastdb.py imports the future -- that is, it imports
-    #   the full ForcedSource lightcure for an object for which we got a source
-    #   the first time that source is seen, and never looks at forcedsources
-    #   again.  Update the tests numbers if/when it simulates not knowing the
-    #   future.
+    # load_fastdb imports forced sources through the latest source of each
+    #   object (and no further), the same as update_elasticc2_sources, so
+    #   these numbers match the elasticc2 ones.
     # (Really, we should probably creat a whole separate simulated PPDB server with
     #  an interface that will look something like the real PPDB interface... when
     #  we actually know what that is.)
 
     assert obj.objects.count() == 131
     assert src.objects.count() == 650
-    assert frced.objects.count() == 20834   # 5765
+    assert frced.objects.count() == 5765
+    assert fastdb_dev.models.DiaObjectForcedSourceWatermark.objects.count() == obj.objects.count()
     assert cfer.objects.count() == 2
     # assert cification.objects.count() == ...  # ???? WHy is this not 650 * 2 ?   LOOK INTO THIS
     # TODO : pver, ss, dpvss, dfspvss
@@ -0,0 +1,103 @@
+# Intended to be run with pytest, but not automatically
+#
+# Micro-benchmark of avro-encoding alerts, comparing the old way
+# AlertReconstructor did it (new BytesIO and schemaless_writer call per
+# alert, DDF alerts reconstructed twice) to AlertEncoder.encode_batch
+# with the limited DDF history sliced out of the full one.
+
+import sys
+import io
+import time
+import random
+import logging
+import pytest
+import fastavro
+
+sys.path.insert( 0, "/tom_desc/elasticc2/management/commands" )
+from _alertreconstructor import AlertEncoder
+from elasticc2.models import PPDBAlert, _reconstruct_objectfields
+
+_logger = logging.getLogger("main")
+_logout = logging.StreamHandler( sys.stderr )
+_logger.addHandler( _logout )
+_logout.setFormatter( logging.Formatter( f'[%(asctime)s - %(levelname)s] - %(message)s',
+                                         datefmt='%Y-%m-%d %H:%M:%S' ) )
+_logger.propagate = False
+_logger.setLevel( logging.INFO )
+
+_schemafile = "/tests/schema/elasticc.v0_9_1.alert.avsc"
+
+
+def _fake_alert( alertid, isddf ):
+    objid = alertid // 100
+    tai = 61000. + random.random() * 100.
+    nsrc = random.randint( 50, 200 ) if isddf else random.randint( 1, 30 )
+    nfrc = random.randint( 500, 2000 ) if isddf else random.randint( 20, 150 )
+    srctais = sorted( tai - 365 * random.random() for i in range( nsrc ) )
+    frctais = sorted( tai - 365 * random.random() for i in range( nfrc ) )
+    source = lambda i, t: { 'diaSourceId': alertid * 1000 + i, 'diaObjectId': objid, 'midPointTai': t,
+                            'filterName': random.choice( 'ugrizY' ), 'ra': 42., 'decl': -23.,
+                            'psFlux': random.gauss( 1000., 100. ), 'psFluxErr': 100., 'snr': 10. }
+    return { 'alertId': alertid,
+             'diaSource': source( 999, tai ),
+             'prvDiaSources': [ source( i, t ) for i, t in enumerate( srctais ) ],
+             'prvDiaForcedSources': [ { 'diaForcedSourceId': alertid * 10000 + i, 'diaObjectId': objid,
+                                        'midPointTai': t, 'filterName': random.choice( 'ugrizY' ),
+                                        'psFlux': random.gauss( 500., 100. ), 'psFluxErr': 100. }
+                                      for i, t in enumerate( frctais ) ],
+             'diaObject': { f: ( objid if f == 'diaObjectId' else None if f == 'simVersion' else 0.5 )
+                            for f in _reconstruct_objectfields } }
+
+
+@pytest.fixture( scope='module' )
+def wfd_and_ddf_alerts():
+    random.seed( 42 )
+    # Roughly the WFD/DDF mix we see in a night
+    return [ ( _fake_alert( 100 * i, i % 10 == 0 ), i % 10 == 0 ) for i in range( 5000 ) ]
+
+
+def test_encode_alerts( wfd_and_ddf_alerts ):
+    nddf = sum( 1 for a, isddf in wfd_and_ddf_alerts if isddf )
+
+    # Before: a BytesIO per message, and a second (here, pre-cut) reconstruction for DDF
+    schema = fastavro.schema.load_schema( _schemafile )
+    limited = { a['alertId']: PPDBAlert.limit_history( a, 30 ) for a, isddf in wfd_and_ddf_alerts if isddf }
+    t0 = time.perf_counter()
+    before = []
+    for alert, isddf in wfd_and_ddf_alerts:
+        msgio = io.BytesIO()
+        fastavro.write.schemaless_writer( msgio, schema, alert )
+        before.append( msgio.getvalue() )
+        if isddf:
+            msgio = io.BytesIO()
+            fastavro.write.schemaless_writer( msgio, schema, limited[ alert['alertId'] ] )
+            before.append( msgio.getvalue() )
+    t1 = time.perf_counter()
+
+    # After: one encoder, batches, limited history sliced from the full one
+    encoder = AlertEncoder( _schemafile )
+    after = []
+    batchsize = 100
+    for i in range( 0, len(wfd_and_ddf_alerts), batchsize ):
+        batch = wfd_and_ddf_alerts[ i : i+batchsize ]
+        fullmsgs = encoder.encode_batch( [ a for a, isddf in batch ] )
+        limitedmsgs = iter( encoder.encode_batch( [ PPDBAlert.limit_history( a, 30 )
+                                                    for a, isddf in batch if isddf ] ) )
+        for ( a, isddf ), msg in zip( batch, fullmsgs ):
+            after.append( msg )
+            if isddf:
+                after.append( next( limitedmsgs ) )
+    t2 = time.perf_counter()
+
+    nmsgs = len( wfd_and_ddf_alerts ) + nddf
+    _logger.info( f"Before: {nmsgs} messages ({nddf} DDF alerts) in {t1-t0:.2f} s ({nmsgs/(t1-t0):.0f} s⁻¹)" )
+    _logger.info( f" After: {nmsgs} messages ({nddf} DDF alerts) in {t2-t1:.2f} s ({nmsgs/(t2-t1):.0f} s⁻¹)" )
+
+    assert before == after
+    for alert, isddf in wfd_and_ddf_alerts[:20]:
+        lim = PPDBAlert.limit_history( alert, 30 )
+        mintai = alert['diaSource']['midPointTai'] - 30
+        assert all( s['midPointTai'] >= mintai for s in lim['prvDiaSources'] )
+        assert all( f['midPointTai'] >= mintai for f in lim['prvDiaForcedSources'] )
+        assert ( len( lim['prvDiaForcedSources'] )
+                 == sum( 1 for f in alert['prvDiaForcedSources'] if f['midPointTai'] >= mintai ) )
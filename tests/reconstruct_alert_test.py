@@ -24,3 +24,30 @@ def test_reconstruct_alerts( elasticc2_ppdb ):
 
     import pdb; pdb.set_trace()
     pass
+
+def test_bulk_reconstruct_alerts( elasticc2_ppdb ):
+    alerts = list( PPDBAlert.objects.order_by( 'diasource__midpointtai' ) )
+    alertids = [ a.alert_id for a in alerts ]
+
+    t0 = time.perf_counter()
+    single = [ alert.reconstruct() for alert in alerts ]
+    t1 = time.perf_counter()
+    batchsize = 100
+    bulk = []
+    for i in range( 0, len(alertids), batchsize ):
+        bulk.extend( PPDBAlert.bulk_reconstruct( alertids=alertids[i:i+batchsize] ) )
+    t2 = time.perf_counter()
+
+    _logger.info( f"Per-alert: {t1-t0:.1f} sec to reconstruct {len(alerts)} alerts "
+                  f"({len(alerts)/(t1-t0):.0f} s⁻¹)" )
+    _logger.info( f"Bulk (batches of {batchsize}): {t2-t1:.1f} sec to reconstruct {len(bulk)} alerts "
+                  f"({len(bulk)/(t2-t1):.0f} s⁻¹)" )
+
+    assert len(bulk) == len(single)
+    for one, many in zip( single, bulk ):
+        assert one['alertId'] == many['alertId']
+        assert one['diaSource'] == dict( many['diaSource'] )
+        assert one['diaObject'] == many['diaObject']
+        assert [ s['diaSourceId'] for s in one['prvDiaSources'] ] == [ s['diaSourceId'] for s in many['prvDiaSources'] ]
+        assert ( [ f['diaForcedSourceId'] for f in one['prvDiaForcedSources'] ]
+                 == [ f['diaForcedSourceId'] for f in many['prvDiaForcedSources'] ] )
@@ -168,6 +168,7 @@ class TestCassandra:
         cur = django.db.connection.cursor()
         cur.execute( "TRUNCATE TABLE elasticc2_brokersourceids" )
         cur.execute( "TRUNCATE TABLE elasticc2_brokerclassifier" )
+        BrokerClassifier.clear_registry()
         casscur = django.db.connections['cassandra'].connection.cursor()
         casscur.execute( "TRUNCATE TABLE tom_desc.cass_broker_message_by_time" )
         casscur.execute( "TRUNCATE TABLE tom_desc.cass_broker_message_by_source" )
@@ -260,11 +261,14 @@ class TestPostgres:
         cur = django.db.connection.cursor()
         cur.execute( "TRUNCATE TABLE elasticc2_brokersourceids" )
         cur.execute( "TRUNCATE TABLE elasticc2_brokerclassifier" )
+        BrokerClassifier.clear_registry()
         cur.execute( "TRUNCATE TABLE elasticc2_brokermessage" )
 
     def test_pg( self, load_pg ):
         bms = BrokerMessage.objects.all()
         assert len(bms) == len(load_pg)
+        assert ( BrokerSourceIds.objects.count()
+                 == len( set( a['msg']['diaSourceId'] for a in load_pg ) ) )
 
     def test_gen_brokerdelay( self, load_pg ):
         t0 = ( datetime.datetime.now( tz=pytz.utc ) + datetime.timedelta( days=-1 ) ).date().isoformat()
@@ -280,3 +284,75 @@ class TestPostgres:
         _logger.info( f"gen_elasticc2_brokerdelaygraphs took {tend-tstart:.1f} sec" )
 
 
+
+
+class TestPostgresCopyVsBulkCreate:
+    """Compare BrokerMessage.load_batch (COPY) to the ORM bulk_create it replaced."""
+
+    def bulk_create_batch( self, messages, classifiers ):
+        objs = []
+        sourceids = set()
+        for msg in messages:
+            cfer = classifiers[ ( msg['msg']['brokerName'], msg['msg']['brokerVersion'],
+                                  msg['msg']['classifierName'], msg['msg']['classifierParams'] ) ]
+            objs.append( BrokerMessage( streammessage_id=msg['msgoffset'],
+                                        topicname=msg['topic'],
+                                        alert_id=msg['msg']['alertId'],
+                                        diasource_id=msg['msg']['diaSourceId'],
+                                        msghdrtimestamp=msg['timestamp'],
+                                        descingesttimestamp=datetime.datetime.now( tz=pytz.utc ),
+                                        elasticcpublishtimestamp=msg['msg']['elasticcPublishTimestamp'],
+                                        brokeringesttimestamp=msg['msg']['brokerIngestTimestamp'],
+                                        classifier_id=cfer.classifier_id,
+                                        classid=[ c['classId'] for c in msg['msg']['classifications'] ],
+                                        probability=[ c['probability'] for c in msg['msg']['classifications'] ] ) )
+            sourceids.add( msg['msg']['diaSourceId'] )
+        BrokerSourceIds.objects.bulk_create( [ BrokerSourceIds( i ) for i in sourceids ], ignore_conflicts=True )
+        return BrokerMessage.objects.bulk_create( objs )
+
+    def time_loads( self, alerts, loader, delta=2000 ):
+        t0 = time.perf_counter()
+        for n in range( 0, len(alerts), delta ):
+            loader( alerts[ n : n+delta ] )
+        return time.perf_counter() - t0
+
+    def truncate( self ):
+        cur = django.db.connection.cursor()
+        cur.execute( "TRUNCATE TABLE elasticc2_brokersourceids" )
+        cur.execute( "TRUNCATE TABLE elasticc2_brokermessage" )
+
+    def test_copy_vs_bulk_create( self, lots_of_alerts ):
+        alerts = lots_of_alerts[ 0 : 100000 ]
+        try:
+            # Make sure all the classifiers exist
+            res = BrokerMessage.load_batch( alerts[0:1] )
+            classifiers = { ( c.brokername, c.brokerversion, c.classifiername, c.classifierparams ): c
+                            for c in BrokerClassifier.objects.all() }
+            self.truncate()
+
+            tcopy = self.time_loads( alerts, BrokerMessage.load_batch )
+            assert BrokerMessage.objects.count() == len(alerts)
+            self.truncate()
+
+            torm = self.time_loads( alerts, lambda batch: self.bulk_create_batch( batch, classifiers ) )
+            assert BrokerMessage.objects.count() == len(alerts)
+            self.truncate()
+
+            _logger.info( f"PG bulk_create: {len(alerts)} messages in {torm:.2f} sec "
+                          f"({len(alerts)/torm:.0f} s⁻¹)" )
+            _logger.info( f"PG COPY       : {len(alerts)} messages in {tcopy:.2f} sec "
+                          f"({len(alerts)/tcopy:.0f} s⁻¹)" )
+
+            # Make sure the returned-value contract didn't change
+            res = BrokerMessage.load_batch( alerts[0:100] )
+            assert res['addedmsgs'] == 100
+            ids = list( BrokerMessage.objects.values_list( 'brokermessage_id', flat=True ) )
+            assert res['firstbrokermessage_id'] == min( ids )
+            res = BrokerMessage.load_batch( [] )
+            assert res['addedmsgs'] == 0
+            assert res['firstbrokermessage_id'] is None
+        finally:
+            self.truncate()
+            cur = django.db.connection.cursor()
+            cur.execute( "TRUNCATE TABLE elasticc2_brokerclassifier" )
+            BrokerClassifier.clear_registry()
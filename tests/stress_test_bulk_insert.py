@@ -0,0 +1,91 @@
+# Intended to be run with pytest, but not automatically
+#
+# Benchmark of Createable.bulk_insert_onlynew.  Compares the CSV path
+# (data_to_createdict -> pandas -> CSV text -> COPY into a temp table ->
+# INSERT ... ON CONFLICT), the binary COPY path through the temp table,
+# and binary COPY directly into the (empty) table, loading synthetic
+# forced sources into the TrainingDiaForcedSource table.
+
+import sys
+import time
+import logging
+import pytest
+import numpy
+from astropy.table import Table
+
+import elasticc2.models as m
+
+_logger = logging.getLogger("main")
+_logout = logging.StreamHandler( sys.stderr )
+_logger.addHandler( _logout )
+_logout.setFormatter( logging.Formatter( f'[%(asctime)s - %(levelname)s] - %(message)s',
+                                         datefmt='%Y-%m-%d %H:%M:%S' ) )
+_logger.propagate = False
+_logger.setLevel( logging.INFO )
+
+_snid0 = 900000000
+_nobj = 1000
+
+
+def _forced_sources( nrows, seed=42 ):
+    rng = numpy.random.default_rng( seed )
+    objid = _snid0 + rng.integers( 0, _nobj, size=nrows )
+    return Table( { 'diaforcedsource_id': _snid0 * 1000 + numpy.arange( nrows, dtype=numpy.int64 ),
+                    'diaobject_id': objid,
+                    'midpointtai': rng.uniform( 60000., 61000., nrows ),
+                    'filtername': rng.choice( [ 'u', 'g', 'r', 'i', 'z', 'Y' ], size=nrows ),
+                    'psflux': rng.normal( 1000., 100., nrows ).astype( numpy.float32 ),
+                    'psfluxerr': rng.uniform( 10., 20., nrows ).astype( numpy.float32 ) } )
+
+
+def _clear_forced():
+    m.TrainingDiaForcedSource.objects.filter( diaobject_id__gte=_snid0 ).delete()
+
+
+@pytest.fixture( scope='module' )
+def objects():
+    if m.TrainingDiaForcedSource.objects.count() > 0:
+        pytest.skip( "TrainingDiaForcedSource needs to be empty to test direct COPY" )
+    objs = Table( { 'diaobject_id': _snid0 + numpy.arange( _nobj, dtype=numpy.int64 ),
+                    'simversion': numpy.full( _nobj, 'benchmark' ),
+                    'ra': numpy.random.uniform( 0., 360., _nobj ),
+                    'decl': numpy.random.uniform( -90., 30., _nobj ),
+                    'isddf': numpy.zeros( _nobj, dtype=bool ) } )
+    assert m.TrainingDiaObject.bulk_insert_onlynew( objs ) == _nobj
+    yield objs
+    _clear_forced()
+    m.TrainingDiaObject.objects.filter( diaobject_id__gte=_snid0 ).delete()
+
+
+@pytest.mark.parametrize( "nrows", [ 100000, 1000000 ] )
+def test_bulk_insert( objects, monkeypatch, nrows ):
+    data = _forced_sources( nrows )
+    rates = {}
+    firstrows = None
+
+    for how in [ 'csv', 'binary', 'direct' ]:
+        _clear_forced()
+        with monkeypatch.context() as mp:
+            if how == 'csv':
+                mp.setattr( m.TrainingDiaForcedSource, '_can_insert_columnar', lambda *args, **kwargs: False )
+            t0 = time.perf_counter()
+            n = m.TrainingDiaForcedSource.bulk_insert_onlynew( data, direct=( how == 'direct' ) )
+            rates[how] = nrows / ( time.perf_counter() - t0 )
+        assert n == nrows
+
+        # Make sure all three ways load the same thing
+        rows = list( m.TrainingDiaForcedSource.objects
+                     .filter( diaobject_id__gte=_snid0 ).order_by( 'diaforcedsource_id' )
+                     .values_list( 'diaforcedsource_id', 'diaobject_id', 'midpointtai',
+                                   'filtername', 'psflux', 'psfluxerr' )[:1000] )
+        if firstrows is None:
+            firstrows = rows
+        else:
+            assert rows == firstrows
+
+        # Loading again should add nothing (except when bypassing ON CONFLICT)
+        if how != 'direct':
+            assert m.TrainingDiaForcedSource.bulk_insert_onlynew( data ) == 0
+
+    for how, rate in rates.items():
+        _logger.info( f"{nrows} rows, {how:6s}: {rate:.0f} rows s⁻¹" )
@@ -0,0 +1,133 @@
+# Intended to be run with pytest, but not automatically
+#
+# Benchmark of BrokerConsumer's pipelined mode (DecodePipeline) against
+# decoding and saving serially.  Uses a recorded stream of fake broker
+# messages instead of a kafka server, and a writer that takes a fixed
+# time per message to stand in for the database.
+
+import sys
+import io
+import time
+import datetime
+import random
+import logging
+import pytest
+import fastavro
+import confluent_kafka
+
+sys.path.insert( 0, "/tom_desc/db/management/commands" )
+from _brokerconsumer import DecodePipeline
+
+_logger = logging.getLogger("main")
+_logout = logging.StreamHandler( sys.stderr )
+_logger.addHandler( _logout )
+_logout.setFormatter( logging.Formatter( f'[%(asctime)s - %(levelname)s] - %(message)s',
+                                         datefmt='%Y-%m-%d %H:%M:%S' ) )
+_logger.propagate = False
+_logger.setLevel( logging.INFO )
+
+_schemafile = "/tests/schema/elasticc.v0_9_1.brokerClassification.avsc"
+
+
+class FakeMessage:
+    """Quacks enough like a confluent_kafka.Message for BrokerConsumer."""
+
+    def __init__( self, topic, partition, offset, timestamp, value ):
+        self._topic = topic
+        self._partition = partition
+        self._offset = offset
+        self._timestamp = timestamp
+        self._value = value
+
+    def topic( self ):
+        return self._topic
+
+    def partition( self ):
+        return self._partition
+
+    def offset( self ):
+        return self._offset
+
+    def timestamp( self ):
+        return ( confluent_kafka.TIMESTAMP_CREATE_TIME, self._timestamp )
+
+    def value( self ):
+        return self._value
+
+
+@pytest.fixture( scope='module' )
+def recorded_messages():
+    nmsgs = 200000
+    npartitions = 4
+    schema = fastavro.schema.load_schema( _schemafile )
+    now = datetime.datetime.now( tz=datetime.timezone.utc )
+    msgs = []
+    offsets = [ 0 ] * npartitions
+    for i in range( nmsgs ):
+        ncls = random.randint( 1, 20 )
+        msg = { 'alertId': i,
+                'diaSourceId': i,
+                'elasticcPublishTimestamp': now,
+                'brokerIngestTimestamp': now,
+                'brokerName': 'decodetest',
+                'brokerVersion': '1.0',
+                'classifierName': 'random',
+                'classifierParams': '0',
+                'classifications': [ { 'classId': c, 'probability': 1. / ncls } for c in range( ncls ) ] }
+        msgio = io.BytesIO()
+        fastavro.write.schemaless_writer( msgio, schema, msg )
+        partition = i % npartitions
+        msgs.append( FakeMessage( 'decodetest', partition, offsets[partition],
+                                  int( now.timestamp() * 1000 ), msgio.getvalue() ) )
+        offsets[partition] += 1
+    return msgs
+
+
+class Writer:
+    def __init__( self, pertime=2e-6 ):
+        self.pertime = pertime
+        self.n = 0
+
+    def __call__( self, batch ):
+        time.sleep( self.pertime * len(batch) )
+        self.n += len( batch )
+
+
+def test_decode_pipeline( recorded_messages ):
+    batchsize = 1000
+    batches = [ recorded_messages[i:i+batchsize] for i in range( 0, len(recorded_messages), batchsize ) ]
+
+    # Serial: what BrokerConsumer.handle_message_batch does
+    schema = fastavro.schema.load_schema( _schemafile )
+    writer = Writer()
+    t0 = time.perf_counter()
+    for batch in batches:
+        raw, offsets = DecodePipeline.raw_messages( batch )
+        writer( [ { 'topic': topic, 'msgoffset': offset, 'timestamp': timestamp,
+                    'msg': fastavro.schemaless_reader( io.BytesIO( payload ), schema ) }
+                  for topic, offset, timestamp, payload in raw ] )
+    dt = time.perf_counter() - t0
+    assert writer.n == len( recorded_messages )
+    _logger.info( f"Serial    : {len(recorded_messages)} messages in {dt:.2f} s "
+                  f"({len(recorded_messages)/dt:.0f} s⁻¹)" )
+
+    for nworkers in [ 1, 2, 4, 8 ]:
+        writer = Writer()
+        pipeline = DecodePipeline( _schemafile, nworkers, writer )
+        committed = {}
+        t0 = time.perf_counter()
+        for batch in batches:
+            pipeline.submit( batch )
+            for tp in pipeline.take_committable():
+                committed[ ( tp.topic, tp.partition ) ] = tp.offset
+        pipeline.drain()
+        for tp in pipeline.take_committable():
+            committed[ ( tp.topic, tp.partition ) ] = tp.offset
+        dt = time.perf_counter() - t0
+        pipeline.close()
+
+        assert pipeline.error is None
+        assert writer.n == len( recorded_messages )
+        assert committed == { ( 'decodetest', p ): len(recorded_messages) // 4 for p in range(4) }
+        _logger.info( f"{nworkers} workers : {len(recorded_messages)} messages in {dt:.2f} s "
+                      f"({len(recorded_messages)/dt:.0f} s⁻¹)" )
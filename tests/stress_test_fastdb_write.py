@@ -0,0 +1,232 @@
+# Intended to be run with pytest, but not automatically
+#
+# Benchmark of the fastdb_dev write endpoints (bulk_create_*,
+# bulk_update_*).  Compares the way bulk_create_dia_source_data used to
+# work (a DiaObject.objects.get for every row, then bulk_create) and the
+# way the valid flag updates used to work (execute_batch of one UPDATE
+# per row) with the set-based versions, in-process, and then times the
+# endpoints through fastdb_api.FASTDBDataStore, both with the rows in
+# one JSON document and streamed as NDJSON or Arrow.
+
+import sys
+import time
+import random
+import logging
+import pytest
+import psycopg2.extras
+import pyarrow
+
+import django.db
+import fastdb_dev.models as m
+import fastdb_dev.DataTools as DataTools
+
+sys.path.insert( 0, "/fastdb_api" )
+import fastdb_api
+
+_logger = logging.getLogger("main")
+_logout = logging.StreamHandler( sys.stderr )
+_logger.addHandler( _logout )
+_logout.setFormatter( logging.Formatter( f'[%(asctime)s - %(levelname)s] - %(message)s',
+                                         datefmt='%Y-%m-%d %H:%M:%S' ) )
+_logger.propagate = False
+_logger.setLevel( logging.INFO )
+
+# Well above the ids in the test data, so the rows are easy to clean up
+_id0 = 900000000
+_nobj = 1000
+_pv = 'benchmark_pv'
+_ss = 'benchmark_ss'
+
+
+def _clear_sources():
+    with django.db.connection.cursor() as cursor:
+        cursor.execute( "DELETE FROM ds_to_pv_to_ss WHERE dia_source >= %(id)s", { 'id': _id0 * 1000 } )
+        cursor.execute( "DELETE FROM dia_source WHERE dia_object >= %(id)s", { 'id': _id0 } )
+
+
+@pytest.fixture( scope='module' )
+def objects():
+    with django.db.connection.cursor() as cursor:
+        cursor.execute( "INSERT INTO dia_object(dia_object,validity_start,season,fake_id,ra,ra_sigma,decl,"
+                        "  decl_sigma,ra_dec_tai,nobs,insert_time) "
+                        "SELECT i, NOW(), 1, 0, 180., 0.00001, 0., 0.00001, 60000., 0, NOW() "
+                        "FROM generate_series( %(id)s, %(id)s + %(n)s - 1 ) i",
+                        { 'id': _id0, 'n': _nobj } )
+    yield True
+    _clear_sources()
+    with django.db.connection.cursor() as cursor:
+        cursor.execute( "DELETE FROM dia_object WHERE dia_object >= %(id)s", { 'id': _id0 } )
+
+
+@pytest.fixture
+def datastore( objects, tmp_path, monkeypatch ):
+    with open( tmp_path / ".fastdbservices.ini", "w" ) as ofp:
+        ofp.write( "[fastdb]\nuser = root\npasswd = testing\n" )
+    monkeypatch.setenv( "HOME", str(tmp_path) )
+    for url in [ 'LOGIN_URL', 'TOKEN_URL', 'DIA_SOURCE_URL', 'DS_PV_SS_URL',
+                 'UPDATE_DS_PV_SS_URL', 'UPDATE_DIA_SOURCE_URL' ]:
+        monkeypatch.setattr( fastdb_api, url,
+                             getattr( fastdb_api, url ).replace( fastdb_api.URL, "http://tom:8080/fastdb_dev/" ) )
+    return fastdb_api.FASTDBDataStore()
+
+
+def _sources( nrows ):
+    rng = random.Random( 42 )
+    return [ { 'dia_source': _id0 * 1000 + i,
+               'dia_object': _id0 + ( i % _nobj ),
+               'processing_version': _pv,
+               'filter_name': rng.choice( [ 'u', 'g', 'r', 'i', 'z', 'Y' ] ),
+               'ra': 180.,
+               'decl': 0.,
+               'ps_flux': rng.gauss( 1000., 100. ),
+               'ps_flux_err': 10.,
+               'snr': 100.,
+               'mid_point_tai': rng.uniform( 60000., 61000. ),
+               'valid_flag': 1,
+               'broker_count': 2 }
+             for i in range( nrows ) ]
+
+
+def _old_bulk_create( rows ):
+    """What bulk_create_dia_source_data used to do, for comparison."""
+    sources = []
+    for data in rows:
+        ds = m.DiaSource()
+        for field in [ 'dia_source', 'filter_name', 'ra', 'decl', 'ps_flux', 'ps_flux_err', 'snr',
+                       'mid_point_tai', 'valid_flag', 'processing_version', 'broker_count' ]:
+            setattr( ds, field, data[field] )
+        do = m.DiaObject.objects.get( dia_object=data['dia_object'] )
+        ds.dia_object = do
+        ds.fake_id = do.fake_id
+        ds.season = do.season
+        sources.append( ds )
+    m.DiaSource.objects.bulk_create( sources )
+
+
+def _old_update( rows ):
+    """What bulk_update_dia_source_valid_flag used to do, for comparison."""
+    with django.db.connection.cursor() as cursor:
+        psycopg2.extras.execute_batch( cursor,
+                                       "update dia_source set valid_flag = %(valid_flag)s "
+                                       "where dia_source = %(dia_source)s "
+                                       "and processing_version = %(processing_version)s", rows )
+
+
+def _stored_sources():
+    return list( m.DiaSource.objects.filter( dia_object_id__gte=_id0 ).order_by( 'dia_source' )
+                 .values_list( 'dia_source', 'dia_object_id', 'season', 'fake_id', 'filter_name',
+                               'ps_flux', 'mid_point_tai', 'valid_flag', 'broker_count' ) )
+
+
+@pytest.mark.parametrize( "nrows", [ 1000, 10000 ] )
+def test_write_inprocess( objects, nrows ):
+    rows = _sources( nrows )
+    flags = [ { 'dia_source': r['dia_source'], 'processing_version': _pv, 'valid_flag': 0 } for r in rows[::2] ]
+
+    _clear_sources()
+    t0 = time.perf_counter()
+    _old_bulk_create( rows )
+    t1 = time.perf_counter()
+    _old_update( flags )
+    t2 = time.perf_counter()
+    old = _stored_sources()
+
+    _clear_sources()
+    t3 = time.perf_counter()
+    assert DataTools._in_transaction( DataTools._insert_dia_sources, rows ) == nrows
+    t4 = time.perf_counter()
+    assert ( DataTools._in_transaction( DataTools._update_valid_flags, flags,
+                                        'dia_source', DataTools._dia_source_keys )
+             == len( flags ) )
+    t5 = time.perf_counter()
+    new = _stored_sources()
+    _clear_sources()
+
+    assert new == old
+    assert sum( 1 for r in new if r[7] == 0 ) == len( flags )
+
+    _logger.info( f"{nrows} rows, old insert: {nrows/(t1-t0):.0f} rows s⁻¹, "
+                  f"old update: {len(flags)/(t2-t1):.0f} rows s⁻¹" )
+    _logger.info( f"{nrows} rows, new insert: {nrows/(t4-t3):.0f} rows s⁻¹, "
+                  f"new update: {len(flags)/(t5-t4):.0f} rows s⁻¹" )
+
+
+def test_write_web( datastore ):
+    nrows = 50000
+    rows = _sources( nrows )
+    dspvss = [ { 'dia_source': r['dia_source'], 'processing_version': _pv, 'snapshot_name': _ss, 'valid_flag': 1 }
+               for r in rows ]
+    flags = [ { 'dia_source': r['dia_source'], 'processing_version': _pv, 'valid_flag': 0 } for r in rows[::2] ]
+    ssflags = [ dict( f, snapshot_name=_ss ) for f in flags ]
+
+    _clear_sources()
+    try:
+        times = {}
+        t0 = time.perf_counter()
+        assert datastore.data_insert( 'dia_source', rows ) == f'{nrows} Rows of Data stored'
+        times['insert dia_source'] = ( nrows, time.perf_counter() - t0 )
+        t0 = time.perf_counter()
+        assert datastore.data_insert( 'ds_to_pv_to_ss', dspvss ) == f'{nrows} Rows of Data stored'
+        times['insert ds_to_pv_to_ss'] = ( nrows, time.perf_counter() - t0 )
+        t0 = time.perf_counter()
+        assert datastore.data_update( 'dia_source', flags ) == f'{len(flags)} Rows of Data stored'
+        times['update dia_source'] = ( len(flags), time.perf_counter() - t0 )
+        t0 = time.perf_counter()
+        assert datastore.data_update( 'ds_to_pv_to_ss', ssflags ) == f'{len(flags)} Rows of Data stored'
+        times['update ds_to_pv_to_ss'] = ( len(flags), time.perf_counter() - t0 )
+
+        assert m.DiaSource.objects.filter( dia_object_id__gte=_id0, valid_flag=0 ).count() == len( flags )
+        assert ( m.DStoPVtoSS.objects.filter( dia_source__gte=_id0 * 1000, valid_flag=0 ).count()
+                 == len( flags ) )
+
+        # Sources of unknown objects are an error, and nothing gets stored
+        bad = _sources( 10 )
+        for r in bad:
+            r['dia_source'] += nrows
+        bad[-1]['dia_object'] = _id0 + _nobj
+        res = datastore.data_insert( 'dia_source', bad )
+        assert res['status'] == 'error'
+        assert 'unknown dia_objects' in res['error']
+        assert m.DiaSource.objects.filter( dia_object_id__gte=_id0 ).count() == nrows
+
+        # Too many rows
+        res = datastore.data_update( 'dia_source', [ flags[0] ] * ( DataTools._max_write_rows + 1 ) )
+        assert res['status'] == 'error'
+        assert 'limit' in res['error']
+
+        for what, ( n, dt ) in times.items():
+            _logger.info( f"{what:22s} through the web: {n/dt:.0f} rows s⁻¹" )
+    finally:
+        _clear_sources()
+
+
+@pytest.mark.parametrize( "format", [ 'ndjson', 'arrow' ] )
+def test_write_stream( datastore, format ):
+    # More rows than a JSON request is allowed
+    nrows = 2 * DataTools._max_write_rows
+    rows = _sources( nrows )
+    flags = [ { 'dia_source': r['dia_source'], 'processing_version': _pv, 'valid_flag': 0 } for r in rows[::2] ]
+    if format == 'arrow':
+        rows = pyarrow.Table.from_pylist( rows )
+        flags = pyarrow.Table.from_pylist( flags )
+    else:
+        # Generators, so the client never has all the rows as JSON
+        rows = ( r for r in rows )
+        flags = ( f for f in flags )
+
+    _clear_sources()
+    try:
+        t0 = time.perf_counter()
+        assert datastore.data_insert_stream( 'dia_source', rows, format=format ) == f'{nrows} Rows of Data stored'
+        t1 = time.perf_counter()
+        assert ( datastore.data_update_stream( 'dia_source', flags, format=format )
+                 == f'{nrows//2} Rows of Data stored' )
+        t2 = time.perf_counter()
+
+        assert m.DiaSource.objects.filter( dia_object_id__gte=_id0 ).count() == nrows
+        assert m.DiaSource.objects.filter( dia_object_id__gte=_id0, valid_flag=0 ).count() == nrows // 2
+
+        _logger.info( f"{format:6s} stream, {nrows} rows: insert {nrows/(t1-t0):.0f} rows s⁻¹, "
+                      f"update {(nrows//2)/(t2-t1):.0f} rows s⁻¹" )
+    finally:
+        _clear_sources()
@@ -0,0 +1,196 @@
+# Intended to be run with pytest, but not automatically
+#
+# Benchmark of load_fastdb, row-by-row vs. --bulk, on a synthetic mongo
+# collection of broker messages for synthetic PPDB objects, sources,
+# and forced sources.  Makes sure that both modes load the same things
+# into FASTDB, and reports broker messages (alerts) per second.
+
+import os
+import sys
+import time
+import datetime
+import logging
+import pytest
+import numpy
+from astropy.table import Table
+from pymongo import MongoClient
+
+import django.db
+import django.core.management
+import elasticc2.models
+import fastdb_dev.models
+
+_logger = logging.getLogger("main")
+_logout = logging.StreamHandler( sys.stderr )
+_logger.addHandler( _logout )
+_logout.setFormatter( logging.Formatter( f'[%(asctime)s - %(levelname)s] - %(message)s',
+                                         datefmt='%Y-%m-%d %H:%M:%S' ) )
+_logger.propagate = False
+_logger.setLevel( logging.INFO )
+
+# Well above the ids in the test data, so the rows are easy to clean up
+_id0 = 900000000
+_nobj = 300
+_nsrcperobj = 10
+_nfrcperobj = 50
+_classifiers = [ 'BenchmarkClassifierA', 'BenchmarkClassifierB' ]
+
+
+@pytest.fixture( scope='module' )
+def synthetic_ppdb():
+    rng = numpy.random.default_rng( 42 )
+    objid = _id0 + numpy.arange( _nobj, dtype=numpy.int64 )
+    objs = Table( { 'diaobject_id': objid,
+                    'simversion': numpy.full( _nobj, 'benchmark' ),
+                    'ra': rng.uniform( 0., 360., _nobj ),
+                    'decl': rng.uniform( -90., 30., _nobj ),
+                    'isddf': numpy.zeros( _nobj, dtype=bool ) } )
+    srcs = Table( { 'diasource_id': ( numpy.repeat( objid, _nsrcperobj ) * 1000
+                                      + numpy.tile( numpy.arange( _nsrcperobj ), _nobj ) ),
+                    'diaobject_id': numpy.repeat( objid, _nsrcperobj ),
+                    'midpointtai': rng.uniform( 60000., 61000., _nobj * _nsrcperobj ),
+                    'filtername': rng.choice( [ 'u', 'g', 'r', 'i', 'z', 'Y' ], size=_nobj * _nsrcperobj ),
+                    'ra': numpy.repeat( objs['ra'], _nsrcperobj ),
+                    'decl': numpy.repeat( objs['decl'], _nsrcperobj ),
+                    'psflux': rng.normal( 1000., 100., _nobj * _nsrcperobj ).astype( numpy.float32 ),
+                    'psfluxerr': numpy.full( _nobj * _nsrcperobj, 10., dtype=numpy.float32 ),
+                    'snr': numpy.full( _nobj * _nsrcperobj, 100., dtype=numpy.float32 ) } )
+    frcs = Table( { 'diaforcedsource_id': ( numpy.repeat( objid, _nfrcperobj ) * 1000
+                                            + numpy.tile( numpy.arange( _nfrcperobj ), _nobj ) ),
+                    'diaobject_id': numpy.repeat( objid, _nfrcperobj ),
+                    'midpointtai': rng.uniform( 60000., 61000., _nobj * _nfrcperobj ),
+                    'filtername': rng.choice( [ 'u', 'g', 'r', 'i', 'z', 'Y' ], size=_nobj * _nfrcperobj ),
+                    'psflux': rng.normal( 1000., 100., _nobj * _nfrcperobj ).astype( numpy.float32 ),
+                    'psfluxerr': numpy.full( _nobj * _nfrcperobj, 10., dtype=numpy.float32 ) } )
+    elasticc2.models.PPDBDiaObject.bulk_insert_onlynew( objs )
+    elasticc2.models.PPDBDiaSource.bulk_insert_onlynew( srcs )
+    elasticc2.models.PPDBDiaForcedSource.bulk_insert_onlynew( frcs )
+
+    yield srcs, frcs
+
+    elasticc2.models.PPDBDiaForcedSource.objects.filter( diaobject_id__gte=_id0 ).delete()
+    elasticc2.models.PPDBDiaSource.objects.filter( diaobject_id__gte=_id0 ).delete()
+    elasticc2.models.PPDBDiaObject.objects.filter( diaobject_id__gte=_id0 ).delete()
+
+
+@pytest.fixture( scope='module' )
+def synthetic_mongo( synthetic_ppdb ):
+    client = MongoClient( f"mongodb://{os.getenv('MONGODB_ALERT_WRITER')}:"
+                          f"{os.getenv('MONGODB_ALERT_WRITER_PASSWORD')}@{os.getenv('MONGOHOST')}:27017/"
+                          f"?authSource=alerts" )
+    coll = client.alerts.test
+    srcs, frcs = synthetic_ppdb
+    timestamp = datetime.datetime.now( tz=datetime.timezone.utc ) - datetime.timedelta( minutes=1 )
+    docs = []
+    for srcid in srcs['diasource_id']:
+        for cfer in _classifiers:
+            docs.append( { 'topic': 'benchmark',
+                           'timestamp': timestamp,
+                           'msg': { 'alertId': int( srcid ),
+                                    'diaSourceId': int( srcid ),
+                                    'brokerName': 'FakeBroker',
+                                    'brokerVersion': 'v1.0',
+                                    'classifierName': cfer,
+                                    'classifierParams': 'benchmark',
+                                    'classifications': [ { 'classId': 2222, 'probability': 0.6 },
+                                                         { 'classId': 2223, 'probability': 0.4 } ] } } )
+    nmatch = len( docs )
+    # ...and some that load_fastdb should ignore
+    for srcid in srcs['diasource_id']:
+        docs.append( { 'topic': 'benchmark',
+                       'timestamp': timestamp,
+                       'msg': { 'alertId': int( srcid ),
+                                'diaSourceId': int( srcid ),
+                                'brokerName': 'FakeBroker',
+                                'brokerVersion': 'v1.0',
+                                'classifierName': 'BenchmarkClassifierIgnored',
+                                'classifierParams': 'benchmark',
+                                'classifications': [ { 'classId': 2222, 'probability': 0.05 },
+                                                     { 'classId': 1111, 'probability': 0.95 } ] } } )
+    coll.insert_many( docs )
+
+    yield coll, nmatch
+
+    coll.delete_many( { 'msg.diaSourceId': { '$gte': _id0 } } )
+
+
+def _clear_fastdb():
+    with django.db.connection.cursor() as cursor:
+        cursor.execute( "DELETE FROM dfs_to_pv_to_ss WHERE dia_forced_source >= %(id)s", { 'id': _id0 * 1000 } )
+        cursor.execute( "DELETE FROM dia_forced_source WHERE dia_object >= %(id)s", { 'id': _id0 } )
+        cursor.execute( "DELETE FROM ds_to_pv_to_ss WHERE dia_source >= %(id)s", { 'id': _id0 * 1000 } )
+        cursor.execute( "DELETE FROM dia_source WHERE dia_object >= %(id)s", { 'id': _id0 } )
+        cursor.execute( "DELETE FROM dia_object WHERE dia_object >= %(id)s", { 'id': _id0 } )
+        cursor.execute( "DELETE FROM dia_object_forced_source_watermark WHERE dia_object >= %(id)s", { 'id': _id0 } )
+        cursor.execute( "DELETE FROM broker_classification WHERE dia_source >= %(id)s", { 'id': _id0 * 1000 } )
+        cursor.execute( "DELETE FROM broker_classifier WHERE classifier_params='benchmark'" )
+
+
+def _fastdb_contents():
+    with django.db.connection.cursor() as cursor:
+        cursor.execute( "SELECT dia_object, nobs, ra FROM dia_object WHERE dia_object >= %(id)s "
+                        "ORDER BY dia_object", { 'id': _id0 } )
+        objs = cursor.fetchall()
+        cursor.execute( "SELECT dia_source, dia_object, broker_count, ps_flux FROM dia_source "
+                        "WHERE dia_object >= %(id)s ORDER BY dia_source", { 'id': _id0 } )
+        srcs = cursor.fetchall()
+        cursor.execute( "SELECT COUNT(*) FROM ds_to_pv_to_ss WHERE dia_source >= %(id)s", { 'id': _id0 * 1000 } )
+        ndspvss = cursor.fetchone()[0]
+        cursor.execute( "SELECT dia_forced_source, dia_object, ps_flux FROM dia_forced_source "
+                        "WHERE dia_object >= %(id)s ORDER BY dia_forced_source", { 'id': _id0 } )
+        frcs = cursor.fetchall()
+        cursor.execute( "SELECT COUNT(*) FROM dfs_to_pv_to_ss WHERE dia_forced_source >= %(id)s",
+                        { 'id': _id0 * 1000 } )
+        ndfspvss = cursor.fetchone()[0]
+        cursor.execute( "SELECT COUNT(*) FROM broker_classification WHERE dia_source >= %(id)s",
+                        { 'id': _id0 * 1000 } )
+        nbc = cursor.fetchone()[0]
+    return { 'objs': objs, 'srcs': srcs, 'ndspvss': ndspvss, 'frcs': frcs, 'ndfspvss': ndfspvss, 'nbc': nbc }
+
+
+def test_load_fastdb( synthetic_ppdb, synthetic_mongo ):
+    coll, nmsgs = synthetic_mongo
+    # Forced sources only get loaded through the latest source of each object
+    srcs, frcs = synthetic_ppdb
+    latest = numpy.full( _nobj, -numpy.inf )
+    numpy.maximum.at( latest, srcs['diaobject_id'] - _id0, srcs['midpointtai'] )
+    nforced = ( frcs['midpointtai'] <= latest[ frcs['diaobject_id'] - _id0 ] ).sum()
+    lut = fastdb_dev.models.LastUpdateTime
+    origlut = list( lut.objects.values_list( 'last_update_time', flat=True ) )
+
+    try:
+        contents = {}
+        rates = {}
+        for mode, extra in [ ( 'row-by-row', [] ), ( 'bulk', [ '--bulk', '--batch-size', '1000' ] ) ]:
+            _clear_fastdb()
+            lut.objects.all().delete()
+            lut.objects.create( last_update_time=( datetime.datetime.now( tz=datetime.timezone.utc )
+                                                   - datetime.timedelta( minutes=5 ) ) )
+            t0 = time.perf_counter()
+            django.core.management.call_command( 'load_fastdb', '--pv', 'benchmark_pv',
+                                                 '--snapshot', 'benchmark_ss', '--brokers', 'test', *extra )
+            rates[mode] = nmsgs / ( time.perf_counter() - t0 )
+            contents[mode] = _fastdb_contents()
+
+        for mode, c in contents.items():
+            assert c['nbc'] == nmsgs
+            assert len( c['objs'] ) == _nobj
+            assert all( row[1] == _nsrcperobj for row in c['objs'] )
+            assert len( c['srcs'] ) == _nobj * _nsrcperobj
+            assert all( row[2] == len( _classifiers ) for row in c['srcs'] )
+            assert c['ndspvss'] == len( c['srcs'] )
+            assert len( c['frcs'] ) == nforced
+            assert c['ndfspvss'] == len( c['frcs'] )
+        assert contents['row-by-row'] == contents['bulk']
+        assert any( list( info['key'] ) == [ ( 'msg.brokerName', 1 ), ( 'timestamp', 1 ),
+                                             ( 'msg.classifications.classId', 1 ) ]
+                    for info in coll.index_information().values() )
+
+        for mode, rate in rates.items():
+            _logger.info( f"load_fastdb {mode:10s}: {rate:.0f} alerts s⁻¹" )
+
+    finally:
+        _clear_fastdb()
+        lut.objects.all().delete()
+        for t in origlut:
+            lut.objects.create( last_update_time=t )
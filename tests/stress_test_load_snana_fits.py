@@ -0,0 +1,180 @@
+# Intended to be run with pytest, but not automatically
+#
+# Benchmark of load_snana_fits on a synthetic SNANA HEAD/PHOT file pair.
+# Compares the old way of building the tables (python loops over every
+# object in the HEAD file) with the vectorized FITSFileHandler.build_tables,
+# and times loading the file pair into the Training* tables.
+
+import sys
+import time
+import types
+import logging
+import pytest
+import numpy
+from astropy.table import Table
+
+import elasticc2.models as m
+from elasticc2.management.commands.load_snana_fits import FITSFileHandler
+
+_logger = logging.getLogger("main")
+_logout = logging.StreamHandler( sys.stderr )
+_logger.addHandler( _logout )
+_logout.setFormatter( logging.Formatter( f'[%(asctime)s - %(levelname)s] - %(message)s',
+                                         datefmt='%Y-%m-%d %H:%M:%S' ) )
+_logger.propagate = False
+_logger.setLevel( logging.INFO )
+
+# Well above the SNIDs in the test data, so the rows are easy to clean up
+_snid0 = 900000000
+
+
+def _write_snana_files( direc, nobj, seed=42 ):
+    """Write a synthetic HEAD/PHOT pair, with separator rows in the PHOT file the way SNANA does it."""
+    rng = numpy.random.default_rng( seed )
+    nobs = rng.integers( 20, 200, size=nobj )
+    # A few DDF-ish objects
+    nobs[ rng.choice( nobj, size=max( 1, nobj//100 ), replace=False ) ] = 1200
+    # +1 for the separator row after each object
+    ptrmax = numpy.cumsum( nobs + 1 ) - 1
+    ptrmin = ptrmax - nobs + 1
+
+    head = Table( { 'SNID': numpy.array( [ str(i) for i in range( _snid0, _snid0+nobj ) ] ),
+                    'RA': rng.uniform( 0., 360., nobj ),
+                    'DEC': rng.uniform( -90., 30., nobj ),
+                    'MWEBV': rng.uniform( 0., 0.2, nobj ).astype( numpy.float32 ),
+                    'MWEBV_ERR': rng.uniform( 0., 0.02, nobj ).astype( numpy.float32 ),
+                    'REDSHIFT_FINAL': rng.uniform( 0., 1., nobj ).astype( numpy.float32 ),
+                    'REDSHIFT_FINAL_ERR': rng.uniform( 0., 0.1, nobj ).astype( numpy.float32 ),
+                    'PTROBS_MIN': ptrmin.astype( numpy.int32 ),
+                    'PTROBS_MAX': ptrmax.astype( numpy.int32 ),
+                    'SIM_TYPE_INDEX': numpy.zeros( nobj, dtype=numpy.int16 ) } )
+
+    nphot = ptrmax[-1]
+    photflag = numpy.where( rng.random( nphot ) < 0.05, 4096, 0 ).astype( numpy.int32 )
+    mjd = rng.uniform( 60000., 61000., nphot )
+    separators = ptrmax[:-1]
+    mjd[ separators ] = -777.
+    photflag[ separators ] = 0
+    phot = Table( { 'MJD': mjd,
+                    'BAND': rng.choice( [ 'u ', 'g ', 'r ', 'i ', 'z ', 'Y ' ], size=nphot ),
+                    'FLUXCAL': rng.normal( 100., 50., nphot ).astype( numpy.float32 ),
+                    'FLUXCALERR': rng.uniform( 5., 20., nphot ).astype( numpy.float32 ),
+                    'PHOTFLAG': photflag,
+                    'ZEROPT': numpy.full( nphot, 27.5, dtype=numpy.float32 ) } )
+
+    headfile = direc / "SYNTH_HEAD.FITS.gz"
+    photfile = direc / "SYNTH_PHOT.FITS.gz"
+    head.write( headfile, overwrite=True )
+    phot.write( photfile, overwrite=True )
+    return headfile, photfile
+
+
+def _old_build_tables( hndlr, orig_head, phot ):
+    """What load_one_file used to do, for comparison."""
+    head = Table( orig_head )
+    hndlr.diaobject_map_columns( head )
+    head.add_column( hndlr.simversion, name='simversion' )
+    head.add_column( False, name='isddf' )
+    for origrow, row in zip( orig_head, head ):
+        if ( origrow['PTROBS_MAX'] - origrow['PTROBS_MIN'] + 1 ) > 1000:
+            row['isddf'] = True
+
+    phot['FLUXCAL'] *= 10 ** ( ( hndlr.alert_zeropoint - hndlr.snana_zeropoint ) / 2.5 )
+    phot['FLUXCALERR'] *= 10 ** ( ( hndlr.alert_zeropoint - hndlr.snana_zeropoint ) / 2.5 )
+    hndlr.diasource_map_columns( phot )
+    phot.add_column( numpy.int64(-1), name='diaobject_id' )
+    phot.add_column( numpy.int64(-1), name='diaforcedsource_id' )
+    phot['snr'] = phot['psflux'] / phot['psfluxerr']
+    phot['filtername'] = [ i.strip() for i in phot['filtername'] ]
+    phot.add_column( -999., name='ra' )
+    phot.add_column( -999., name='decl' )
+    for obj in orig_head:
+        pmin = obj['PTROBS_MIN'] -1
+        pmax = obj['PTROBS_MAX'] -1
+        phot['diaobject_id'][pmin:pmax+1] = obj['SNID']
+        phot['diaforcedsource_id'][pmin:pmax+1] = ( obj['SNID'] * hndlr.max_sources_per_object
+                                                    + numpy.arange( pmax - pmin + 1 ) )
+        phot['ra'][pmin:pmax+1] = obj['RA']
+        phot['decl'][pmin:pmax+1] = obj['DEC']
+    phot = phot[ phot['diaobject_id'] >= 0 ]
+
+    sources = phot[ ( phot['photflag'] & hndlr.photflag_detect ) != 0 ]
+    sources.rename_column( 'diaforcedsource_id', 'diasource_id' )
+    alerts = { 'alert_id': sources[ 'diasource_id' ],
+               'diasource_id': sources[ 'diasource_id' ],
+               'diaobject_id': sources[ 'diaobject_id' ] }
+    return head, phot, sources, alerts
+
+
+def _read( headfile, photfile ):
+    orig_head = Table.read( headfile )
+    orig_head['SNID'] = orig_head['SNID'].astype( numpy.int64 )
+    return orig_head, Table.read( photfile )
+
+
+@pytest.fixture
+def handler( tmp_path, monkeypatch ):
+    # FITSFileHandler writes a log file to the current directory
+    monkeypatch.chdir( tmp_path )
+    parent = types.SimpleNamespace( simversion='benchmark', max_sources_per_object=100000,
+                                    photflag_detect=4096, snana_zeropoint=27.5, alert_zeropoint=31.4,
+                                    really_do=True, verbose=False, tableset='training', direct_copy=False )
+    return FITSFileHandler( parent, None )
+
+
+def _report( what, dt, head, forced, sources, alerts ):
+    _logger.info( f"{what}: {len(head)/dt:.0f} objects s⁻¹, {len(forced)/dt:.0f} forced sources s⁻¹, "
+                  f"{len(sources)/dt:.0f} sources s⁻¹, {len(alerts['alert_id'])/dt:.0f} alerts s⁻¹ "
+                  f"({dt:.2f} s)" )
+
+
+@pytest.mark.parametrize( "nobj", [ 1000, 10000 ] )
+def test_build_tables( handler, tmp_path, nobj ):
+    headfile, photfile = _write_snana_files( tmp_path, nobj )
+
+    orig_head, phot = _read( headfile, photfile )
+    t0 = time.perf_counter()
+    old = _old_build_tables( handler, orig_head, phot )
+    t1 = time.perf_counter()
+
+    orig_head, phot = _read( headfile, photfile )
+    t2 = time.perf_counter()
+    new = handler.build_tables( orig_head, phot )
+    t3 = time.perf_counter()
+
+    # Same rows, possibly in a different order (the old way kept PHOT file order)
+    for oldtab, newtab, key in zip( old[:3], new[:3], [ 'diaobject_id', 'diaforcedsource_id', 'diasource_id' ] ):
+        assert set( oldtab.columns ) == set( newtab.columns )
+        oldtab = oldtab[ numpy.argsort( oldtab[key] ) ]
+        newtab = newtab[ numpy.argsort( newtab[key] ) ]
+        for col in oldtab.columns:
+            assert numpy.all( numpy.asarray( oldtab[col] ) == numpy.asarray( newtab[col] ) ), col
+    assert new[0]['isddf'].sum() == nobj // 100
+    assert set( new[1]['filtername'] ) == { 'u', 'g', 'r', 'i', 'z', 'Y' }
+    assert ( new[1]['diaobject_id'] >= _snid0 ).all()
+
+    _report( f"{nobj} objects, old build", t1-t0, *old )
+    _report( f"{nobj} objects, new build", t3-t2, *new )
+
+
+def test_load_one_file( handler, tmp_path ):
+    headfile, photfile = _write_snana_files( tmp_path, 2000 )
+    try:
+        t0 = time.perf_counter()
+        res = handler.load_one_file( headfile, photfile )
+        dt = time.perf_counter() - t0
+        assert res['ok'], res['msg']
+
+        nobj = m.TrainingDiaObject.objects.filter( diaobject_id__gte=_snid0 ).count()
+        nfrc = m.TrainingDiaForcedSource.objects.filter( diaobject_id__gte=_snid0 ).count()
+        nsrc = m.TrainingDiaSource.objects.filter( diaobject_id__gte=_snid0 ).count()
+        nalrt = m.TrainingAlert.objects.filter( diaobject_id__gte=_snid0 ).count()
+        assert nobj == 2000
+        assert nalrt == nsrc
+        _logger.info( f"load_one_file: {nobj/dt:.0f} objects s⁻¹, {nfrc/dt:.0f} forced sources s⁻¹, "
+                      f"{nsrc/dt:.0f} sources s⁻¹, {nalrt/dt:.0f} alerts s⁻¹ ({dt:.2f} s)" )
+    finally:
+        m.TrainingAlert.objects.filter( diaobject_id__gte=_snid0 ).delete()
+        m.TrainingDiaSource.objects.filter( diaobject_id__gte=_snid0 ).delete()
+        m.TrainingDiaForcedSource.objects.filter( diaobject_id__gte=_snid0 ).delete()
+        m.TrainingDiaObject.objects.filter( diaobject_id__gte=_snid0 ).delete()
@@ -0,0 +1,97 @@
+# Intended to be run with pytest, but not automatically
+#
+# Benchmark of db/runsqlquery.  Compares the way RunSQLQuery used to
+# work (new connection for every request, RealDictCursor, a dict per
+# row) to a pooled connection and a columnar response, both in-process
+# (to isolate the database and serialization costs) and through the web
+# server with the three response formats.
+
+import sys
+import json
+import time
+import logging
+import pytest
+import psycopg2
+import psycopg2.extras
+import psycopg2.pool
+import pyarrow.ipc
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+_logger = logging.getLogger("main")
+_logout = logging.StreamHandler( sys.stderr )
+_logger.addHandler( _logout )
+_logout.setFormatter( logging.Formatter( f'[%(asctime)s - %(levelname)s] - %(message)s',
+                                         datefmt='%Y-%m-%d %H:%M:%S' ) )
+_logger.propagate = False
+_logger.setLevel( logging.INFO )
+
+_dbargs = { 'host': 'postgres', 'user': 'postgres', 'password': 'fragile', 'dbname': 'tom_desc' }
+_query = "SELECT * FROM elasticc2_ppdbdiaforcedsource ORDER BY diaforcedsource_id LIMIT %(n)s"
+
+
+def _old_way( nrows ):
+    conn = psycopg2.connect( **_dbargs, cursor_factory=psycopg2.extras.RealDictCursor )
+    try:
+        cursor = conn.cursor()
+        cursor.execute( _query, { 'n': nrows } )
+        rows = cursor.fetchall()
+        return json.dumps( { 'status': 'ok', 'rows': rows }, cls=DjangoJSONEncoder )
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def _new_way( pool, nrows ):
+    conn = pool.getconn()
+    try:
+        cursor = conn.cursor( name="runsqlquery" )
+        cursor.execute( _query, { 'n': nrows } )
+        rows = cursor.fetchmany( nrows + 1 )
+        columns = [ d.name for d in cursor.description ]
+        return json.dumps( { 'status': 'ok', 'columns': columns, 'data': [ list(c) for c in zip( *rows ) ] },
+                           cls=DjangoJSONEncoder )
+    finally:
+        conn.rollback()
+        pool.putconn( conn )
+
+
+@pytest.mark.parametrize( "nrows", [ 10, 1000, 50000 ] )
+def test_runsqlquery_inprocess( elasticc2_ppdb, nrows ):
+    nreqs = max( 10, 20000 // nrows )
+
+    t0 = time.perf_counter()
+    for i in range( nreqs ):
+        oldresp = _old_way( nrows )
+    t1 = time.perf_counter()
+
+    pool = psycopg2.pool.ThreadedConnectionPool( 0, 4, **_dbargs )
+    for i in range( nreqs ):
+        newresp = _new_way( pool, nrows )
+    t2 = time.perf_counter()
+    pool.closeall()
+
+    old = json.loads( oldresp )
+    new = json.loads( newresp )
+    assert [ r['diaforcedsource_id'] for r in old['rows'] ] == new['data'][ new['columns'].index('diaforcedsource_id') ]
+
+    _logger.info( f"{nrows} rows, old way: {nreqs/(t1-t0):.1f} requests s⁻¹, {len(oldresp)} bytes" )
+    _logger.info( f"{nrows} rows, new way: {nreqs/(t2-t1):.1f} requests s⁻¹, {len(newresp)} bytes" )
+
+
+@pytest.mark.parametrize( "nrows", [ 10, 1000, 50000 ] )
+def test_runsqlquery_web( elasticc2_ppdb, tomclient, nrows ):
+    nreqs = max( 5, 5000 // nrows )
+    query = _query.replace( '%(n)s', str(nrows) )
+    for format in [ 'rows', 'columns', 'arrow' ]:
+        t0 = time.perf_counter()
+        for i in range( nreqs ):
+            res = tomclient.post( 'db/runsqlquery/', json={ 'query': query, 'format': format } )
+            assert res.status_code == 200
+        dt = time.perf_counter() - t0
+        if format == 'arrow':
+            assert len( pyarrow.ipc.open_stream( res.content ).read_all() ) == nrows
+        else:
+            assert res.json()['status'] == 'ok'
+        _logger.info( f"{nrows} rows, format {format:7s}: {nreqs/dt:.1f} requests s⁻¹, "
+                      f"{len(res.content)} bytes" )
@@ -8,15 +8,21 @@ import dateutil.parser
 import pytz
 import time
 import subprocess
+import uuid
+import multiprocessing
+import tracemalloc
 
 import pytest
 import psycopg2
 import psycopg2.extras
+import numpy
 import pandas
+import pyarrow.ipc
 
 sys.path.insert( 0, "/tom_desc" )
 
 import db.models
+import db.views
 
 # Use the last alertcycle fixture api_classify_existing_alerts to get
 # the database into a known state.  This is kind of slow, due to all the
@@ -119,6 +125,94 @@ class TestSQLWebInterface:
                                       
         # TODO : more error modes
 
+    def test_run_query_formats( self, tomclient ):
+        query = "SELECT * FROM elasticc2_gentypeofclassid ORDER BY id"
+        res = tomclient.post( 'db/runsqlquery/', json={ 'query': query } )
+        assert 'truncated' not in res.json()
+        rows = res.json()['rows']
+        assert len(rows) == 54
+
+        res = tomclient.post( 'db/runsqlquery/', json={ 'query': query, 'format': 'columns' } )
+        assert res.status_code == 200
+        data = res.json()
+        assert data['status'] == 'ok'
+        assert 'truncated' not in data
+        assert set( data['columns'] ) == set( rows[0].keys() )
+        for col, vals in zip( data['columns'], data['data'] ):
+            assert vals == [ r[col] for r in rows ]
+
+        res = tomclient.post( 'db/runsqlquery/', json={ 'query': query, 'format': 'arrow' } )
+        assert res.status_code == 200
+        assert res.headers['Content-Type'] == 'application/vnd.apache.arrow.stream'
+        df = pyarrow.ipc.open_stream( res.content ).read_pandas()
+        assert len(df) == 54
+        assert list( df['classid'] ) == [ r['classid'] for r in rows ]
+
+        # Row cap
+        res = tomclient.post( 'db/runsqlquery/', json={ 'query': query, 'maxrows': 10 } )
+        data = res.json()
+        assert data['status'] == 'ok'
+        assert data['truncated']
+        assert data['rows'] == rows[:10]
+
+        # Statement timeout
+        res = tomclient.post( 'db/runsqlquery/', json={ 'query': "SELECT pg_sleep(5)", 'timeout': 1 } )
+        data = res.json()
+        assert data['status'] == 'error'
+        assert re.search( 'statement timeout', data['error'] ) is not None
+
+        # Make sure a temp table from one request doesn't stick around on
+        # the pooled connection for the next one
+        for i in range( 10 ):
+            res = tomclient.post( 'db/runsqlquery/',
+                                  json={ 'query': [ "CREATE TEMP TABLE junk( i int )", "SELECT * FROM junk" ] } )
+            assert res.json()['status'] == 'ok'
+
+    def test_run_query_cache( self, tomclient ):
+        db.models.QueryResultCache.invalidate()
+        query = "SELECT * FROM elasticc2_gentypeofclassid ORDER BY id"
+
+        # Not cached unless asked for
+        res = tomclient.post( 'db/runsqlquery/', json={ 'query': query } )
+        assert 'X-Cache' not in res.headers
+        uncached = res.json()
+
+        res = tomclient.post( 'db/runsqlquery/', json={ 'query': query, 'cache': True } )
+        assert res.headers['X-Cache'] == 'miss'
+        assert res.json() == uncached
+        # Whitespace differences shouldn't matter
+        res = tomclient.post( 'db/runsqlquery/', json={ 'query': f"  {query.replace(' ', '   ')} ;", 'cache': True } )
+        assert res.headers['X-Cache'] == 'hit'
+        assert res.json() == uncached
+        # ...but the format should
+        res = tomclient.post( 'db/runsqlquery/', json={ 'query': query, 'format': 'arrow', 'cache': 60 } )
+        assert res.headers['X-Cache'] == 'miss'
+        res = tomclient.post( 'db/runsqlquery/', json={ 'query': query, 'format': 'arrow', 'cache': 60 } )
+        assert res.headers['X-Cache'] == 'hit'
+        assert len( pyarrow.ipc.open_stream( res.content ).read_all() ) == 54
+
+        res = tomclient.post( 'db/querycachestats/' )
+        stats = res.json()
+        assert stats['status'] == 'ok'
+        assert stats['entries'] == 2
+        assert stats['entryhits'] == 2
+
+        # Errors don't get cached
+        res = tomclient.post( 'db/runsqlquery/', json={ 'query': "SELECT * FROM nonexistent_table", 'cache': True } )
+        assert res.json()['status'] == 'error'
+        assert 'X-Cache' not in res.headers
+
+        # Invalidation only throws out entries for the given app's tables
+        # (fastdb_dev tables don't have the app name in them)
+        res = tomclient.post( 'db/runsqlquery/', json={ 'query': "SELECT COUNT(*) FROM dia_object", 'cache': True } )
+        assert res.headers['X-Cache'] == 'miss'
+        assert db.models.QueryResultCache.invalidate( 'fastdb_dev' ) == 1
+        assert db.models.QueryResultCache.invalidate( 'fastdb_dev' ) == 0
+        assert db.models.QueryResultCache.invalidate( 'elasticc2' ) == 2
+        res = tomclient.post( 'db/runsqlquery/', json={ 'query': query, 'cache': True } )
+        assert res.headers['X-Cache'] == 'miss'
+        db.models.QueryResultCache.invalidate()
+
     # The next set of fixtures and tests probably violate some
     # assumption about how pytest is supposed to be used, but oh well.
     # The tests depend on some fixtures having been run and others not
@@ -181,6 +275,8 @@ class TestSQLWebInterface:
         assert res.status_code == 200
         data = res.json()
         assert data['status'] == 'finished'
+        assert data['nrows'] == 1950
+        assert data['nbytes'] > 0
 
         res = tomclient.post( f'db/getsqlqueryresults/{submit_long_query}/' )
         assert res.status_code == 200
@@ -189,6 +285,47 @@ class TestSQLWebInterface:
         df = pandas.read_pickle( bio )
         assert len(df) == 1950
 
+        # Byte ranges
+        full = res.content
+        assert res.headers['Accept-Ranges'] == 'bytes'
+        res = tomclient.post( f'db/getsqlqueryresults/{submit_long_query}/', headers={ 'Range': 'bytes=100-199' } )
+        assert res.status_code == 206
+        assert res.headers['Content-Range'] == f'bytes 100-199/{len(full)}'
+        assert res.content == full[100:200]
+        res = tomclient.post( f'db/getsqlqueryresults/{submit_long_query}/',
+                              headers={ 'Range': f'bytes={len(full)}-' } )
+        assert res.status_code == 416
+
+        # Compressed transfer (requests decompresses gzip by itself)
+        res = tomclient.post( f'db/getsqlqueryresults/{submit_long_query}/', json={ 'compression': 'gzip' } )
+        assert res.status_code == 200
+        assert res.headers['Content-Encoding'] == 'gzip'
+        assert res.content == full
+
+        # Resuming a download
+        outf = pathlib.Path( f'/tmp/{submit_long_query}' )
+        try:
+            outf.write_bytes( full[:1000] )
+            assert tomclient.download_long_query_results( submit_long_query, outf ) == len(full)
+            assert outf.read_bytes() == full
+        finally:
+            outf.unlink( missing_ok=True )
+
+        # Whether or not this client can decompress zstd, the file is the uncompressed result
+        try:
+            assert tomclient.download_long_query_results( submit_long_query, outf, compression='zstd' ) == len(full)
+            assert outf.read_bytes() == full
+        finally:
+            outf.unlink( missing_ok=True )
+
+        # Pages
+        page = tomclient.get_long_query_page( submit_long_query, offset=10, limit=5 )
+        assert page['nrows'] == 1950
+        assert page['offset'] == 10
+        assert [ r['brokermessage_id'] for r in page['rows'] ] == list( df['brokermessage_id'][10:15] )
+        page = tomclient.get_long_query_page( submit_long_query, offset=1948, limit=5 )
+        assert len( page['rows'] ) == 2
+
     def test_queries_purged( self, tomclient, submit_long_query, purge_long_queries ):
         direc = pathlib.Path( '/query_results' )
         assert len( [ i for i in  direc.glob( '*' ) ] ) == 0
@@ -198,3 +335,84 @@ class TestSQLWebInterface:
         cursor.execute( 'SELECT COUNT(*) AS count FROM db_queryqueue' )
         rows = cursor.fetchall()
         assert rows[0]['count'] == 0
+
+
+def test_csv_page_at_large_offset( tmp_path ):
+    # A page deep in a big csv result shouldn't need memory that grows with the offset
+    nrows = 1000000
+    path = tmp_path / "results"
+    pandas.DataFrame( { 'x': numpy.arange( nrows ), 'y': numpy.arange( nrows ) * 2. } ).to_csv( path )
+
+    tracemalloc.start()
+    try:
+        df = db.views.GetLongSQLQueryResultsPage().read_page( path, 'csv', nrows - 10, 5 )
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert list( df.index ) == list( range( nrows - 10, nrows - 5 ) )
+    assert list( df['x'] ) == list( range( nrows - 10, nrows - 5 ) )
+    assert list( df['y'] ) == [ 2. * i for i in range( nrows - 10, nrows - 5 ) ]
+    # A set of a million ints is ~60MB
+    assert peak < 10 * 1024 * 1024
+
+    df = db.views.GetLongSQLQueryResultsPage().read_page( path, 'csv', nrows - 2, 5 )
+    assert list( df['x'] ) == [ nrows - 2, nrows - 1 ]
+
+
+class TestLongQueryClaiming:
+
+    @pytest.fixture
+    def queued_queries( self ):
+        now = datetime.datetime.now( tz=datetime.timezone.utc )
+        qs = {}
+        # alice has one query running already, so bob gets to go first
+        # at the same priority, even though alice's other queries are older
+        for name, submitter, priority, started, dt in [ ( 'arunning', 'alice', 0, now, 0 ),
+                                                        ( 'a1', 'alice', 0, None, 1 ),
+                                                        ( 'a2', 'alice', 0, None, 2 ),
+                                                        ( 'b1', 'bob', 0, None, 3 ),
+                                                        ( 'blow', 'bob', -1, None, 4 ),
+                                                        ( 'chigh', 'carol', 1, None, 5 ) ]:
+            qs[name] = db.models.QueryQueue.objects.create( queryid=uuid.uuid4(),
+                                                            submitted=now + datetime.timedelta( seconds=dt ),
+                                                            started=started, submitter=submitter,
+                                                            priority=priority, queries=[ 'SELECT 1' ],
+                                                            subdicts=[ {} ] )
+        yield qs
+        db.models.QueryQueue.objects.filter( queryid__in=[ q.queryid for q in qs.values() ] ).delete()
+
+    def test_claim_order( self, queued_queries ):
+        sys.path.insert( 0, "/tom_desc/db/management/commands" )
+        from long_query_runner import Command
+
+        runner = Command()
+        order = []
+        while True:
+            queryinfo = runner.get_queued_query()
+            if queryinfo is None:
+                break
+            order.append( queryinfo['queryid'] )
+        byid = { str(q.queryid): name for name, q in queued_queries.items() }
+        # Once bob's query is claimed, alice and bob each have one running, so it's back to oldest first
+        assert [ byid[str(i)] for i in order ] == [ 'chigh', 'b1', 'a1', 'a2', 'blow' ]
+
+    def test_abandoned_query( self, queued_queries ):
+        sys.path.insert( 0, "/tom_desc/db/management/commands" )
+        from long_query_runner import Command
+
+        runner = Command()
+        claim = multiprocessing.Array( 'c', 36 )
+        queryinfo = runner.get_queued_query( claim )
+        assert str( queryinfo['queryid'] ) == str( queued_queries['chigh'].queryid )
+        assert claim.value.decode( 'ascii' ) == str( queryinfo['queryid'] )
+
+        # What run_workers does when the worker that claimed this query dies
+        runner.fail_abandoned_query( claim.value.decode( 'ascii' ), "worker died" )
+        q = db.models.QueryQueue.objects.get( queryid=queryinfo['queryid'] )
+        assert q.finished is not None
+        assert q.error
+        assert q.errortext == "worker died"
+
+        # ...and it doesn't count as running any more, so carol isn't held back
+        assert db.models.QueryQueue.objects.filter( submitter='carol', started__isnull=False,
+                                                    finished__isnull=True ).count() == 0
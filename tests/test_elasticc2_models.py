@@ -4,6 +4,9 @@ import datetime
 import dateutil.parser
 import pytz
 
+import django.db
+from django.test.utils import CaptureQueriesContext
+
 from elasticc2.models import ( CassBrokerMessageBySource,
                                CassBrokerMessageByTime,
                                BrokerSourceIds,
@@ -46,6 +49,7 @@ class TestElasticc2Models:
         BrokerSourceIds.objects.filter( diasource_id__in=sourceids ).delete()
 
         BrokerClassifier.objects.filter( classifier_id__in=[ i.classifier_id for i in cfers ] ).delete()
+        BrokerClassifier.clear_registry()
 
 
         
@@ -105,3 +109,19 @@ class TestElasticc2Models:
         for msg in msgs.all():
             sources.add( msg.diasource_id )
         assert sources.issubset( set( [ b.diasource_id for b in BrokerSourceIds.objects.all() ] ) )
+
+    def test_classifier_registry( self, loaded_broker_classifications ):
+        cfers = BrokerClassifier.objects.filter( brokername__in=[ 'rbc_test1', 'rbc_test2' ] )
+        tags = [ ( c.brokername, c.brokerversion, c.classifiername, c.classifierparams ) for c in cfers ]
+        assert len( tags ) > 0
+        before = BrokerClassifier.registry_stats()
+        with CaptureQueriesContext( django.db.connection ) as queries:
+            ids, nadded = BrokerClassifier.ids_for( tags )
+        assert len( queries ) == 0
+        assert nadded == 0
+        assert ids == { ( c.brokername, c.brokerversion, c.classifiername, c.classifierparams ): c.classifier_id
+                        for c in cfers }
+        after = BrokerClassifier.registry_stats()
+        assert after['hits'] == before['hits'] + len( tags )
+        assert after['misses'] == before['misses']
+
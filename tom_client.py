@@ -1,4 +1,6 @@
+import time
 import requests
+import urllib3.util.request
 
 class TomClient:
     """A thin class that supports sending requests via "requests" to the DESC tom.
@@ -91,4 +93,73 @@ class TomClient:
         """Shortand for TomClient.request( "PUT", ... )"""
         return self.request( "PUT", page, **kwargs )
 
+    def download_long_query_results( self, queryid, filename, compression=None, retries=5,
+                                     blocksize=1024*1024 ):
+        """Download the results of a finished long SQL query to a file.
+
+        queryid : the query id you got back from db/submitsqlquery/
+
+        filename : where to write the results.  If this file already
+          exists (e.g. from a previous download that was interrupted),
+          the download picks up where it left off.  (So delete it first
+          if you want to start over!)
+
+        compression : None, "gzip", or "zstd"; ask the server to compress
+          the data in transit.  This only applies to a download that
+          starts from the beginning; the file written is always the
+          uncompressed result.  requests can only decompress zstd if the
+          zstandard package is installed (and urllib3 is version 2 or
+          later); if it can't, gzip is used instead.
+
+        retries : try this many times to resume after a failed request
+          before giving up.
+
+        Returns the number of bytes in the file.
+
+        """
+        page = f"db/getsqlqueryresults/{queryid}/"
+        if ( compression == 'zstd' ) and ( 'zstd' not in urllib3.util.request.ACCEPT_ENCODING ):
+            compression = 'gzip'
+        tries = 0
+        while True:
+            try:
+                with open( filename, "ab" ) as ofp:
+                    have = ofp.tell()
+                    if have == 0:
+                        res = self.post( page, json={ 'compression': compression }, stream=True )
+                    else:
+                        res = self.post( page, headers={ 'Range': f'bytes={have}-' }, stream=True )
+                    if res.status_code == 416:
+                        # Asked for the bytes after the end of the file; we already have it all
+                        res.close()
+                        return have
+                    if res.status_code not in ( 200, 206 ):
+                        raise RuntimeError( f"Got status {res.status_code} downloading results: {res.text}" )
+                    if ( have > 0 ) and ( res.status_code != 206 ):
+                        # Server didn't honor the range; start over
+                        ofp.truncate( 0 )
+                    for block in res.iter_content( chunk_size=blocksize ):
+                        ofp.write( block )
+                    return ofp.tell()
+            except requests.exceptions.RequestException:
+                tries += 1
+                if tries >= retries:
+                    raise
+                time.sleep( 2 * tries )
+
+    def get_long_query_page( self, queryid, offset=0, limit=1000 ):
+        """Get rows offset through offset+limit-1 of the results of a finished long SQL query.
+
+        Returns a dict with 'offset', 'nrows' (the total number of rows
+        in the result), and 'rows' (a list of dicts).
+
+        """
+        res = self.post( f"db/getsqlqueryresultspage/{queryid}/", json={ 'offset': offset, 'limit': limit } )
+        if res.status_code != 200:
+            raise RuntimeError( f"Got status {res.status_code} getting results page: {res.text}" )
+        data = res.json()
+        if data['status'] != 'ok':
+            raise RuntimeError( f"Error getting results page: {data['error']}" )
+        return data
+
     
@@ -0,0 +1,86 @@
+import json
+
+import pyarrow
+
+
+def unique_names( columns ):
+    """Return a copy of the list columns where repeated names get _1, _2, etc. appended."""
+    names = list( columns )
+    for i, col in enumerate( names ):
+        n = 1
+        while names[i] in names[:i]:
+            names[i] = f"{col}_{n}"
+            n += 1
+    return names
+
+
+class ArrowTableBuilder:
+    """Turns rows from a psycopg2 cursor into pyarrow Tables.
+
+    The arrow schema comes from the postgres column types (the type_code
+    of each entry in cursor.description), rather than being guessed from
+    the data, which would go wrong for columns that happen to be all NULL
+    in a given batch of rows.  Types without an obvious arrow equivalent
+    are turned into strings.  Repeated column names get _1, _2, etc.
+    appended.
+
+    """
+
+    _typeofoid = { 16: pyarrow.bool_(),
+                   20: pyarrow.int64(),
+                   21: pyarrow.int16(),
+                   23: pyarrow.int32(),
+                   26: pyarrow.int64(),
+                   700: pyarrow.float32(),
+                   701: pyarrow.float64(),
+                   1700: pyarrow.float64(),
+                   1082: pyarrow.date32(),
+                   1114: pyarrow.timestamp( 'us' ),
+                   1184: pyarrow.timestamp( 'us', tz='UTC' ),
+                   1000: pyarrow.list_( pyarrow.bool_() ),
+                   1005: pyarrow.list_( pyarrow.int16() ),
+                   1007: pyarrow.list_( pyarrow.int32() ),
+                   1016: pyarrow.list_( pyarrow.int64() ),
+                   1021: pyarrow.list_( pyarrow.float32() ),
+                   1022: pyarrow.list_( pyarrow.float64() ),
+                   1009: pyarrow.list_( pyarrow.string() ),
+                   1015: pyarrow.list_( pyarrow.string() ),
+                  }
+
+    @staticmethod
+    def _tostring( val ):
+        if val is None or isinstance( val, str ):
+            return val
+        if isinstance( val, ( dict, list ) ):
+            return json.dumps( val, default=str )
+        return str( val )
+
+    @staticmethod
+    def _tofloat( val ):
+        return None if val is None else float( val )
+
+    def __init__( self, columns, typeoids ):
+        self.schema = pyarrow.schema( [ ( name, self._typeofoid.get( oid, pyarrow.string() ) )
+                                        for name, oid in zip( unique_names( columns ), typeoids ) ] )
+        self.converters = []
+        for oid, field in zip( typeoids, self.schema ):
+            if oid == 1700:
+                self.converters.append( self._tofloat )
+            elif field.type == pyarrow.string():
+                self.converters.append( self._tostring )
+            else:
+                self.converters.append( None )
+
+    @classmethod
+    def from_cursor( cls, cursor ):
+        return cls( [ d.name for d in cursor.description ], [ d.type_code for d in cursor.description ] )
+
+    def table( self, rows ):
+        """rows is a sequence of tuples (not dicts)."""
+        arrays = []
+        for i, ( field, conv ) in enumerate( zip( self.schema, self.converters ) ):
+            vals = [ row[i] for row in rows ]
+            if conv is not None:
+                vals = [ conv(v) for v in vals ]
+            arrays.append( pyarrow.array( vals, type=field.type ) )
+        return pyarrow.Table.from_arrays( arrays, schema=self.schema )
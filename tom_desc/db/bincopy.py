@@ -0,0 +1,144 @@
+import numpy
+
+
+class BinaryCopyStream:
+    """A file-like object that reads as postgres binary COPY data for a set of columns.
+
+    Pass it to psycopg2's cursor.copy_expert with
+    "COPY table(col,...) FROM STDIN WITH (FORMAT binary)".
+
+    Each column is a numpy array (or anything numpy.asarray can handle,
+    e.g. an astropy Column or a pandas Series) and the postgres type oid
+    of the column it's going into.  Rows are encoded a chunk of chunksize
+    at a time with whole-column numpy operations, so the whole data set
+    is never in memory as COPY data (or as python objects).
+
+    NULLs come from masked arrays (e.g. astropy MaskedColumn), NaNs in
+    floating-point columns (the same as the CSV path in
+    Createable.bulk_insert_onlynew), and Nones in object columns.
+
+    Only a handful of types are supported; use supports() to check.
+
+    """
+
+    _dtypeofoid = { 16: numpy.dtype( 'u1' ),
+                    20: numpy.dtype( '>i8' ),
+                    21: numpy.dtype( '>i2' ),
+                    23: numpy.dtype( '>i4' ),
+                    700: numpy.dtype( '>f4' ),
+                    701: numpy.dtype( '>f8' ),
+                   }
+    # text, bpchar, varchar
+    _textoids = { 25, 1042, 1043 }
+
+    _header = b'PGCOPY\n\xff\r\n\x00' + numpy.array( [ 0, 0 ], dtype='>i4' ).tobytes()
+    _trailer = numpy.array( [ -1 ], dtype='>i2' ).tobytes()
+
+    @classmethod
+    def supports( cls, typeoid ):
+        return ( typeoid in cls._dtypeofoid ) or ( typeoid in cls._textoids )
+
+    def __init__( self, columns, typeoids, chunksize=100000 ):
+        if len( columns ) != len( typeoids ):
+            raise ValueError( "Number of columns and number of type oids must match" )
+        for oid in typeoids:
+            if not self.supports( oid ):
+                raise TypeError( f"Binary COPY of postgres type oid {oid} isn't supported" )
+        self.columns = [ self._values_and_nulls( col, oid ) for col, oid in zip( columns, typeoids ) ]
+        self.typeoids = list( typeoids )
+        self.nrows = len( self.columns[0][0] ) if len( self.columns ) > 0 else 0
+        if any( len( vals ) != self.nrows for vals, nulls in self.columns ):
+            raise ValueError( "All columns must have the same length" )
+        self.chunksize = chunksize
+        self._chunks = self._generate()
+        self._buffer = b''
+        self._offset = 0
+
+    def _values_and_nulls( self, col, oid ):
+        nulls = numpy.ma.getmaskarray( col ) if numpy.ma.isMaskedArray( col ) else None
+        vals = numpy.asarray( numpy.ma.getdata( col ) )
+        if vals.dtype.kind == 'O':
+            isnone = numpy.array( [ v is None for v in vals ], dtype=bool )
+            nulls = isnone if nulls is None else ( nulls | isnone )
+        elif vals.dtype.kind == 'f':
+            isnan = numpy.isnan( vals )
+            nulls = isnan if nulls is None else ( nulls | isnan )
+        if nulls is None:
+            nulls = numpy.zeros( len( vals ), dtype=bool )
+        return vals, nulls
+
+    def _encode_text( self, vals, nulls ):
+        if vals.dtype.kind == 'O':
+            vals = numpy.array( [ '' if n else ( v if isinstance( v, ( str, bytes ) ) else str( v ) )
+                                  for v, n in zip( vals, nulls ) ] )
+        if vals.dtype.kind == 'U':
+            vals = numpy.char.encode( vals, 'utf-8' )
+        elif vals.dtype.kind != 'S':
+            vals = vals.astype( str ).astype( 'S' )
+        vals = numpy.ascontiguousarray( vals )
+        return vals, numpy.char.str_len( vals ).astype( numpy.int64 )
+
+    def encode( self, start, end ):
+        """Return the COPY data (without header or trailer) for rows start:end."""
+        n = end - start
+        encoded = []
+        sizes = numpy.full( n, 2, dtype=numpy.int64 )
+        for ( vals, nulls ), oid in zip( self.columns, self.typeoids ):
+            vals = vals[start:end]
+            nulls = nulls[start:end]
+            if oid in self._textoids:
+                vals, lens = self._encode_text( vals, nulls )
+            else:
+                # (Whatever NaNs turn into when cast to an integer type doesn't
+                # matter, since those are NULL and won't be written.)
+                with numpy.errstate( invalid='ignore' ):
+                    vals = vals.astype( self._dtypeofoid[oid] )
+                lens = numpy.full( n, vals.dtype.itemsize, dtype=numpy.int64 )
+            lens[ nulls ] = 0
+            encoded.append( ( vals, lens, nulls ) )
+            sizes += 4 + lens
+
+        rowstart = numpy.cumsum( sizes ) - sizes
+        buf = numpy.empty( sizes.sum(), dtype=numpy.uint8 )
+        buf[ rowstart[:, None] + numpy.arange( 2 ) ] = numpy.frombuffer( numpy.array( [ len(self.columns) ],
+                                                                                       dtype='>i2' ).tobytes(),
+                                                                         dtype=numpy.uint8 )
+        pos = rowstart + 2
+        for vals, lens, nulls in encoded:
+            fieldlen = numpy.where( nulls, -1, lens ).astype( '>i4' )
+            buf[ pos[:, None] + numpy.arange( 4 ) ] = fieldlen.view( numpy.uint8 ).reshape( n, 4 )
+            pos += 4
+            width = vals.dtype.itemsize
+            if width > 0:
+                valbytes = vals.view( numpy.uint8 ).reshape( n, width )
+                if vals.dtype.kind == 'S':
+                    keep = numpy.arange( width ) < lens[:, None]
+                else:
+                    keep = numpy.repeat( ~nulls[:, None], width, axis=1 )
+                buf[ ( pos[:, None] + numpy.arange( width ) )[ keep ] ] = valbytes[ keep ]
+            pos += lens
+        return buf.tobytes()
+
+    def _generate( self ):
+        yield self._header
+        for start in range( 0, self.nrows, self.chunksize ):
+            yield self.encode( start, min( start + self.chunksize, self.nrows ) )
+        yield self._trailer
+
+    def read( self, size=-1 ):
+        pieces = []
+        nread = 0
+        while ( size < 0 ) or ( nread < size ):
+            if self._offset >= len( self._buffer ):
+                try:
+                    self._buffer = next( self._chunks )
+                    self._offset = 0
+                except StopIteration:
+                    break
+            n = len( self._buffer ) - self._offset
+            if size >= 0:
+                n = min( n, size - nread )
+            pieces.append( self._buffer[ self._offset : self._offset + n ] )
+            self._offset += n
+            nread += n
+        return b''.join( pieces )
@@ -7,10 +7,15 @@ import traceback
 import pathlib
 import urllib
 import logging
+import queue
+import threading
+import multiprocessing
 
 import confluent_kafka
 import fastavro
 from pymongo import MongoClient
+import pymongo.errors
+from pymongo.write_concern import WriteConcern
 
 # TODO : uncomment this next line
 #   and the whole PittGoogleBroker class
@@ -28,6 +33,146 @@ sys.path.append( str( _djangodir / "db/management/commands" ) )
 from _consumekafkamsgs import MsgConsumer
 
 
+# ======================================================================
+# Pipelined decoding: the thread running MsgConsumer.poll_loop fetches
+# batches from kafka and hands the raw payloads to a pool of decode
+# processes; a single writer thread takes decoded batches (in the order
+# they were fetched) off of a bounded queue and saves them.  Kafka offsets
+# are only committed once the writer has saved a batch.
+
+_decoder_schema = None
+
+def _decoder_init( schemafile ):
+    global _decoder_schema
+    _decoder_schema = fastavro.parse_schema( fastavro.schema.load_schema( schemafile ) )
+
+def _decode_chunk( rawmsgs ):
+    """Runs in a DecodePipeline pool process.
+
+    rawmsgs is a list of ( topic, offset, timestamp, avro payload )
+
+    """
+    return [ { 'topic': topic,
+               'msgoffset': offset,
+               'timestamp': timestamp,
+               'msg': fastavro.schemaless_reader( io.BytesIO( payload ), _decoder_schema ) }
+             for topic, offset, timestamp, payload in rawmsgs ]
+
+
+class DecodePipeline:
+    """Decode kafka messages in a process pool, save them in a writer thread.
+
+    schemafile : the avro schema of the messages
+    nworkers : number of decode processes
+    writer : a callable; called (in the writer thread) with lists of
+             decoded messages in the form BrokerMessage.load_batch wants
+    queuedepth : maximum number of batches that have been submitted but
+                 not yet written.  submit() blocks when there are this
+                 many, which is what keeps the kafka fetch from running
+                 arbitrarily far ahead of the database.  Defaults to
+                 2*nworkers.
+
+    Create one of these *before* opening database or kafka connections,
+    as the pool processes are forked.
+
+    """
+
+    def __init__( self, schemafile, nworkers, writer, queuedepth=None, logger=logging.getLogger(__name__) ):
+        self.logger = logger
+        self.nworkers = nworkers
+        self.writer = writer
+        self.pool = multiprocessing.Pool( nworkers, initializer=_decoder_init, initargs=( str(schemafile), ) )
+        self.queue = queue.Queue( maxsize=( 2 * nworkers if queuedepth is None else queuedepth ) )
+        self._lock = threading.Lock()
+        self._committable = {}
+        self.error = None
+        self.nwritten = 0
+        self.thread = threading.Thread( target=self._write_loop, daemon=True )
+        self.thread.start()
+
+    @staticmethod
+    def raw_messages( msgs ):
+        """Pull the picklable bits out of a list of confluent_kafka.Message.
+
+        Returns ( list of ( topic, offset, timestamp, payload ),
+                  { ( topic, partition ): next offset to consume } )
+
+        """
+        raw = []
+        offsets = {}
+        for msg in msgs:
+            timestamptype, timestamp = msg.timestamp()
+            if timestamptype == confluent_kafka.TIMESTAMP_NOT_AVAILABLE:
+                timestamp = None
+            else:
+                timestamp = datetime.datetime.fromtimestamp( timestamp / 1000, tz=datetime.timezone.utc )
+            raw.append( ( msg.topic(), msg.offset(), timestamp, msg.value() ) )
+            key = ( msg.topic(), msg.partition() )
+            offsets[ key ] = max( offsets.get( key, 0 ), msg.offset() + 1 )
+        return raw, offsets
+
+    def submit( self, msgs ):
+        """Queue up a list of confluent_kafka.Message for decoding and writing.
+
+        Blocks if there are already queuedepth batches waiting.  Raises
+        if the writer has failed; nothing submitted after that will be
+        written until clear_error() is called.
+
+        """
+        if self.error is not None:
+            raise RuntimeError( f"DecodePipeline writer failed: {self.error}" ) from self.error
+        raw, offsets = self.raw_messages( msgs )
+        chunksize = -( -len(raw) // self.nworkers )
+        chunks = [ raw[i:i+chunksize] for i in range( 0, len(raw), chunksize ) ]
+        self.queue.put( ( self.pool.map_async( _decode_chunk, chunks ), offsets ) )
+
+    def _write_loop( self ):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                # After a failure, throw away everything in flight; since
+                # those offsets never get committed, kafka will redeliver.
+                if self.error is None:
+                    result, offsets = item
+                    batch = [ msg for chunk in result.get() for msg in chunk ]
+                    self.writer( batch )
+                    self.nwritten += len( batch )
+                    with self._lock:
+                        for key, offset in offsets.items():
+                            self._committable[ key ] = max( self._committable.get( key, 0 ), offset )
+            except Exception as ex:
+                self.logger.exception( f"DecodePipeline writer failed: {ex}" )
+                self.error = ex
+            finally:
+                self.queue.task_done()
+
+    def take_committable( self ):
+        """Return (and forget) a list of confluent_kafka.TopicPartition for everything written so far."""
+        with self._lock:
+            committable = self._committable
+            self._committable = {}
+        return [ confluent_kafka.TopicPartition( topic, partition, offset )
+                 for ( topic, partition ), offset in committable.items() ]
+
+    def drain( self ):
+        """Block until everything submitted has been written (or thrown away after an error)."""
+        self.queue.join()
+
+    def clear_error( self ):
+        """Forget a writer failure so that submit() works again; call drain() first."""
+        self.error = None
+
+    def close( self ):
+        self.queue.put( None )
+        self.thread.join()
+        self.pool.close()
+        self.pool.join()
+
+
+# ======================================================================
+
 class BrokerConsumer:
     """A class for consuming broker messages from brokers.
 
@@ -44,7 +189,9 @@ class BrokerConsumer:
                   schemaless=True, reset=False, extraconfig={},
                   schemafile=None, pipe=None, loggername="BROKER", loggername_prefix='',
                   postgres_brokermessage_model=None, mongodb_dbname=None, mongodb_collection=None,
-                  **kwargs ):
+                  mongodb_write_concern=None, decode_workers=0, decode_queue_depth=None,
+                  consume_nmsgs=1000, consume_timeout=1, max_consume_nmsgs=None, max_batch_bytes=None,
+                  manual_commit=False, **kwargs ):
 
         self.logger = logging.getLogger( loggername )
         self.logger.propagate = False
@@ -78,6 +225,12 @@ class BrokerConsumer:
         self._updatetopics = updatetopics
         self._reset = reset
         self.extraconfig = extraconfig
+        # See MsgConsumer for what these mean
+        self.consume_nmsgs = consume_nmsgs
+        self.consume_timeout = consume_timeout
+        self.max_consume_nmsgs = max_consume_nmsgs
+        self.max_batch_bytes = max_batch_bytes
+        self.manual_commit = manual_commit
 
         self.schemaless = schemaless
         if not self.schemaless:
@@ -86,6 +239,21 @@ class BrokerConsumer:
         self.schemafile = schemafile
         self.schema = fastavro.schema.load_schema( self.schemafile )
 
+        # If decode_workers > 0, decode messages in a pool of processes and
+        #   save them in a separate thread (see DecodePipeline).  In that mode
+        #   kafka offsets are committed by hand once messages are saved, so
+        #   turn off auto commit.  This has to happen before any database
+        #   connections are opened, as the pool processes are forked.
+        self.pipeline = None
+        if decode_workers > 0:
+            self.pipeline = DecodePipeline( self.schemafile, decode_workers, self.store_message_batch,
+                                            queuedepth=decode_queue_depth, logger=self.logger )
+            self.extraconfig = dict( self.extraconfig )
+            self.extraconfig[ 'enable.auto.commit' ] = False
+            # The pipeline commits offsets itself once batches are written
+            self.manual_commit = False
+            self.countlogger.info( f"Decoding messages with {decode_workers} worker processes" )
+
         self.nmessagesconsumed = 0
 
         # Figure out where we're saving stuff.  postgres_brokermessage_model right
@@ -98,6 +266,7 @@ class BrokerConsumer:
         #   one or the other.
 
         self.postgres_brokermessage_model = postgres_brokermessage_model
+        self.classifiermodel = None
         self.mongodb_dbname = mongodb_dbname
         self.mongodb_collection = mongodb_collection
         if ( self.mongodb_dbname is None ) != ( self.mongodb_collection is None ):
@@ -111,6 +280,12 @@ class BrokerConsumer:
         if self.postgres_brokermessage_model is not None:
             self.logger.info( f"Writing broker messages to postgres model "
                               f"{self.postgres_brokermessage_model.__name__}" )
+            # Load all known classifiers up front so that message batches
+            #   don't have to look them up in the database
+            self.classifiermodel = getattr( self.postgres_brokermessage_model, '_classifiermodel', None )
+            if self.classifiermodel is not None:
+                ncfers = self.classifiermodel.warm_registry()
+                self.countlogger.info( f"Warmed classifier registry with {ncfers} classifiers" )
         if self.mongodb_dbname is not None:
             # mongodb running on port 27017 on host $MONGOHOST; default
             #   $MONGOHOST to fastdbdev-mongodb for backwards compatibility
@@ -120,13 +295,22 @@ class BrokerConsumer:
             self.mongopassword = urllib.parse.quote_plus(os.environ['MONGODB_ALERT_WRITER_PASSWORD'])
             self.logger.info( f"Writing broker messages to monogdb {self.mongodb_dbname} "
                               f"collection {self.mongodb_collection}" )
-            # Thought required: it would be less overhead to connect to the mongo hosdt
-            #   once here and just reuse that connection.  However, if the mongodb restarts
-            #   or the connection becomes invalid for any reason, we might regret holding
-            #   the connection open for hours.  On the assumption that the mongo connection
-            #   overhead is going to be small compared to the time it takes to receive
-            #   a batch of messages, just connect to the mongodb every time we handle
-            #   a message batch.  TODO: test this to see if that assumption is correct.
+            # The MongoClient is created the first time it's needed (so that it's
+            #   created in whatever process and thread actually does the writing)
+            #   and then reused.  MongoClient keeps its own connection pool and
+            #   reconnects by itself after the server goes away, but if a write
+            #   fails anyway, mongodb_store throws the client away and tries once
+            #   more with a new one.  mongodb_write_concern is a dict of kwargs
+            #   for pymongo.write_concern.WriteConcern (e.g. { 'w': 'majority' });
+            #   None means use the server default.
+            self.mongo_writeconcern = ( None if mongodb_write_concern is None
+                                        else WriteConcern( **mongodb_write_concern ) )
+            self.mongo_healthcheck_interval = datetime.timedelta( minutes=1 )
+            self._mongoclient = None
+            self._mongolastok = None
+            self.mongo_connecttime = 0
+            self.mongo_inserttime = 0
+            self.mongo_nbatches = 0
 
 
     @property
@@ -143,7 +327,12 @@ class BrokerConsumer:
             try:
                 self.consumer = MsgConsumer( self.server, self.groupid, self.schemafile, self.topics,
                                              extraconsumerconfig=self.extraconfig,
-                                             consume_nmsgs=1000, consume_timeout=1, nomsg_sleeptime=5,
+                                             consume_nmsgs=self.consume_nmsgs,
+                                             consume_timeout=self.consume_timeout,
+                                             nomsg_sleeptime=5,
+                                             manual_commit=self.manual_commit,
+                                             max_consume_nmsgs=self.max_consume_nmsgs,
+                                             max_batch_bytes=self.max_batch_bytes,
                                              logger=self.logger )
                 countdown = -1
             except Exception as e:
@@ -170,6 +359,8 @@ class BrokerConsumer:
 
     def close_connection( self ):
         self.countlogger.info( f"**************** Closing consumer connection ******************" )
+        if self.pipeline is not None:
+            self.finish_pipeline()
         self.consumer.close()
         self.consumer = None
 
@@ -204,28 +395,117 @@ class BrokerConsumer:
                                    'msgoffset': msg.offset(),
                                    'timestamp': timestamp,
                                    'msg': alert } )
+        self.store_message_batch( messagebatch )
+
+    def handle_message_batch_pipelined( self, msgs ):
+        self.countlogger.info( f"Queueing {len(msgs)} messages; consumer has received "
+                               f"{self.consumer.tot_handled} messages." )
+        self.pipeline.submit( msgs )
+        self.consumer.commit_offsets( self.pipeline.take_committable() )
+
+    def finish_pipeline( self ):
+        """Wait for the pipeline to write everything submitted, and commit the offsets of what got written."""
+        self.pipeline.drain()
+        self.consumer.commit_offsets( self.pipeline.take_committable() )
+        if self.pipeline.error is not None:
+            self.countlogger.error( f"Message writer failed ({self.pipeline.error}); uncommitted messages "
+                                    f"will be redelivered after reconnecting." )
+            self.pipeline.clear_error()
+        self.countlogger.info( f"Pipeline has written {self.pipeline.nwritten} messages." )
+
+    def store_message_batch( self, messagebatch ):
         if self.postgres_brokermessage_model is not None:
             added = self.postgres_brokermessage_model.load_batch( messagebatch, logger=self.logger )
             self.countlogger.info( f"...added {added['addedmsgs']} messages, "
                                    f"{added['addedclassifiers']} classifiers, "
                                    f"{added['addedclassifications']} classifications. " )
+            if self.classifiermodel is not None:
+                stats = self.classifiermodel.registry_stats()
+                self.countlogger.info( f"...classifier registry: {stats['classifiers']} classifiers, "
+                                       f"{stats['hits']} hits, {stats['misses']} misses" )
         if self.mongodb_dbname is not None:
             nadded = self.mongodb_store( messagebatch )
             self.countlogger.info( f"...added {nadded} messages to mongodb {self.mongodb_dbname} "
                                    f"collection {self.mongodb_collection}" )
 
 
+    def mongodb_client( self ):
+        """Return the consumer's MongoClient, creating it (or replacing it) if necessary.
+
+        If the client hasn't had a successful operation in
+        mongo_healthcheck_interval, ping the server before returning it,
+        and make a new client if that fails.
+
+        """
+        if ( ( self._mongoclient is not None ) and
+             ( ( self._mongolastok is None ) or
+               ( datetime.datetime.now() - self._mongolastok > self.mongo_healthcheck_interval ) ) ):
+            try:
+                self._mongoclient.admin.command( 'ping' )
+                self._mongolastok = datetime.datetime.now()
+            except pymongo.errors.PyMongoError as ex:
+                self.logger.warning( f"mongodb ping failed ({ex}), reconnecting" )
+                self.mongodb_close()
+
+        if self._mongoclient is None:
+            connstr = ( f"mongodb://{self.mongousername}:{self.mongopassword}@{self.mongohost}:27017/"
+                        f"?authSource={self.mongodb_dbname}" )
+            self.logger.debug( f"Connecting to mongodb on {self.mongohost}" )
+            self._mongoclient = MongoClient( connstr )
+            self._mongolastok = None
+
+        return self._mongoclient
+
+    def mongodb_close( self ):
+        if self._mongoclient is not None:
+            try:
+                self._mongoclient.close()
+            except Exception as ex:
+                self.logger.warning( f"Exception closing mongodb client: {ex}" )
+            self._mongoclient = None
+            self._mongolastok = None
+
     def mongodb_store(self, messagebatch=None):
         if messagebatch is None:
             return 0
-        connstr = ( f"mongodb://{self.mongousername}:{self.mongopassword}@{self.mongohost}:27017/"
-                    f"?authSource={self.mongodb_dbname}" )
-        self.logger.debug( f"mongodb connection string {connstr}" )
-        client = MongoClient( connstr )
-        db = getattr( client, self.mongodb_dbname )
-        collection = db[ self.mongodb_collection ]
-        results = collection.insert_many(messagebatch)
-        return len(results.inserted_ids)
+        tries = 2
+        nadded = 0
+        while tries > 0:
+            tries -= 1
+            t0 = time.perf_counter()
+            client = self.mongodb_client()
+            db = getattr( client, self.mongodb_dbname )
+            collection = db.get_collection( self.mongodb_collection, write_concern=self.mongo_writeconcern )
+            t1 = time.perf_counter()
+            try:
+                results = collection.insert_many( messagebatch, ordered=False )
+                nadded += len( results.inserted_ids )
+                tries = 0
+            except pymongo.errors.BulkWriteError as ex:
+                # insert_many puts an _id into each of the dicts in messagebatch, so on a
+                # retry, anything that got in the first time shows up as a duplicate key.
+                if any( err['code'] != 11000 for err in ex.details['writeErrors'] ):
+                    raise
+                nadded += ex.details['nInserted']
+                tries = 0
+            except pymongo.errors.PyMongoError as ex:
+                self.mongodb_close()
+                if tries == 0:
+                    raise
+                self.logger.warning( f"mongodb insert failed ({ex}), reconnecting and retrying" )
+                continue
+            finally:
+                t2 = time.perf_counter()
+                self.mongo_connecttime += t1 - t0
+                self.mongo_inserttime += t2 - t1
+            self._mongolastok = datetime.datetime.now()
+
+        self.mongo_nbatches += 1
+        self.countlogger.info( f"...mongodb batch: get client {1000*(t1-t0):.1f} ms, "
+                               f"insert {1000*(t2-t1):.1f} ms; averages over {self.mongo_nbatches} batches: "
+                               f"get client {1000*self.mongo_connecttime/self.mongo_nbatches:.1f} ms, "
+                               f"insert {1000*self.mongo_inserttime/self.mongo_nbatches:.1f} ms" )
+        return nadded
 
 
     def poll( self, restart_time=datetime.timedelta(minutes=30) ):
@@ -240,8 +520,10 @@ class BrokerConsumer:
             else:
                 self.logger.info( f"Subscribed to topics: {self.consumer.topics}; starting poll loop." )
                 self.countlogger.info( f"Subscribed to topics: {self.consumer.topics}; starting poll loop." )
+                handler = ( self.handle_message_batch if self.pipeline is None
+                            else self.handle_message_batch_pipelined )
                 try:
-                    happy = self.consumer.poll_loop( handler=self.handle_message_batch,
+                    happy = self.consumer.poll_loop( handler=handler,
                                                      max_consumed=None, max_runtime=restart_time,
                                                      pipe=self.pipe )
                     if happy:
@@ -253,6 +535,8 @@ class BrokerConsumer:
                         self.logger.info( strio.getvalue() )
                         self.countlogger.info( strio.getvalue() )
                         self.close_connection()
+                        if self.pipeline is not None:
+                            self.pipeline.close()
                         return
                 except Exception as e:
                     otherstrio = io.StringIO("")
@@ -266,6 +550,8 @@ class BrokerConsumer:
                     self.logger.info( "No topics, but also exiting broker poll due to die command." )
                     self.countlogger.info( "No topics, but also existing broker poll due to die command." )
                     self.close_connection()
+                    if self.pipeline is not None:
+                        self.pipeline.close()
                     return
             strio.write( "Reconnecting.\n" )
             self.logger.info( strio.getvalue() )
@@ -28,7 +28,8 @@ def close_msg_consumer( obj ):
 class MsgConsumer(object):
     def __init__( self, server, groupid, schema, topics=None,
                   extraconsumerconfig=None, consume_nmsgs=10, consume_timeout=5, nomsg_sleeptime=1,
-                  logger=_logger ):
+                  manual_commit=False, max_consume_nmsgs=None, max_batch_bytes=None,
+                  lag_check_interval=datetime.timedelta(seconds=30), logger=_logger ):
         """Wraps a confluent_kafka.Consumer.
 
         server : the bootstrap.servers value
@@ -39,6 +40,20 @@ class MsgConsumer(object):
         consume_nmsgs : number of messages to pull from the server at once (default 10)
         consume_timeout : timeout after waiting on the server for this many seconds
         nomsg_sleeptime : sleep for this many seconds after a consume_timeout before trying again
+        manual_commit : if True, turn off kafka auto commit, and have
+            poll_loop commit the offsets of each batch only after the
+            handler has returned successfully.  (If the handler raises,
+            those messages will be delivered again to whatever next
+            consumes with this group id.)
+        max_consume_nmsgs : if not None, poll_loop will increase the
+            number of messages consumed at once (up to this many) when
+            the consumer is falling behind, and drop back to
+            consume_nmsgs when it has caught up
+        max_batch_bytes : if not None, poll_loop won't grow batches
+            past (about) this many bytes of message payload
+        lag_check_interval : how often poll_loop checks how far behind
+            the consumer is (a datetime.timedelta).  The lag is sent
+            through the heartbeat pipe.
         logger : a logging object
 
         """
@@ -49,14 +64,23 @@ class MsgConsumer(object):
 
         self.schema = None if schema is None else fastavro.schema.load_schema( schema )
         self.consume_nmsgs = consume_nmsgs
+        self.base_consume_nmsgs = consume_nmsgs
+        self.max_consume_nmsgs = max_consume_nmsgs
+        self.max_batch_bytes = max_batch_bytes
         self.consume_timeout = consume_timeout
         self.nomsg_sleeptime = nomsg_sleeptime
+        self.manual_commit = manual_commit
+        self.lag_check_interval = lag_check_interval
+        self.lag = {}
+        self.totlag = None
 
         consumerconfig = { "bootstrap.servers": server,
                            "auto.offset.reset": "earliest",
                            "group.id": groupid }
         if extraconsumerconfig is not None:
             consumerconfig.update( extraconsumerconfig )
+        if self.manual_commit:
+            consumerconfig[ "enable.auto.commit" ] = False
         self.logger.debug( f'Initializing Kafka consumer with\n{json.dumps(consumerconfig, indent=4)}' )
         self.consumer = confluent_kafka.Consumer( consumerconfig )
         self.logger.debug( f"Consumer initialized" )
@@ -124,6 +148,17 @@ class MsgConsumer(object):
         self.consumer.commit( offsets=partlist )
         self.tot_handled = 0
 
+    def commit_offsets( self, offsets ):
+        """Synchronously commit offsets, a list of confluent_kafka.TopicPartition.
+
+        Remember that the offset to commit is the offset of the *next*
+        message to consume, i.e. one more than the last message handled.
+
+        """
+        if len( offsets ) > 0:
+            self.logger.debug( f"Committing offsets for {len(offsets)} partitions" )
+            self.consumer.commit( offsets=offsets, asynchronous=False )
+
     def get_topics( self ):
         cluster_meta = self.consumer.list_topics()
         return [ n for n in cluster_meta.topics ]
@@ -149,6 +184,54 @@ class MsgConsumer(object):
             tot += high_offset - low_offset
         return tot, partdata
 
+    @staticmethod
+    def batch_offsets( msgs ):
+        """Return a list of confluent_kafka.TopicPartition with the offsets to commit after handling msgs."""
+        offsets = {}
+        for msg in msgs:
+            key = ( msg.topic(), msg.partition() )
+            offsets[ key ] = max( offsets.get( key, 0 ), msg.offset() + 1 )
+        return [ confluent_kafka.TopicPartition( topic, partition, offset )
+                 for ( topic, partition ), offset in offsets.items() ]
+
+    def get_lag( self ):
+        """Return { topic: { partition: lag } } for the partitions assigned to this consumer.
+
+        lag is the number of messages on the server past the consumer's
+        current position.  Also sets self.lag and self.totlag.
+
+        """
+        positions = self._get_positions( self.consumer.assignment() )
+        lag = {}
+        sizes = {}
+        for pos in positions:
+            if pos.topic not in sizes:
+                sizes[ pos.topic ] = self.get_topic_size_offsets( pos.topic )[1]
+            marks = sizes[ pos.topic ][ pos.partition ]
+            # A negative offset means no position yet, i.e. nothing consumed
+            start = pos.offset if pos.offset >= 0 else marks['low']
+            lag.setdefault( pos.topic, {} )[ pos.partition ] = max( marks['high'] - start, 0 )
+        self.lag = lag
+        self.totlag = sum( n for parts in lag.values() for n in parts.values() )
+        return lag
+
+    def adapt_batch_size( self, msgs ):
+        """Adjust consume_nmsgs based on the current lag and the size of msgs (the last batch)."""
+        if self.max_consume_nmsgs is None:
+            return
+        newnmsgs = self.consume_nmsgs
+        if ( self.totlag is not None ) and ( self.totlag > 2 * self.consume_nmsgs ):
+            newnmsgs = min( 2 * self.consume_nmsgs, self.max_consume_nmsgs )
+        elif ( self.totlag is not None ) and ( self.totlag < self.consume_nmsgs ):
+            newnmsgs = max( self.consume_nmsgs // 2, self.base_consume_nmsgs )
+        if ( self.max_batch_bytes is not None ) and ( len(msgs) > 0 ):
+            avgbytes = sum( len( msg.value() ) for msg in msgs ) / len(msgs)
+            newnmsgs = min( newnmsgs, max( int( self.max_batch_bytes / avgbytes ), self.base_consume_nmsgs ) )
+        if newnmsgs != self.consume_nmsgs:
+            self.logger.info( f"Changing batch size from {self.consume_nmsgs} to {newnmsgs} "
+                              f"(lag {self.totlag})" )
+            self.consume_nmsgs = newnmsgs
+
     def _get_positions( self, partitions ):
         return self.consumer.position( partitions )
 
@@ -185,13 +268,31 @@ class MsgConsumer(object):
         max_runtime : Quit polling after this much time has elapsed;
                       must be a datetime.timedelta object.  (Default: 1h.)
 
+        If the consumer was created with manual_commit=True, the offsets
+        of each batch are committed after handler returns.
+
+        The heartbeats sent to pipe are dicts with "message": "ok",
+        "nconsumed", "runtime", and "batchsize"; every
+        lag_check_interval, they also include "lag" (see get_lag) and
+        "totlag".
+
         returns True if consumed ≥max_consumed or timed out, False if died due to die command
         """
         nconsumed = 0
         starttime = datetime.datetime.now()
+        nextlagcheck = starttime
         keepgoing = True
         retval = True
         while keepgoing:
+            heartbeat = {}
+            if ( self.lag_check_interval is not None ) and ( datetime.datetime.now() >= nextlagcheck ):
+                nextlagcheck = datetime.datetime.now() + self.lag_check_interval
+                try:
+                    heartbeat[ 'lag' ] = self.get_lag()
+                    heartbeat[ 'totlag' ] = self.totlag
+                except Exception as ex:
+                    self.logger.warning( f"Failed to get consumer lag: {ex}" )
+
             self.logger.debug( f"Trying to consume {self.consume_nmsgs} messages "
                                f"with timeout {self.consume_timeout}..." )
             msgs = self.consumer.consume( self.consume_nmsgs, timeout=self.consume_timeout )
@@ -205,6 +306,9 @@ class MsgConsumer(object):
                     handler( msgs )
                 else:
                     self.default_handle_message_batch( msgs )
+                if self.manual_commit:
+                    self.commit_offsets( self.batch_offsets( msgs ) )
+                self.adapt_batch_size( msgs )
             nconsumed += len( msgs )
             runtime = datetime.datetime.now() - starttime
             if ( ( ( max_consumed is not None ) and ( nconsumed >= max_consumed ) )
@@ -212,7 +316,9 @@ class MsgConsumer(object):
                  ( ( max_runtime is not None ) and ( runtime > max_runtime ) ) ):
                 keepgoing = False
             if pipe is not None:
-                pipe.send( { "message": "ok", "nconsumed": nconsumed, "runtime": runtime } )
+                heartbeat.update( { "message": "ok", "nconsumed": nconsumed, "runtime": runtime,
+                                    "batchsize": self.consume_nmsgs } )
+                pipe.send( heartbeat )
                 if pipe.poll():
                     msg = pipe.recv()
                     if ( 'command' in msg ) and ( msg['command'] == 'die' ):
@@ -1,11 +1,21 @@
 import sys
+import pickle
 import logging
 import datetime
+import select
+import multiprocessing
+import multiprocessing.connection
 import pathlib
+import tempfile
 import time
+import zipfile
 
+import numpy
 import pandas
+import pyarrow
+import pyarrow.parquet
 import psycopg2
+import psycopg2.errors
 import psycopg2.extras
 
 import django.db
@@ -13,15 +23,176 @@ import django.conf
 from django.db import transaction
 from django.core.management.base import BaseCommand, CommandError
 from db.models import QueryQueue
+from db.arrowtables import ArrowTableBuilder, unique_names
+
+
+class QueryLimitExceeded( RuntimeError ):
+    pass
+
+
+# ======================================================================
+# Writers for query results.  Each gets the rows a chunk at a time (as
+# they come off of a server-side cursor), so that the runner never has to
+# hold the whole result set in memory unless the format demands it.
+# After each call to write, chunkbytes is (roughly) how much memory that
+# chunk took up, which the runner uses to size the next fetch.
+
+class QueryResultWriter:
+    def __init__( self, path, columns, typeoids, maxmemory ):
+        self.path = path
+        self.columns = columns
+        self.typeoids = typeoids
+        self.maxmemory = maxmemory
+        self.nrows = 0
+        self.chunkbytes = 0
+
+    def dataframe( self, rows ):
+        df = pandas.DataFrame( rows, columns=self.columns )
+        df.index = pandas.RangeIndex( self.nrows, self.nrows + len(rows) )
+        self.chunkbytes = int( df.memory_usage( deep=True ).sum() )
+        return df
+
+    def write( self, rows ):
+        raise NotImplementedError( f"{self.__class__.__name__} doesn't implement write" )
+
+    def close( self ):
+        pass
+
+
+class CSVResultWriter( QueryResultWriter ):
+    def __init__( self, *args, **kwargs ):
+        super().__init__( *args, **kwargs )
+        self.ofp = open( self.path, "w", newline="" )
+        self.wroteheader = False
+
+    def write( self, rows ):
+        df = self.dataframe( rows )
+        df.to_csv( self.ofp, header=( not self.wroteheader ) )
+        self.wroteheader = True
+        self.nrows += len( rows )
+
+    def close( self ):
+        if not self.wroteheader:
+            pandas.DataFrame( [], columns=self.columns ).to_csv( self.ofp )
+        self.ofp.close()
+
+
+class PandasResultWriter( QueryResultWriter ):
+    """A pickled DataFrame.  This one has to hold everything in memory, as there's no appending to a pickle."""
+
+    def __init__( self, *args, **kwargs ):
+        super().__init__( *args, **kwargs )
+        self.dfs = []
+        self.totbytes = 0
+
+    def write( self, rows ):
+        self.dfs.append( self.dataframe( rows ) )
+        self.totbytes += self.chunkbytes
+        self.nrows += len( rows )
+        if self.totbytes > self.maxmemory:
+            raise QueryLimitExceeded( f"Results of query are more than {self.maxmemory/1024/1024:.0f} MiB "
+                                      f"in memory, too big for format pandas; try parquet or csv." )
+
+    def close( self ):
+        if len( self.dfs ) == 0:
+            df = pandas.DataFrame( [], columns=self.columns )
+        else:
+            df = pandas.concat( self.dfs )
+        self.dfs = []
+        df.to_pickle( self.path )
+
+
+class NumpyResultWriter( QueryResultWriter ):
+    """An .npz file with one array per column.
+
+    Each chunk of each column gets pickled out to its own spool file as it
+    comes in; on close, the columns are assembled and written into the
+    .npz one at a time, so only one column ever has to be in memory.
+    (Twice, really: its chunks and the concatenated column.  So a column
+    can be no more than half of maxmemory.)
+    Columns that come out with dtype object (text, arrays, etc.) need
+    allow_pickle=True when loaded with numpy.load.
+
+    """
+
+    def __init__( self, *args, **kwargs ):
+        super().__init__( *args, **kwargs )
+        self.spooldir = tempfile.TemporaryDirectory( dir=self.path.parent )
+        self.names = unique_names( self.columns )
+        self.spools = [ open( pathlib.Path( self.spooldir.name ) / str(i), "wb" )
+                        for i in range( len(self.columns) ) ]
+
+    def write( self, rows ):
+        df = self.dataframe( rows )
+        for i, spool in enumerate( self.spools ):
+            pickle.dump( df.iloc[ :, i ].to_numpy(), spool )
+        self.nrows += len( rows )
+
+    def close( self ):
+        try:
+            with zipfile.ZipFile( self.path, "w", allowZip64=True ) as zf:
+                for name, spool in zip( self.names, self.spools ):
+                    spool.close()
+                    chunks = []
+                    nbytes = 0
+                    with open( spool.name, "rb" ) as ifp:
+                        while True:
+                            try:
+                                chunk = pickle.load( ifp )
+                            except EOFError:
+                                break
+                            # Check as the chunks come in, so that neither the
+                            # chunks nor the concatenated column go past the limit
+                            nbytes += chunk.nbytes
+                            if nbytes > self.maxmemory / 2:
+                                raise QueryLimitExceeded( f"Column {name} is more than "
+                                                          f"{self.maxmemory/2/1024/1024:.0f} MiB, too big "
+                                                          f"for format numpy; try parquet or csv." )
+                            chunks.append( chunk )
+                    arr = numpy.concatenate( chunks ) if len(chunks) > 0 else numpy.array( [], dtype=object )
+                    chunks = []
+                    with zf.open( f"{name}.npy", "w", force_zip64=True ) as ofp:
+                        numpy.lib.format.write_array( ofp, arr, allow_pickle=True )
+        finally:
+            self.spooldir.cleanup()
+
+
+class ParquetResultWriter( QueryResultWriter ):
+    """A parquet file, one row group per chunk.  See db.arrowtables.ArrowTableBuilder for the schema."""
+
+    def __init__( self, *args, **kwargs ):
+        super().__init__( *args, **kwargs )
+        self.builder = ArrowTableBuilder( self.columns, self.typeoids )
+        self.pqwriter = pyarrow.parquet.ParquetWriter( self.path, self.builder.schema )
+
+    def write( self, rows ):
+        table = self.builder.table( rows )
+        self.chunkbytes = table.nbytes
+        self.pqwriter.write_table( table )
+        self.nrows += len( rows )
+
+    def close( self ):
+        self.pqwriter.close()
+
+
+# ======================================================================
 
 class Command(BaseCommand):
     help = 'Run long database queries'
 
+    writers = { 'csv': CSVResultWriter,
+                'pandas': PandasResultWriter,
+                'numpy': NumpyResultWriter,
+                'parquet': ParquetResultWriter }
+
     def __init__( self, *args, **kwargs ):
         super().__init__( *args, **kwargs )
 
         self.outdir = pathlib.Path( "/query_results" )
         self.sleeptime = 60
+        self.chunksize = 100000
+        self.maxruntime = 4 * 3600
+        self.maxmemory = 4 * 1024 * 1024 * 1024
 
         self.logger = logging.getLogger( "long_query_runner" )
         _logout = logging.StreamHandler( sys.stderr )
@@ -39,13 +210,20 @@ class Command(BaseCommand):
         qs = QueryQueue.objects.filter( finished__lt=since )
         for q in qs:
             self.logger.info( f"Pruning query {q.queryid}" )
-            outf = self.outdir / str(q.queryid)
-            if outf.is_file():
-                outf.unlink()
+            for outf in [ self.outdir / str(q.queryid), self.outdir / f"{q.queryid}.partial" ]:
+                if outf.is_file():
+                    outf.unlink()
             q.delete()
 
 
-    def get_queued_query( self ):
+    def get_queued_query( self, claim=None ):
+        """Claim the next query to run, and return its row of the queue as a dict (or None).
+
+        claim : if not None, a multiprocessing.Array of chars that gets
+          the id of the claimed query as soon as the claim is committed,
+          so that run_workers can clean up after a worker that dies.
+
+        """
         origautocommit = None
         conn = None
         try:
@@ -56,9 +234,19 @@ class Command(BaseCommand):
             origautocommit = conn.autocommit
             conn.autocommit = False
 
+            # Claim the next query: highest priority first, then the
+            # submitter with the fewest queries running, then the oldest.
+            # SKIP LOCKED means that several workers can be doing this at
+            # once, and each will get a different query.
             cursor = conn.cursor( cursor_factory=psycopg2.extras.RealDictCursor )
-            cursor.execute( "LOCK TABLE db_queryqueue" )
-            cursor.execute( "SELECT * FROM db_queryqueue WHERE started IS NULL ORDER BY submitted" )
+            cursor.execute( "SELECT q.queryid FROM db_queryqueue q "
+                            "LEFT JOIN ( SELECT submitter, COUNT(*) AS nrunning FROM db_queryqueue "
+                            "            WHERE started IS NOT NULL AND finished IS NULL "
+                            "            GROUP BY submitter ) r "
+                            "  ON q.submitter IS NOT DISTINCT FROM r.submitter "
+                            "WHERE q.started IS NULL "
+                            "ORDER BY q.priority DESC, COALESCE(r.nrunning,0), q.submitted "
+                            "LIMIT 1 FOR UPDATE OF q SKIP LOCKED" )
             rows = cursor.fetchall()
             if len(rows) == 0:
                 return None
@@ -68,6 +256,8 @@ class Command(BaseCommand):
                             { 't': datetime.datetime.now( tz=datetime.timezone.utc ),
                               'id': rows[0]['queryid'] } )
             conn.commit()
+            if claim is not None:
+                claim.value = str( rows[0]['queryid'] ).encode( 'ascii' )
 
             cursor.execute( "SELECT * FROM db_queryqueue WHERE queryid=%(id)s", { 'id': rows[0]['queryid'] } )
             rows = cursor.fetchall()
@@ -80,9 +270,118 @@ class Command(BaseCommand):
                     conn.autocommit = origautocommit
 
 
+    def listen_connection( self ):
+        """A connection (with autocommit on) listening for notifications of newly submitted queries."""
+        dbsettings = django.conf.settings.DATABASES['default']
+        conn = psycopg2.connect( host=dbsettings['HOST'], port=dbsettings['PORT'], dbname=dbsettings['NAME'],
+                                 user=dbsettings['USER'], password=dbsettings['PASSWORD'] )
+        conn.autocommit = True
+        cursor = conn.cursor()
+        cursor.execute( "LISTEN db_queryqueue" )
+        cursor.close()
+        return conn
+
+
+    def wait_for_notify( self, listenconn ):
+        """Wait up to sleeptime seconds for a new query to be submitted."""
+        if len( listenconn.notifies ) == 0:
+            select.select( [ listenconn ], [], [], self.sleeptime )
+            listenconn.poll()
+        listenconn.notifies.clear()
+
+
+    def worker_loop( self, claim=None ):
+        """Run queries forever, waiting on postgres notifications when there's nothing to do.
+
+        claim : see get_queued_query; cleared after each query is done.
+
+        """
+        listenconn = self.listen_connection()
+        try:
+            while True:
+                # Pick up any notifications that arrived while the last
+                # query was running; the queue check that follows will see
+                # whatever they were about.
+                listenconn.poll()
+                listenconn.notifies.clear()
+                queryinfo = self.get_queued_query( claim )
+                if queryinfo is None:
+                    self.wait_for_notify( listenconn )
+                    continue
+
+                self.run_query( queryinfo )
+                if claim is not None:
+                    claim.value = b''
+        finally:
+            listenconn.close()
+
+
+    def fail_abandoned_query( self, queryid, errortext ):
+        """Mark a query that a dead worker had claimed as finished with an error.
+
+        It's not put back in the queue, because whatever killed the
+        worker (e.g. running out of memory) would probably just kill the
+        next one too.
+
+        """
+        partialpath = self.outdir / f"{queryid}.partial"
+        if partialpath.is_file():
+            partialpath.unlink()
+        nfailed = ( QueryQueue.objects.filter( queryid=queryid, finished__isnull=True )
+                    .update( finished=datetime.datetime.now( tz=datetime.timezone.utc ),
+                             error=True, errortext=errortext ) )
+        if nfailed > 0:
+            self.logger.error( f"Marked query request {queryid} as failed: {errortext}" )
+
+
+    def run_workers( self, nworkers ):
+        """Launch nworkers subprocesses running worker_loop, relaunching any that die."""
+        procs = {}
+        claims = {}
+
+        def launch():
+            # Make sure each subprocess opens its own database connection
+            django.db.connections.close_all()
+            claim = multiprocessing.Array( 'c', 36 )
+            proc = multiprocessing.Process( target=lambda: self.worker_loop( claim ), daemon=True )
+            proc.start()
+            procs[ proc.pid ] = proc
+            claims[ proc.pid ] = claim
+            self.logger.info( f"Launched query worker process {proc.pid}" )
+
+        for i in range( nworkers ):
+            launch()
+        while True:
+            multiprocessing.connection.wait( [ p.sentinel for p in procs.values() ] )
+            for pid, proc in list( procs.items() ):
+                if not proc.is_alive():
+                    self.logger.error( f"Query worker process {pid} exited with status {proc.exitcode}; "
+                                       f"relaunching" )
+                    queryid = claims[ pid ].value.decode( 'ascii' )
+                    if len( queryid ) > 0:
+                        self.fail_abandoned_query( queryid, f"Query worker process died (exit status "
+                                                            f"{proc.exitcode}) while running the query" )
+                    del procs[ pid ]
+                    del claims[ pid ]
+                    launch()
+            # Don't spin if things are dying right away
+            time.sleep( 1 )
+
+
+    def set_timeout( self, cursor, t0 ):
+        """Limit the next statement to whatever is left of the query's runtime allowance."""
+        remaining = self.maxruntime - ( time.perf_counter() - t0 )
+        if remaining <= 0:
+            raise QueryLimitExceeded( f"Query ran longer than {self.maxruntime} s" )
+        cursor.execute( "SET statement_timeout=%(ms)s", { 'ms': int( remaining * 1000 ) + 1 } )
+
+
     def run_query( self, queryinfo ):
         conn = None
         qentry = None
+        writer = None
+        outpath = self.outdir / str(queryinfo['queryid'])
+        partialpath = self.outdir / f"{queryinfo['queryid']}.partial"
         try:
             qentry = QueryQueue.objects.filter( queryid=queryinfo['queryid'] )
             if len(qentry) == 0:
@@ -90,7 +389,11 @@ class Command(BaseCommand):
             if len(qentry) > 1:
                 raise RuntimeError( f"Error, {len(qentry)} queue entries with id {queryinfo['queryid']}" )
             qentry = qentry[0]
-            
+            if queryinfo['format'] not in self.writers:
+                raise ValueError( f"Unknown format {queryinfo['format']}" )
+            if len( queryinfo['queries'] ) == 0:
+                raise ValueError( f"No queries in query request {queryinfo['queryid']}" )
+
             # Make a separate connection to the database to run
             # these queries.  We need a psycopg2 connection anyway,
             # which django yields only grudgingly, but more
@@ -111,76 +414,114 @@ class Command(BaseCommand):
             cursor = conn.cursor()
 
             self.logger.info( f"Starting query request {queryinfo['queryid']}" )
-
-            for query, subdict in zip( queryinfo['queries'], queryinfo['subdicts'] ):
-                try:
-                    self.logger.info( f"For query request {queryinfo['queryid']}, running query: "
-                                      f"{cursor.mogrify(query,subdict)}" )
-                    cursor.execute( query, subdict )
-                except Exception as e:
-                    self.logger.exception( "Exception running query: {str(e)}" )
-                    conn.rollback()
-                    conn = None
-                    qentry.finished = datetime.datetime.now( tz=datetime.timezone.utc )
-                    qentry.error = True
-                    qentry.errortext = str(e)
-                    qentry.save()
-                    return False
-
-            self.logger.info( "Done running queries, fetching" )
-            columns = [ d.name for d in cursor.description ]
-            rows = cursor.fetchall()
-
-            self.logger.info( "Done fetching, saving" )
-            if ( queryinfo['format'] == 'csv' ) or ( queryinfo['format'] == 'pandas' ):
-                df = pandas.DataFrame( rows, columns=columns )
-                if queryinfo['format'] == 'pandas':
-                    df.to_pickle( self.outdir / str(queryinfo['queryid']) )
-                else:
-                    df.to_csv( self.outdir / str(queryinfo['queryid']) )
-
-            elif ( queryinfo['format'] == 'numpy' ):
-                raise NotImplementedError( "numpy return format isn't implemented yet" )
-
-            self.logger.info( "Done saving, marking finished" )
+            t0 = time.perf_counter()
+
+            # All but the last query are run normally (they're probably
+            # things like making temp tables).  The last one goes through
+            # a named (server-side) cursor so its results can be pulled
+            # down a chunk at a time.
+            queries = list( zip( queryinfo['queries'], queryinfo['subdicts'] ) )
+            for query, subdict in queries[:-1]:
+                self.logger.info( f"For query request {queryinfo['queryid']}, running query: "
+                                  f"{cursor.mogrify(query,subdict)}" )
+                self.set_timeout( cursor, t0 )
+                cursor.execute( query, subdict )
+
+            query, subdict = queries[-1]
+            self.logger.info( f"For query request {queryinfo['queryid']}, running query: "
+                              f"{cursor.mogrify(query,subdict)}" )
+            self.set_timeout( cursor, t0 )
+            rescursor = conn.cursor( name=f"longquery_{str(queryinfo['queryid']).replace('-','')}" )
+            rescursor.execute( query, subdict )
+
+            self.logger.info( "Done running queries, fetching and saving" )
+            nfetch = self.chunksize
+            rows = rescursor.fetchmany( nfetch )
+            columns = [ d.name for d in rescursor.description ]
+            typeoids = [ d.type_code for d in rescursor.description ]
+            writer = self.writers[ queryinfo['format'] ]( partialpath, columns, typeoids, self.maxmemory )
+            while len( rows ) > 0:
+                writer.write( rows )
+                # Keep each chunk down to a small fraction of the memory allowance
+                if writer.chunkbytes > 0:
+                    nfetch = max( 1, min( self.chunksize,
+                                          int( len(rows) * ( self.maxmemory / 8 ) / writer.chunkbytes ) ) )
+                rows = None
+                self.set_timeout( cursor, t0 )
+                rows = rescursor.fetchmany( nfetch )
+            writer.close()
+            nrows = writer.nrows
+            writer = None
+            partialpath.rename( outpath )
+
+            self.logger.info( f"Done saving {nrows} rows ({outpath.stat().st_size} bytes) "
+                              f"in {time.perf_counter()-t0:.1f} s, marking finished" )
+            conn.rollback()
+            conn.close()
             conn = None
             qentry.finished = datetime.datetime.now( tz=datetime.timezone.utc )
+            qentry.nrows = nrows
+            qentry.nbytes = outpath.stat().st_size
             qentry.save()
 
             self.logger.info( "All done." )
             return True
 
         except Exception as ex:
-            self.logger.exception( ex )
+            self.logger.exception( f"Exception running query request {queryinfo['queryid']}: {str(ex)}" )
             if conn is not None:
                 conn.rollback()
-                cursor = conn.cursor()
+                conn.close()
                 conn = None
-                if qentry is not None:
-                    qentry.finished = datetime.datetime.now( tz=datetime.timezone.utc )
-                    qentry.error = True
+            if writer is not None:
+                try:
+                    writer.close()
+                except Exception:
+                    pass
+            if partialpath.is_file():
+                partialpath.unlink()
+            if qentry is not None:
+                qentry.finished = datetime.datetime.now( tz=datetime.timezone.utc )
+                qentry.error = True
+                if isinstance( ex, psycopg2.errors.QueryCanceled ):
+                    qentry.errortext = f"Query ran longer than {self.maxruntime} s"
+                else:
                     qentry.errortext = str(ex)
-                    qentry.save()
+                qentry.save()
             return False
 
         finally:
             if conn is not None:
                 conn.rollback()
+                conn.close()
 
     def add_arguments( self, parser ):
         parser.add_argument( '-o', '--once', default=False, action='store_true',
                              help="Just run at most one query" )
         parser.add_argument( '-l', '--loop', default=False, action='store_true',
                              help="Run the check/run query loop" )
+        parser.add_argument( '-n', '--nworkers', default=1, type=int,
+                             help="Number of queries to run at once (with --loop)" )
         parser.add_argument( '-p', '--prune', default=None, type=float,
                              help=( "Prune queries older than this many days.  It probably doesn't "
                                     "make sense to use this with --loop" ) )
-        
+        parser.add_argument( '-c', '--chunk-size', default=100000, type=int,
+                             help="Fetch (at most) this many rows at a time from the database" )
+        parser.add_argument( '-t', '--max-runtime', default=4*3600, type=float,
+                             help="Give up on a query that takes longer than this many seconds" )
+        parser.add_argument( '-m', '--max-memory', default=4096, type=float,
+                             help=( "Give up on a query whose results need more than this many MiB "
+                                    "of memory (only an issue for formats pandas and numpy)" ) )
+
 
     def handle( self, *args, **options ):
+        self.chunksize = options['chunk_size']
+        self.maxruntime = options['max_runtime']
+        self.maxmemory = int( options['max_memory'] * 1024 * 1024 )
+
         if options['prune'] is not None:
             self.prune_old_query_results( options['prune'] )
-        
+
         if options['once']:
             if options['loop']:
                 self.logger.warning( "Both --once and --loop given, only running one query (ignoring --loop)." )
@@ -193,13 +534,9 @@ class Command(BaseCommand):
             return
 
         if options['loop']:
-            self.logger.info( f"Starting infinite loop to look for and run queries." )
-            while True:
-                queryinfo = self.get_queued_query()
-                if queryinfo is None:
-                    time.sleep( self.sleeptime )
-                    continue
-
-                self.run_query( queryinfo )
-
-
+            self.logger.info( f"Starting infinite loop to look for and run queries "
+                              f"with {options['nworkers']} workers." )
+            if options['nworkers'] > 1:
+                self.run_workers( options['nworkers'] )
+            else:
+                self.worker_loop()
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('db', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queryqueue',
+            name='nbytes',
+            field=models.BigIntegerField(default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='queryqueue',
+            name='nrows',
+            field=models.BigIntegerField(default=None, null=True),
+        ),
+    ]
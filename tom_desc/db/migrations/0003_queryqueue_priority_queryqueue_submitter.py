@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-18 16:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('db', '0002_queryqueue_nbytes_queryqueue_nrows'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queryqueue',
+            name='priority',
+            field=models.SmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='queryqueue',
+            name='submitter',
+            field=models.TextField(default=None, null=True),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.7 on 2026-10-18 19:05
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('db', '0003_queryqueue_priority_queryqueue_submitter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueryResultCache',
+            fields=[
+                ('cachekey', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('lastused', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('expires', models.DateTimeField(db_index=True)),
+                ('nhits', models.BigIntegerField(default=0)),
+                ('nbytes', models.BigIntegerField()),
+                ('tables', django.contrib.postgres.fields.ArrayField(base_field=models.TextField(), default=list, size=None)),
+                ('contenttype', models.TextField()),
+                ('result', models.BinaryField()),
+            ],
+        ),
+    ]
@@ -1,16 +1,23 @@
 import sys
 import io
+import re
+import json
+import hashlib
 import psycopg2
 import psycopg2.extras
 import numpy
 import pandas
 
 import django.db
+import django.apps
+import django.utils.timezone
 from django.db import models
 import django.contrib.postgres.indexes as indexes
 from django.utils.functional import cached_property
 from django.contrib.postgres.fields import ArrayField
 
+from db.bincopy import BinaryCopyStream
+
 # Create your models here.
 
 # Support the Q3c Indexing scheme
@@ -128,21 +135,150 @@ class Createable(models.Model):
         q = cls.objects.filter( pk__in=pks )
         return [ getattr(i, i._pk) for i in q ]
 
+    # Postgres column type oids of tables, for bulk_insert_columnar; { db_table: { column: oid } }
+    _table_typeoids = {}
+
+    @classmethod
+    def _typeoids( cls ):
+        table = cls._meta.db_table
+        if table not in Createable._table_typeoids:
+            with django.db.connection.cursor() as cursor:
+                cursor.execute( "SELECT attname, atttypid FROM pg_attribute "
+                                "WHERE attrelid=%(table)s::regclass AND attnum>0 AND NOT attisdropped",
+                                { 'table': table } )
+                Createable._table_typeoids[ table ] = { row[0]: row[1] for row in cursor.fetchall() }
+        return Createable._table_typeoids[ table ]
+
+    @classmethod
+    def _columnar_data( cls, data, kwmap=None ):
+        """If data is columnar, return { model keyword: column }; otherwise, return None.
+
+        Columnar data is an astropy Table, a numpy structured array, a
+        pandas DataFrame, or a dict whose values are all numpy arrays
+        (which includes astropy Columns).  Keywords are matched the same
+        way as in data_to_createdict.
+
+        """
+        if isinstance( data, numpy.ndarray ) and ( data.dtype.names is not None ):
+            names = data.dtype.names
+        elif isinstance( data, pandas.DataFrame ):
+            names = list( data.columns )
+        elif hasattr( data, 'colnames' ):
+            # astropy Table (without having to import astropy)
+            names = data.colnames
+        elif isinstance( data, dict ) and all( isinstance( v, numpy.ndarray ) for v in data.values() ):
+            names = list( data.keys() )
+        else:
+            return None
+
+        if kwmap is None:
+            kwmap = cls._create_kws_map if hasattr( cls, '_create_kws_map' ) else {}
+        datamap = { ( kwmap[kw] if kw in kwmap else kw.lower() ): kw for kw in names }
+        return { kw: data[ datamap[kw] ] for kw in cls._create_kws if kw in datamap }
+
+    @classmethod
+    def _can_insert_columnar( cls, data, kwmap=None ):
+        columns = cls._columnar_data( data, kwmap=kwmap )
+        if ( columns is None ) or ( len( columns ) == 0 ):
+            return False
+        typeoids = cls._typeoids()
+        return all( BinaryCopyStream.supports( typeoids[kw] ) for kw in columns )
+
+    @classmethod
+    def bulk_insert_columnar( cls, data, kwmap=None, direct=False, chunksize=100000 ):
+        """Insert columnar data with a binary COPY.  Ignores records that conflict with things present.
+
+        data is an astropy Table, a numpy structured array, a pandas
+        DataFrame, or a dict of { kw: numpy array }; see _columnar_data.
+        Unlike the CSV path of bulk_insert_onlynew, the data never turns
+        into python objects or text.  It's encoded into postgres' binary
+        COPY format chunksize rows at a time (see db.bincopy), and
+        streamed to the server.
+
+        direct : if True, COPY straight into the table, skipping the temp
+          table and the INSERT ... ON CONFLICT DO NOTHING.  Only do this
+          if the table is known to be empty (or has no unique constraints,
+          e.g. while load_snana_fits has dropped them), and data has no
+          duplicates; otherwise, you'll get an error.
+
+        Returns the number of rows actually inserted.
+
+        """
+        columns = cls._columnar_data( data, kwmap=kwmap )
+        if columns is None:
+            raise TypeError( f"Can't do a columnar insert of a {type(data)}" )
+        typeoids = cls._typeoids()
+        stream = BinaryCopyStream( list( columns.values() ), [ typeoids[kw] for kw in columns ],
+                                   chunksize=chunksize )
+        table = cls._meta.db_table
+
+        conn = None
+        origautocommit = None
+        gratuitous = None
+        cursor = None
+        try:
+            # Same hoop-jumping as in bulk_insert_onlynew
+            gratuitous = django.db.connection.cursor()
+            conn = gratuitous.connection
+            origautocommit = conn.autocommit
+            conn.autocommit = False
+            cursor = conn.cursor()
+            if direct:
+                cursor.copy_expert( f"COPY {table}({','.join(columns.keys())}) FROM STDIN WITH (FORMAT binary)",
+                                    stream, size=1048576 )
+                # COPY either loads every row or fails
+                ninserted = stream.nrows
+            else:
+                cursor.execute( "DROP TABLE IF EXISTS bulk_upsert" )
+                cursor.execute( f"CREATE TEMP TABLE bulk_upsert (LIKE {table})" )
+                cursor.copy_expert( f"COPY bulk_upsert({','.join(columns.keys())}) FROM STDIN WITH (FORMAT binary)",
+                                    stream, size=1048576 )
+                cursor.execute( f"INSERT INTO {table} SELECT * FROM bulk_upsert ON CONFLICT DO NOTHING" )
+                ninserted = cursor.rowcount
+                cursor.execute( "DROP TABLE bulk_upsert" )
+            conn.commit()
+            return ninserted
+        except Exception as e:
+            if conn is not None:
+                conn.rollback()
+            raise e
+        finally:
+            if cursor is not None:
+                cursor.close()
+                cursor = None
+            if gratuitous is not None:
+                gratuitous.close()
+                gratuitous = None
+            if origautocommit is not None and conn is not None:
+                conn.autocommit = origautocommit
+                origautocommit = None
+                conn = None
+
     # This version uses postgres COPY and tries to be faster than mucking
     # about with ORM constructs.
     @classmethod
-    def bulk_insert_onlynew( cls, data, kwmap=None ):
+    def bulk_insert_onlynew( cls, data, kwmap=None, direct=False ):
         """Insert a bunch of data into the database.  Ignores records that conflict with things present.
 
         data can be:
           * a dict of { kw: iterable }.  All of the iterables must have the same length,
             and must be something that pandas.DataFrame could handle
           * a list of dicts.  The keys in all dicts must be the same
+          * columnar data (an astropy Table, numpy structured array,
+            pandas DataFrame, or dict of numpy arrays).  If all the
+            columns are types that BinaryCopyStream can handle, this
+            goes through bulk_insert_columnar, which is much faster.
         data and kwmap will be run through data_to_createdict
 
+        direct : COPY straight into the table instead of going through a
+          temp table; see bulk_insert_columnar.
+
         Returns the number of rows actually inserted (which may be less than len(data)).
 
         """
+        if cls._can_insert_columnar( data, kwmap=kwmap ):
+            return cls.bulk_insert_columnar( data, kwmap=kwmap, direct=direct )
+
         conn = None
         origautocommit = None
         gratuitous = None
@@ -158,8 +294,10 @@ class Createable(models.Model):
             cursor = conn.cursor( cursor_factory=psycopg2.extras.RealDictCursor )
             # Yeah.... if anybody ever creates a django application named "bulk" and then
             #   has a model "upsert", we're about to totally screw that up.
-            cursor.execute( "DROP TABLE IF EXISTS bulk_upsert" )
-            cursor.execute( f"CREATE TEMP TABLE bulk_upsert (LIKE {cls._meta.db_table})" )
+            target = cls._meta.db_table if direct else "bulk_upsert"
+            if not direct:
+                cursor.execute( "DROP TABLE IF EXISTS bulk_upsert" )
+                cursor.execute( f"CREATE TEMP TABLE bulk_upsert (LIKE {cls._meta.db_table})" )
             # NOTE: I have a little bit of worry here that pandas is going to destroy
             # datatypes-- in particular, that it will convert my int64s to either int32 or
             # float our double, thereby losing precision.  I've checked it, and it seems
@@ -174,16 +312,19 @@ class Createable(models.Model):
             # this will break if columns aren't all lower case)
             # columns = [ f'"{c}"' for c in df.columns.values ]
             columns = df.columns.values
-            cursor.copy_from( strio, "bulk_upsert", columns=columns, size=1048576 )
-            q = f"INSERT INTO {cls._meta.db_table} SELECT * FROM bulk_upsert ON CONFLICT DO NOTHING"
-            cursor.execute( q )
-            ninserted = cursor.rowcount
-            # I don't think I should have to do this; shouldn't it happen automatically
-            #   with conn.commit()?  But it didn't seem to.  Maybe it only happens
-            #   with conn.close(), but I don't want to do that because it screws
-            #   with django.  (I'm probably doing naughty things by even digging to
-            #   get conn, but hey, I need it for efficiency.)
-            cursor.execute( "DROP TABLE bulk_upsert" )
+            cursor.copy_from( strio, target, columns=columns, size=1048576 )
+            if direct:
+                ninserted = len( df )
+            else:
+                q = f"INSERT INTO {cls._meta.db_table} SELECT * FROM bulk_upsert ON CONFLICT DO NOTHING"
+                cursor.execute( q )
+                ninserted = cursor.rowcount
+                # I don't think I should have to do this; shouldn't it happen automatically
+                #   with conn.commit()?  But it didn't seem to.  Maybe it only happens
+                #   with conn.close(), but I don't want to do that because it screws
+                #   with django.  (I'm probably doing naughty things by even digging to
+                #   get conn, but hey, I need it for efficiency.)
+                cursor.execute( "DROP TABLE bulk_upsert" )
             conn.commit()
             return ninserted
         except Exception as e:
@@ -232,7 +373,14 @@ class Createable(models.Model):
         return curobjs
 
 
-# A queue for tracking long SQL queries
+# A queue for tracking long SQL queries.  nrows and nbytes are the
+# number of rows the query returned and the size of the results file,
+# filled in by long_query_runner when the query finishes.
+#
+# long_query_runner runs queries with higher priority first; within a
+# priority, it prefers submitters who have the fewest queries already
+# running, and then the oldest query.  (So one user who submits a pile
+# of long queries doesn't lock everybody else out.)
 
 class QueryQueue(models.Model):
     queryid = models.UUIDField( primary_key=True )
@@ -244,4 +392,163 @@ class QueryQueue(models.Model):
     queries = ArrayField( models.TextField(), default=list )
     subdicts = ArrayField( models.JSONField(), default=list )
     format = models.TextField( default='csv' )
+    nrows = models.BigIntegerField( null=True, default=None )
+    nbytes = models.BigIntegerField( null=True, default=None )
+    submitter = models.TextField( null=True, default=None )
+    priority = models.SmallIntegerField( default=0 )
+
+
+
+# An opt-in cache of the results of short SQL queries (db/runsqlquery/
+# and fastdb_dev/submit_short_query), so that dashboards and notebooks
+# that run the same query over and over don't keep going to the
+# database.  It's in postgres (rather than on local disk) so that it's
+# shared by all of the web server processes, and so that ingestion
+# commands running elsewhere can invalidate it.
+#
+# Entries are keyed on a hash of the endpoint, the query text (with
+# whitespace outside of string literals normalized), the substitution
+# dictionaries, and any options that affect the response.  What's stored
+# is the body of the response.  Entries expire after their TTL, and the
+# least recently used entries are evicted when the total size goes over
+# maxbytes.  tables is the list of the tables of django models that the
+# queries mention (elasticc2 tables are named elasticc2_*, but fastdb_dev
+# tables have plain names like dia_source), so that invalidate can throw
+# out just the entries that depend on tables from one app.
+
+class QueryResultCache(models.Model):
+    cachekey = models.CharField( max_length=64, primary_key=True )
+    created = models.DateTimeField( default=django.utils.timezone.now )
+    lastused = models.DateTimeField( default=django.utils.timezone.now, db_index=True )
+    expires = models.DateTimeField( db_index=True )
+    nhits = models.BigIntegerField( default=0 )
+    nbytes = models.BigIntegerField()
+    tables = ArrayField( models.TextField(), default=list )
+    contenttype = models.TextField()
+    result = models.BinaryField()
+
+    defaultttl = 300
+    maxttl = 3600
+    maxbytes = 256 * 1024 * 1024
+    maxentrybytes = 16 * 1024 * 1024
+
+    # Per-process counters
+    _hits = 0
+    _misses = 0
+
+    _literal_re = re.compile( r"('(?:[^']|'')*')" )
+    _word_re = re.compile( r"\w+" )
+
+    @classmethod
+    def _tables_of( cls, app_label=None ):
+        mods = ( django.apps.apps.get_models() if app_label is None
+                 else django.apps.apps.get_app_config( app_label ).get_models() )
+        return set( m._meta.db_table.lower() for m in mods )
+
+    @classmethod
+    def tables_mentioned( cls, queries ):
+        """Return a sorted list of the model tables mentioned anywhere in queries."""
+        words = set( w.lower() for q in queries for w in cls._word_re.findall( q ) )
+        return sorted( words & cls._tables_of() )
 
+    @classmethod
+    def normalize_query( cls, query ):
+        """Collapse runs of whitespace (outside of string literals) and strip any trailing semicolon."""
+        parts = cls._literal_re.split( query )
+        for i in range( 0, len(parts), 2 ):
+            parts[i] = " ".join( parts[i].split() )
+        return "".join( parts ).strip().rstrip( ';' ).strip()
+
+    @classmethod
+    def make_key( cls, endpoint, queries, subdicts, **options ):
+        keydata = json.dumps( { 'endpoint': endpoint,
+                                'queries': [ cls.normalize_query(q) for q in queries ],
+                                'subdicts': subdicts,
+                                'options': options },
+                              sort_keys=True, default=str )
+        return hashlib.sha256( keydata.encode( 'utf-8' ) ).hexdigest()
+
+    @classmethod
+    def ttl( cls, requested ):
+        """Turn the 'cache' value from a request into a TTL in seconds, or None for don't cache.
+
+        requested can be None or False (don't cache), True (cache for
+        defaultttl), or a number of seconds (no more than maxttl).
+
+        """
+        if ( requested is None ) or ( requested is False ):
+            return None
+        if requested is True:
+            return cls.defaultttl
+        requested = float( requested )
+        if requested <= 0:
+            return None
+        return min( requested, cls.maxttl )
+
+    @classmethod
+    def lookup( cls, key ):
+        """Returns ( result bytes, content type ), or None if there's no unexpired entry for key."""
+        with django.db.connection.cursor() as cursor:
+            cursor.execute( "UPDATE db_queryresultcache SET lastused=NOW(), nhits=nhits+1 "
+                            "WHERE cachekey=%(key)s AND expires>NOW() "
+                            "RETURNING result, contenttype",
+                            { 'key': key } )
+            row = cursor.fetchone()
+        if row is None:
+            cls._misses += 1
+            return None
+        cls._hits += 1
+        return bytes( row[0] ), row[1]
+
+    @classmethod
+    def store( cls, key, queries, result, contenttype, ttl ):
+        """Save result (bytes) for key, and evict whatever's necessary to stay under maxbytes."""
+        if len( result ) > cls.maxentrybytes:
+            return
+        tables = cls.tables_mentioned( queries )
+        with django.db.connection.cursor() as cursor:
+            cursor.execute( "INSERT INTO db_queryresultcache(cachekey,created,lastused,expires,nhits,"
+                            "                                nbytes,tables,contenttype,result) "
+                            "VALUES (%(key)s,NOW(),NOW(),NOW()+%(ttl)s*INTERVAL '1 second',0,"
+                            "        %(nbytes)s,%(tables)s,%(ctype)s,%(result)s) "
+                            "ON CONFLICT (cachekey) DO UPDATE "
+                            "  SET created=excluded.created, lastused=excluded.lastused, expires=excluded.expires, "
+                            "      nbytes=excluded.nbytes, tables=excluded.tables, "
+                            "      contenttype=excluded.contenttype, result=excluded.result",
+                            { 'key': key, 'ttl': ttl, 'nbytes': len(result), 'tables': tables,
+                              'ctype': contenttype, 'result': psycopg2.Binary( result ) } )
+            cursor.execute( "DELETE FROM db_queryresultcache WHERE expires<=NOW()" )
+            cursor.execute( "DELETE FROM db_queryresultcache WHERE cachekey IN "
+                            "  ( SELECT cachekey FROM "
+                            "    ( SELECT cachekey, SUM(nbytes) OVER (ORDER BY lastused DESC, cachekey) AS cum "
+                            "      FROM db_queryresultcache ) subq "
+                            "    WHERE cum > %(max)s )",
+                            { 'max': cls.maxbytes } )
+
+    @classmethod
+    def invalidate( cls, app_label=None ):
+        """Throw out cached results.
+
+        app_label : if None, throw out everything; otherwise, throw out
+          the entries whose queries mention tables of the models of
+          that django app (e.g. "elasticc2" or "fastdb_dev").
+
+        Returns the number of entries thrown out.
+
+        """
+        with django.db.connection.cursor() as cursor:
+            if app_label is None:
+                cursor.execute( "DELETE FROM db_queryresultcache" )
+            else:
+                cursor.execute( "DELETE FROM db_queryresultcache WHERE tables && %(tables)s::text[]",
+                                { 'tables': sorted( cls._tables_of( app_label ) ) } )
+            return cursor.rowcount
+
+    @classmethod
+    def stats( cls ):
+        with django.db.connection.cursor() as cursor:
+            cursor.execute( "SELECT COUNT(*), COALESCE(SUM(nbytes),0), COALESCE(SUM(nhits),0) "
+                            "FROM db_queryresultcache WHERE expires>NOW()" )
+            nentries, nbytes, nhits = cursor.fetchone()
+        return { 'entries': nentries, 'bytes': int(nbytes), 'entryhits': int(nhits),
+                 'processhits': cls._hits, 'processmisses': cls._misses }
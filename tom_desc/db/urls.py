@@ -3,7 +3,9 @@ from db import views
 
 urlpatterns = [
     path('runsqlquery/', views.RunSQLQuery.as_view()),
+    path('querycachestats/', views.QueryCacheStats.as_view()),
     path('submitsqlquery/', views.SubmitLongSQLQuery.as_view()),
     path('checksqlquery/<str:queryid>/', views.CheckLongSQLQuery.as_view()),
     path('getsqlqueryresults/<str:queryid>/', views.GetLongSQLQueryResults.as_view()),
+    path('getsqlqueryresultspage/<str:queryid>/', views.GetLongSQLQueryResultsPage.as_view()),
 ]
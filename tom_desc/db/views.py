@@ -1,17 +1,38 @@
 import sys
 import os
+import re
 import json
+import threading
+import contextlib
 import uuid
+import zlib
+import pathlib
 import datetime
 import logging
+import numpy
+import pandas
+import pyarrow
+import pyarrow.ipc
+import pyarrow.parquet
 import psycopg2
+import psycopg2.errors
 import psycopg2.extras
-from django.http import HttpResponse, JsonResponse
+import psycopg2.pool
+from django.http import HttpResponse, JsonResponse, FileResponse, StreamingHttpResponse
 from django.utils.decorators import method_decorator
 from django.shortcuts import render
 from django.contrib.auth.mixins import PermissionRequiredMixin, LoginRequiredMixin
+import django.db
 import django.views
-from db.models import QueryQueue
+from db.models import QueryQueue, QueryResultCache
+from db.arrowtables import ArrowTableBuilder, unique_names
+
+# zstd transfer compression of long query results is only available if
+# zstandard is installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 # WARNING -- I've harcoded a couple of paths here, in anticipation
 #  that they'll be bind-mounted there inside whatever container
@@ -73,46 +94,226 @@ def _extract_queries( request ):
     return queries, subdicts, data
     
 
+class _ReadOnlyConnectionPool:
+    """A process-wide pool of connections to the database as the postgres_ro user.
+
+    Use as
+
+      with _ropool.connection() as conn:
+          ...
+
+    Each connection comes out with autocommit off, and on the way back
+    in is rolled back and reset with DISCARD ALL, so nothing a query does
+    (temp tables, SET, etc.) leaks into the next request that gets that
+    connection.  If the pool is exhausted, you get a one-off connection
+    that's closed afterwards rather than an error.
+
+    """
+
+    def __init__( self, maxconn=8 ):
+        self.maxconn = maxconn
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _connect_kwargs( self ):
+        with open( "/secrets/postgres_ro_password" ) as ifp:
+            password = ifp.readline().strip()
+        return { 'dbname': os.getenv('DB_NAME'), 'host': os.getenv('DB_HOST'),
+                 'user': 'postgres_ro', 'password': password }
+
+    def _getpool( self ):
+        with self._lock:
+            if self._pool is None:
+                self._pool = psycopg2.pool.ThreadedConnectionPool( 0, self.maxconn, **self._connect_kwargs() )
+            return self._pool
+
+    @contextlib.contextmanager
+    def connection( self ):
+        pool = self._getpool()
+        pooled = True
+        try:
+            conn = pool.getconn()
+        except psycopg2.pool.PoolError:
+            pooled = False
+            conn = psycopg2.connect( **self._connect_kwargs() )
+        ok = False
+        try:
+            conn.autocommit = False
+            yield conn
+            ok = True
+        finally:
+            try:
+                if not conn.closed:
+                    conn.rollback()
+                    conn.autocommit = True
+                    with conn.cursor() as cursor:
+                        cursor.execute( "DISCARD ALL" )
+                    conn.autocommit = False
+            except Exception as ex:
+                _logger.warning( f"Failed to reset read-only connection, discarding it: {ex}" )
+                ok = False
+            if pooled:
+                pool.putconn( conn, close=( conn.closed or not ok ) )
+            else:
+                conn.close()
+
+_ropool = _ReadOnlyConnectionPool()
+
+
 class RunSQLQuery(LoginRequiredMixin, django.views.View):
+    """Run a (short) read-only SQL query, or sequence of queries, and return the results.
+
+    POST body is JSON with 'query' and 'subdict' (see _extract_queries), and optionally:
+
+      format : 'rows' (the default) returns { 'status': 'ok', 'rows': [ { col: val, ... }, ... ] };
+               'columns' returns { 'status': 'ok', 'columns': [ names ], 'data': [ [ col0 vals ], ... ] };
+               'arrow' returns the results as an Arrow IPC stream
+               (content type application/vnd.apache.arrow.stream)
+      timeout : statement timeout in seconds (no more than maxtimeout,
+                which is also the default; that's about when the web
+                proxy gives up anyway)
+      maxrows : return no more than this many rows (by default, all rows
+                are returned)
+      cache : True, or a number of seconds; if given, the response may
+              come from (and will be saved to) the query result cache
+              (see db.models.QueryResultCache).  True means keep the
+              result for QueryResultCache.defaultttl seconds.  Only use
+              this for queries whose results you're OK being a few
+              minutes stale; the cache is only thrown out when one of
+              the ingestion commands finishes.
+
+    If the results had more rows than were returned, the JSON response
+    has 'truncated': True (and the arrow response has the header
+    X-Truncated: true).  If cache was given, the response has the header
+    X-Cache, which is either "hit" or "miss".
+
+    """
+
     raise_exception = True
+    maxtimeout = 300
 
     def post( self, request, *args, **kwargs ):
-        dbconn = None
         try:
-            dbuser = "postgres_ro"
-            pwfile = "/secrets/postgres_ro_password"
-            with open( pwfile ) as ifp:
-                password = ifp.readline().strip()
-
             queries, subdicts, data = _extract_queries( request )
 
-            dbconn = psycopg2.connect( dbname=os.getenv('DB_NAME'), host=os.getenv('DB_HOST'),
-                                       user=dbuser, password=password,
-                                       cursor_factory=psycopg2.extras.RealDictCursor )
+            format = data['format'] if 'format' in data else 'rows'
+            if format not in [ 'rows', 'columns', 'arrow' ]:
+                raise ValueError( f"Unknown format {format}" )
+            timeout = min( float( data['timeout'] ), self.maxtimeout ) if 'timeout' in data else self.maxtimeout
+            maxrows = int( data['maxrows'] ) if ( 'maxrows' in data ) and ( data['maxrows'] is not None ) else None
+
+            cachettl = QueryResultCache.ttl( data['cache'] if 'cache' in data else None )
+            if cachettl is not None:
+                cachekey = QueryResultCache.make_key( 'db/runsqlquery', queries, subdicts,
+                                                     format=format, maxrows=maxrows )
+                cached = QueryResultCache.lookup( cachekey )
+                if cached is not None:
+                    _logger.debug( "Returning cached query sequence results" )
+                    response = HttpResponse( cached[0], content_type=cached[1] )
+                    response['X-Cache'] = 'hit'
+                    return response
+
+            response = self._run( queries, subdicts, format, timeout, maxrows )
+
+            if cachettl is not None:
+                # (The cache only keeps the body, so don't save a truncated
+                # arrow response, as X-Truncated wouldn't survive.)
+                if not response.has_header( 'X-Truncated' ):
+                    QueryResultCache.store( cachekey, queries, response.content,
+                                            response['Content-Type'], cachettl )
+                response['X-Cache'] = 'miss'
+            return response
+
+        except Exception as ex:
+            _logger.exception( ex )
+            return JsonResponse( { 'status': 'error', 'error': str(ex) } )
+
+    def _run( self, queries, subdicts, format, timeout, maxrows ):
+        with _ropool.connection() as dbconn:
             cursor = dbconn.cursor()
+            cursor.execute( "SET LOCAL statement_timeout=%(ms)s", { 'ms': int( timeout * 1000 ) } )
 
             _logger.debug( "Starting query sequence" )
             _logger.debug( "queries={queries}" )
             _logger.debug( "subdicts={subdicts}" )
-            for query, subdict in zip( queries, subdicts ):
-                _logger.debug( f'Query is {query}, subdict is {subdict}, dbuser is {dbuser}' )
+            for query, subdict in zip( queries[:-1], subdicts[:-1] ):
+                _logger.debug( f'Query is {query}, subdict is {subdict}' )
                 cursor.execute( query, subdict )
                 _logger.debug( 'Query done' )
+
+            # The last query goes through a server-side cursor, so that
+            # (if there's a maxrows) no more than maxrows rows ever come
+            # over from postgres.
+            # Not everything can be a cursor (only SELECT and the like,
+            # and only one statement), so if postgres won't declare the
+            # cursor, just run the query normally.
+            _logger.debug( f'Query is {queries[-1]}, subdict is {subdicts[-1]}' )
+            cursor.execute( "SAVEPOINT runsqlquery" )
+            try:
+                rescursor = dbconn.cursor( name="runsqlquery" )
+                rescursor.execute( queries[-1], subdicts[-1] )
+            except psycopg2.errors.SyntaxError:
+                cursor.execute( "ROLLBACK TO SAVEPOINT runsqlquery" )
+                rescursor = cursor
+                rescursor.execute( queries[-1], subdicts[-1] )
             _logger.debug( "Fetching" )
-            rows = cursor.fetchall()
+            if maxrows is None:
+                rows = rescursor.fetchall()
+                truncated = False
+            else:
+                rows = rescursor.fetchmany( maxrows + 1 )
+                truncated = len( rows ) > maxrows
+                rows = rows[ :maxrows ]
+            columns = [ d.name for d in rescursor.description ]
+
+            if format == 'arrow':
+                table = ArrowTableBuilder.from_cursor( rescursor ).table( rows )
+                sink = pyarrow.BufferOutputStream()
+                with pyarrow.ipc.new_stream( sink, table.schema ) as writer:
+                    writer.write_table( table )
+                response = HttpResponse( sink.getvalue().to_pybytes(),
+                                         content_type="application/vnd.apache.arrow.stream" )
+                if truncated:
+                    response['X-Truncated'] = 'true'
+                _logger.debug( f"Returning {len(rows)} rows from query sequence." )
+                return response
+
+        if format == 'columns':
+            response = { 'status': 'ok', 'columns': columns, 'data': [ list(c) for c in zip( *rows ) ] }
+            if len( rows ) == 0:
+                response['data'] = [ [] for c in columns ]
+        else:
+            response = { 'status': 'ok', 'rows': [ dict( zip( columns, row ) ) for row in rows ] }
+        if truncated:
+            response['truncated'] = True
+
+        _logger.debug( f"Returning {len(rows)} rows from query sequence." )
+        return JsonResponse( response )
+
+
+
+class QueryCacheStats(LoginRequiredMixin, django.views.View):
+    """Return statistics about the query result cache.
 
-            _logger.debug( f"Returning {len(rows)} rows from query sequence." )
-            return JsonResponse( { 'status': 'ok', 'rows': rows } )
+    GET or POST; returns { 'status': 'ok', 'entries': <int>, 'bytes': <int>,
+    'entryhits': <int>, 'processhits': <int>, 'processmisses': <int> }.
+    entries, bytes, and entryhits are totals over the unexpired entries
+    in the cache; processhits and processmisses are only for the web
+    server process that answered this request.
 
+    """
+
+    raise_exception = True
+
+    def get( self, request, *args, **kwargs ):
+        try:
+            return JsonResponse( { 'status': 'ok', **QueryResultCache.stats() } )
         except Exception as ex:
             _logger.exception( ex )
             return JsonResponse( { 'status': 'error', 'error': str(ex) } )
 
-        finally:
-            if dbconn is not None:
-                dbconn.rollback()
-                dbconn.close()
-
+    def post( self, request, *args, **kwargs ):
+        return self.get( request, *args, **kwargs )
 
 
 # ======================================================================
@@ -128,12 +329,27 @@ class SubmitLongSQLQuery(LoginRequiredMixin, django.views.View):
             format = 'csv'
             if 'format' in data:
                 format = data[ 'format' ]
-                if format not in [ 'csv', 'pandas', 'numpy' ]:
+                if format not in [ 'csv', 'pandas', 'numpy', 'parquet' ]:
                     raise ValueError( f"Unknown format {format}" )
 
+            # Anybody can make their query lower priority than the default,
+            # but only staff can bump theirs up.
+            priority = 0
+            if 'priority' in data:
+                priority = int( data['priority'] )
+                if ( priority > 0 ) and ( not request.user.is_staff ):
+                    raise ValueError( "Only staff can submit queries with priority > 0" )
+                if ( priority < -32768 ) or ( priority > 32767 ):
+                    raise ValueError( f"priority must be between -32768 and 32767" )
+
             queryid = uuid.uuid4()
             newqueue = QueryQueue.objects.create( queryid=queryid, submitted=datetime.datetime.now(),
-                                                  queries=queries, subdicts=subdicts, format=format )
+                                                  queries=queries, subdicts=subdicts, format=format,
+                                                  submitter=request.user.username, priority=priority )
+
+            # Wake up any long_query_runner workers waiting for something to do
+            with django.db.connection.cursor() as cursor:
+                cursor.execute( "SELECT pg_notify( 'db_queryqueue', %(id)s )", { 'id': str(queryid) } )
 
             return JsonResponse( { 'status': 'ok', 'queryid': str(queryid) } )
 
@@ -157,6 +373,7 @@ class CheckLongSQLQuery(LoginRequiredMixin, django.views.View):
             response = { 'queryid': queueobj.queryid,
                          'queries': queueobj.queries,
                          'subdicts': queueobj.subdicts,
+                         'priority': queueobj.priority,
                          'submitted': queueobj.submitted.isoformat() }
 
             if queueobj.error:
@@ -169,7 +386,9 @@ class CheckLongSQLQuery(LoginRequiredMixin, django.views.View):
             elif queueobj.finished is not None:
                 response.update( { 'status': 'finished',
                                    'started': queueobj.started.isoformat(),
-                                   'finished': queueobj.finished.isoformat() } )
+                                   'finished': queueobj.finished.isoformat(),
+                                   'nrows': queueobj.nrows,
+                                   'nbytes': queueobj.nbytes } )
 
             elif queueobj.started is not None:
                 response.update( { 'status': 'started',
@@ -186,44 +405,223 @@ class CheckLongSQLQuery(LoginRequiredMixin, django.views.View):
 
 # ======================================================================
 
+def _finished_query( queryid ):
+    """Returns ( QueryQueue object, None ) for a finished query, or ( None, error HttpResponse )."""
+    queueobj = QueryQueue.objects.filter( queryid=queryid )
+    if len( queueobj ) == 0:
+        return None, HttpResponse( f"Unknown query {queryid}",
+                                   content_type="text/plain; charset=utf-8",
+                                   status=500 )
+
+    queueobj = queueobj[0]
+    if queueobj.error:
+        return None, HttpResponse( f"Query errored out: {queueobj.errortext}",
+                                   content_type="text/plain; charset=utf-8",
+                                   status=500 )
+
+    if queueobj.finished is None:
+        if queueobj.started is None:
+            return None, HttpResponse( f"Query {queryid} hasn't started yet",
+                                       content_type="text/plain; charset=utf-8",
+                                       status=500 )
+        else:
+            return None, HttpResponse( f"Query {queryid} hasn't finished yet",
+                                       content_type="text/plain; charset=utf-8",
+                                       status=500 )
+
+    return queueobj, None
+
+
+def _file_chunks( path, start=0, length=None, blocksize=1024*1024 ):
+    """Yield the bytes of path from start, length bytes (or to the end) at most blocksize at a time."""
+    with open( path, "rb" ) as ifp:
+        ifp.seek( start )
+        while ( length is None ) or ( length > 0 ):
+            block = ifp.read( blocksize if length is None else min( blocksize, length ) )
+            if len( block ) == 0:
+                break
+            if length is not None:
+                length -= len( block )
+            yield block
+
+
+def _compressed_chunks( chunks, compression ):
+    if compression == 'gzip':
+        compressor = zlib.compressobj( wbits=31 )
+    elif compression == 'zstd':
+        compressor = zstandard.ZstdCompressor().compressobj()
+    for chunk in chunks:
+        out = compressor.compress( chunk )
+        if len( out ) > 0:
+            yield out
+    yield compressor.flush()
+
+
+def _parse_range( rangeheader, size ):
+    """Parse a (single) HTTP Range header; returns ( start, length ), or None if it's not satisfiable."""
+    match = re.search( r'^\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*$', rangeheader )
+    if ( match is None ) or ( ( match.group(1) == '' ) and ( match.group(2) == '' ) ):
+        return None
+    if match.group(1) == '':
+        # Suffix range: the last n bytes
+        n = int( match.group(2) )
+        if n == 0:
+            return None
+        start = max( 0, size - n )
+        return start, size - start
+    start = int( match.group(1) )
+    end = size - 1 if match.group(2) == '' else min( int( match.group(2) ), size - 1 )
+    if ( start >= size ) or ( end < start ):
+        return None
+    return start, end - start + 1
+
+
 class GetLongSQLQueryResults(LoginRequiredMixin, django.views.View):
+    """Return the results file of a finished long query.
+
+    The file is streamed, not read into memory.  Supports the HTTP Range
+    header (a single byte range), so that interrupted downloads can be
+    resumed.  If the POST body is JSON with "compression" set to "gzip"
+    or "zstd", the response is compressed on the fly (with the
+    Content-Encoding header set); this is ignored for range requests.
+
+    """
+
     raise_exception = True
 
+    _contenttypes = { 'numpy': 'application/octet-stream',
+                      'pandas': 'application/octet-stream',
+                      'parquet': 'application/octet-stream',
+                      'csv': 'text/csv; charset=utf-8' }
+
+    def get( self, request, queryid, *args, **kwargs ):
+        return self.post( request, queryid, *args, **kwargs )
+
     def post( self, request, queryid, *args, **kwargs ):
         try:
-            queueobj = QueryQueue.objects.filter( queryid=queryid )
-            if len( queueobj ) == 0:
-                return HttpResponse( f"Unknown query {queueobj.queryid}",
-                                     content_type="text/plain; charset=utf-8",
-                                     status=500 )
+            queueobj, errresponse = _finished_query( queryid )
+            if errresponse is not None:
+                return errresponse
 
-            queueobj = queueobj[0]
-            if queueobj.error:
-                return HttpResponse( f"Query errored out: {queueobj.errortext}",
-                                     content_type="text/plain; charset=utf-8",
-                                     status=500 )
-
-            if queueobj.finished is None:
-                if queueobj.started is None:
-                    return HttpResponse( f"Query {queryid} hasn't started yet",
-                                         content_type="text/plain; charset=utf-8",
-                                         status=500 )
-                else:
-                    return HttpResponse( f"Query {queryid} hasn't finished yet",
-                                         content_type="text/plain; charset=utf-8",
-                                         status=500 )
-
-
-            if ( queueobj.format == "numpy" ) or ( queueobj.format == "pandas" ):
-                with open( f"/query_results/{str(queueobj.queryid)}", "rb" ) as ifp:
-                    return HttpResponse( ifp.read(), content_type='application/octet-stream' )
-            elif ( queueobj.format == "csv" ):
-                with open( f"/query_results/{str(queueobj.queryid)}", "r" ) as ifp:
-                    return HttpResponse( ifp.read(), content_type='text/csv; charset=utf-8' )
-            else:
+            if queueobj.format not in self._contenttypes:
                 return HttpResponse( f"Query is finished, but results are in an unknown format "
                                      f"{queueobj.format}", content_type="text/plain; charset=utf-8",
                                      status=500 )
+            contenttype = self._contenttypes[ queueobj.format ]
+
+            compression = None
+            if len( request.body ) > 0:
+                data = json.loads( request.body )
+                if 'compression' in data:
+                    compression = data['compression']
+                    if compression not in [ None, 'gzip', 'zstd' ]:
+                        raise ValueError( f"Unknown compression {compression}" )
+                    if ( compression == 'zstd' ) and ( zstandard is None ):
+                        raise ValueError( "zstd compression isn't available on this server" )
+
+            path = pathlib.Path( "/query_results" ) / str( queueobj.queryid )
+            size = path.stat().st_size
+
+            if 'Range' in request.headers:
+                byterange = _parse_range( request.headers['Range'], size )
+                if byterange is None:
+                    response = HttpResponse( status=416 )
+                    response['Content-Range'] = f'bytes */{size}'
+                    return response
+                start, length = byterange
+                response = StreamingHttpResponse( _file_chunks( path, start, length ),
+                                                  content_type=contenttype, status=206 )
+                response['Content-Range'] = f'bytes {start}-{start+length-1}/{size}'
+                response['Content-Length'] = str( length )
+
+            elif compression is not None:
+                response = StreamingHttpResponse( _compressed_chunks( _file_chunks( path ), compression ),
+                                                  content_type=contenttype )
+                response['Content-Encoding'] = compression
+
+            else:
+                response = FileResponse( open( path, "rb" ), content_type=contenttype )
+
+            response['Accept-Ranges'] = 'bytes'
+            return response
+
         except Exception as ex:
             _logger.exception( ex )
             return HttpResponse( str(ex), content_type="text/plain; charset=utf-8", status=500 )
+
+# ======================================================================
+
+class GetLongSQLQueryResultsPage(LoginRequiredMixin, django.views.View):
+    """Return a slice of the rows of a finished long query as JSON.
+
+    POST body is JSON with "offset" (default 0) and "limit" (default
+    and maximum 100000).  Returns { "status": "ok", "offset": <int>,
+    "nrows": <total rows in the result>, "rows": [ { column: value, ... } ] }.
+
+    For csv and parquet results, only as much of the file as is needed
+    for the requested rows is read (for parquet, only the row groups that
+    include them).  numpy results are read one column at a time; pandas
+    results have to be read whole.
+
+    """
+
+    raise_exception = True
+    maxlimit = 100000
+
+    def read_page( self, path, format, offset, limit ):
+        if format == 'csv':
+            # (A callable rather than a range, which pandas would turn into a set of offset ints)
+            df = pandas.read_csv( path, index_col=0, skiprows=lambda i: 0 < i <= offset, nrows=limit )
+        elif format == 'pandas':
+            df = pandas.read_pickle( path ).iloc[ offset : offset+limit ]
+        elif format == 'numpy':
+            with numpy.load( path, allow_pickle=True ) as npz:
+                df = pandas.DataFrame( { col: npz[col][ offset : offset+limit ] for col in npz.files } )
+        elif format == 'parquet':
+            pqfile = pyarrow.parquet.ParquetFile( path )
+            tables = []
+            groupstart = 0
+            for i in range( pqfile.num_row_groups ):
+                ngroup = pqfile.metadata.row_group(i).num_rows
+                if ( groupstart + ngroup > offset ) and ( groupstart < offset + limit ):
+                    table = pqfile.read_row_group( i )
+                    lo = max( 0, offset - groupstart )
+                    hi = min( ngroup, offset + limit - groupstart )
+                    tables.append( table.slice( lo, hi - lo ) )
+                groupstart += ngroup
+            if len( tables ) == 0:
+                df = pqfile.schema_arrow.empty_table().to_pandas()
+            else:
+                df = pyarrow.concat_tables( tables ).to_pandas()
+        else:
+            raise ValueError( f"Results are in an unknown format {format}" )
+        return df
+
+    def post( self, request, queryid, *args, **kwargs ):
+        try:
+            queueobj, errresponse = _finished_query( queryid )
+            if errresponse is not None:
+                return errresponse
+
+            data = json.loads( request.body ) if len( request.body ) > 0 else {}
+            offset = int( data['offset'] ) if 'offset' in data else 0
+            limit = int( data['limit'] ) if 'limit' in data else self.maxlimit
+            if ( offset < 0 ) or ( limit < 0 ):
+                raise ValueError( "offset and limit must be non-negative" )
+            limit = min( limit, self.maxlimit )
+
+            path = pathlib.Path( "/query_results" ) / str( queueobj.queryid )
+            df = self.read_page( path, queueobj.format, offset, limit )
+            if not df.columns.is_unique:
+                df.columns = unique_names( df.columns )
+
+            # pandas knows how to json-ify its own types (numpy ints, timestamps, NaN)
+            # better than the django encoder does.
+            return HttpResponse( f'{{"status": "ok", "offset": {offset}, '
+                                 f'"nrows": {json.dumps(queueobj.nrows)}, '
+                                 f'"rows": {df.to_json( orient="records", date_format="iso" )}}}',
+                                 content_type="application/json" )
+
+        except Exception as ex:
+            _logger.exception( ex )
+            return JsonResponse( { 'status': 'error', 'error': str(ex) } )
@@ -3,14 +3,52 @@ import os
 import io
 import logging
 import time
+import multiprocessing
+import multiprocessing.connection
 import fastavro
 
 import django.db
 
 from elasticc2.models import PPDBAlert
 
+class AlertEncoder:
+    """Avro-encodes alerts with a schema that is loaded and parsed once.
+
+    encode_batch writes a whole batch of alerts into a single reused
+    buffer and then slices out the individual messages, rather than
+    making a new BytesIO for every alert.
+
+    """
+
+    def __init__( self, schemafile ):
+        self.schema = fastavro.parse_schema( fastavro.schema.load_schema( schemafile ) )
+        self.buffer = io.BytesIO()
+
+    def encode( self, alert ):
+        return self.encode_batch( [ alert ] )[0]
+
+    def encode_batch( self, alerts ):
+        """Returns a list of bytes, one for each alert dict in alerts."""
+        self.buffer.seek( 0 )
+        self.buffer.truncate()
+        offsets = [ 0 ]
+        for alert in alerts:
+            fastavro.write.schemaless_writer( self.buffer, self.schema, alert )
+            offsets.append( self.buffer.tell() )
+        with self.buffer.getbuffer() as view:
+            return [ bytes( view[ offsets[i] : offsets[i+1] ] ) for i in range( len(alerts) ) ]
+
+
 class AlertReconstructor():
-    def __init__( self, parent, pipe, schemafile ):
+    """Runs in a subprocess; reconstructs and avro-encodes batches of alerts.
+
+    Pulls { 'command': 'do', 'batchdex': <int>, 'alertids': <list> } or
+    { 'command': 'die' } off of workqueue, and sends the results back to
+    the parent through pipe.  See AlertReconstructorPool.
+
+    """
+
+    def __init__( self, parent, pipe, schemafile, workqueue ):
         self._getalerttime = 0
         self._reconstructtime = 0
         self._ddfreconstructtime = 0
@@ -20,7 +58,8 @@ class AlertReconstructor():
         self.limitedprevious = 30
 
         self.pipe = pipe
-        self.schema = fastavro.schema.load_schema( schemafile )
+        self.workqueue = workqueue
+        self.encoder = AlertEncoder( schemafile )
 
         self.logger = logging.getLogger( str( os.getpid() ) )
         self.logger.propagate = False
@@ -48,7 +87,6 @@ class AlertReconstructor():
         nextreconnect = 1000
         # ****
         nlongs = 0
-        nlongsddf = 0
         # ****
         while not done:
             try:
@@ -57,69 +95,58 @@ class AlertReconstructor():
                     nextreconnect += deltareconnect
                     django.db.connections.close_all()
 
-                msg = self.pipe.recv()
+                msg = self.workqueue.get()
                 if msg['command'] == 'die':
                     # self.logger.debug( f'Got die' )
                     done = True
                 elif msg['command'] == 'do':
-                    # self.logger.debug( f'Got do for alert dex {msg["alertdex"]}, id {msg["alert"].alert_id}' )
+                    # self.logger.debug( f'Got do for {len(msg["alertids"])} alerts' )
                     t0 = time.perf_counter()
-                    alertdex = msg['alertdex']
-                    alert = msg['alert']
-                    # alertid = msg['alertid']
-                    # alert = PPDBAlert.objects.get( pk=alertid )
+                    alertids = msg['alertids']
 
                     t1 = time.perf_counter()
-                    isddf = alert.diaobject.isddf
                     # self.logger.debug( "reconstructing" )
-                    fullalert = alert.reconstruct( daysprevious=self.fullprevious )
-                    if isddf:
-                        limitedalert = alert.reconstruct( daysprevious=self.limitedprevious )
+                    # Only go to the database once; the limited DDF
+                    # history is just a slice of the full history.
+                    fullalerts = PPDBAlert.bulk_reconstruct( alertids=alertids, daysprevious=self.fullprevious,
+                                                             withisddf=True )
+                    limitedalerts = [ PPDBAlert.limit_history( alert, self.limitedprevious )
+                                      for alert, isddf in fullalerts if isddf ]
                     # self.logger.debug( "done reconstructing" )
 
                     t2 = time.perf_counter()
 
                     # ****
-                    if ( nlongs < 5 ) or ( nlongsddf < 5 ):
-                        if ( t2 - t1 ) > 0.03:
-                            if ( not isddf ) and ( nlongs < 5 ):
-                                self.logger.info( f'source {alert.diasource_id} object {alert.diaobject_id}\n'
-                                                  f'took {1000*(t2-t1):.0f} ms' )
-                                nlongs += 1
-                            elif ( isddf ) and ( nlongsddf < 5 ):
-                                self.logger.info( f'DDF source {alert.diasource_id} object {alert.diaobject_id}\n'
-                                                  f'took {1000*(t2-t1):.0f} ms' )
-                                nlongsddf += 1
+                    if ( nlongs < 5 ) and ( len(alertids) > 0 ) and ( ( t2 - t1 ) / len(alertids) > 0.03 ):
+                        self.logger.info( f'batch of {len(alertids)} alerts ({len(limitedalerts)} DDF) '
+                                          f'took {1000*(t2-t1):.0f} ms' )
+                        nlongs += 1
                     # ****
 
-                    fullmsgio = io.BytesIO()
-                    fastavro.write.schemaless_writer( fullmsgio, self.schema, fullalert )
-                    fullmsg = fullmsgio.getvalue()
-                    if isddf:
-                        limitedmsgio = io.BytesIO()
-                        fastavro.write.schemaless_writer( limitedmsgio, self.schema, limitedalert )
-                        limitedmsg = limitedmsgio.getvalue()
-                    else:
-                        limitedmsg = None
+                    fullmsgs = self.encoder.encode_batch( [ alert for alert, isddf in fullalerts ] )
+                    limitedmsgs = iter( self.encoder.encode_batch( limitedalerts ) )
+                    produced = []
+                    for ( fullalert, isddf ), fullmsg in zip( fullalerts, fullmsgs ):
+                        produced.append( { 'alertid': fullalert['alertId'],
+                                           'isddf': isddf,
+                                           'fullhistory': fullmsg,
+                                           'limitedhistory': next( limitedmsgs ) if isddf else None } )
                     t3 = time.perf_counter()
 
                     self._getalerttime += t1 - t0
                     self._reconstructtime += t2 - t1
                     self._avrowritetime += t3 - t2
-                    if isddf:
-                        self._ddfreconstructtime += t2 - t1
-                        self._ddfavrowritetime += t3 - t2
-
-                    self.pipe.send( { 'response': 'alert produced',
-                                      'alertdex': alertdex,
-                                      'alertid': alert.alert_id,
-                                      'fullhistory': fullmsg,
-                                      'limitedhistory': limitedmsg
-                                     } )
+                    if len( limitedalerts ) > 0:
+                        self._ddfreconstructtime += ( t2 - t1 ) * len(limitedalerts) / len(alertids)
+                        self._ddfavrowritetime += ( t3 - t2 ) * len(limitedalerts) / len(alertids)
+
+                    self.pipe.send( { 'response': 'alerts produced',
+                                      'batchdex': msg['batchdex'],
+                                      'alerts': produced } )
+                    ndone += len( alertids )
                 else:
                     raise ValueError( f"Unknown message {msg['command']}" )
 
-                ndone += 1
             except Exception as ex:
                 # Should I be sending an error message back to the
                 # parent process instead of just raising?
@@ -141,8 +168,122 @@ class AlertReconstructor():
                           'PPDBAlert._ddfprvsourcetime': PPDBAlert._ddfprvsourcetime,
                           'PPDBAlert._prvforcedsourcetime': PPDBAlert._prvforcedsourcetime,
                           'PPDBAlert._ddfprvforcedsourcetime': PPDBAlert._ddfprvforcedsourcetime,
-                          'PPDBAlert._sourcetime': PPDBAlert._sourcetime,
+                          'PPDBAlert._bulkalerttime': PPDBAlert._bulkalerttime,
+                          'PPDBAlert._bulksourcetime': PPDBAlert._bulksourcetime,
+                          'PPDBAlert._bulkforcedsourcetime': PPDBAlert._bulkforcedsourcetime,
+                          'PPDBAlert._bulkassembletime': PPDBAlert._bulkassembletime,
                          } )
         # self.logger.debug( 'Exiting' )
 
 
+# ======================================================================
+
+class AlertReconstructorPool:
+    """A pool of AlertReconstructor subprocesses fed batches of alert ids.
+
+    Batches of alert ids go to the workers through a single shared
+    queue, so whichever worker is free next picks up the next batch.
+    Each worker sends its results back on its own pipe, and the parent
+    blocks on multiprocessing.connection.wait for those pipes rather
+    than polling.  No more than maxoutstanding batches are ever in
+    flight, so memory in the parent stays flat no matter how many alert
+    ids come out of the iterator passed to process().
+
+    IMPORTANT : call django.db.connections.close_all() before
+    constructing one of these, so that each subprocess opens its own
+    database connection.
+
+    """
+
+    def __init__( self, nprocs, schemafile, logger, maxoutstanding=None ):
+        self.logger = logger
+        self.maxoutstanding = 2 * nprocs if maxoutstanding is None else maxoutstanding
+        self.workqueue = multiprocessing.Queue( maxsize=self.maxoutstanding )
+        self.procinfo = {}
+
+        def launchReconstructor( pipe ):
+            reconstructor = AlertReconstructor( self, pipe, schemafile, self.workqueue )
+            reconstructor.go()
+
+        self.logger.info( f'Launching {nprocs} alert reconstruction subprocesses.' )
+        for i in range( nprocs ):
+            parentconn, childconn = multiprocessing.Pipe()
+            proc = multiprocessing.Process( target=lambda: launchReconstructor( childconn ), daemon=True )
+            proc.start()
+            self.procinfo[ proc.pid ] = { 'proc': proc,
+                                          'parentconn': parentconn,
+                                          'childconn': childconn }
+
+    @staticmethod
+    def chunk_alertids( queryset, batchsize ):
+        """Yield lists of (at most) batchsize alert ids from queryset, in the queryset's order.
+
+        Uses a server-side cursor, so the full list of ids is never in
+        memory at once.
+
+        """
+        batch = []
+        for alertid in queryset.values_list( 'alert_id', flat=True ).iterator( chunk_size=batchsize ):
+            batch.append( alertid )
+            if len( batch ) >= batchsize:
+                yield batch
+                batch = []
+        if len( batch ) > 0:
+            yield batch
+
+    def process( self, idbatches ):
+        """Reconstruct all alerts in idbatches (an iterable of lists of alert ids).
+
+        Yields lists of { 'alertid', 'isddf', 'fullhistory', 'limitedhistory' }
+        as the subprocesses produce them (so not necessarily in the order
+        the alert ids went in).
+
+        """
+        idbatches = iter( idbatches )
+        outstanding = {}
+        batchdex = 0
+        exhausted = False
+        conns = { info['parentconn']: pid for pid, info in self.procinfo.items() }
+
+        while True:
+            while ( not exhausted ) and ( len(outstanding) < self.maxoutstanding ):
+                try:
+                    batch = next( idbatches )
+                except StopIteration:
+                    exhausted = True
+                    break
+                self.workqueue.put( { 'command': 'do', 'batchdex': batchdex, 'alertids': batch } )
+                outstanding[ batchdex ] = len( batch )
+                batchdex += 1
+
+            if len( outstanding ) == 0:
+                return
+
+            for conn in multiprocessing.connection.wait( list( conns.keys() ) ):
+                try:
+                    msg = conn.recv()
+                except EOFError:
+                    raise RuntimeError( f"Alert reconstruction subprocess {conns[conn]} died" )
+                if ( 'response' not in msg ) or ( msg['response'] != 'alerts produced' ):
+                    raise ValueError( f"Unexpected response from child process: {msg}" )
+                if msg['batchdex'] not in outstanding:
+                    raise RuntimeError( f"Batch {msg['batchdex']} got processed more than once" )
+                del outstanding[ msg['batchdex'] ]
+                yield msg['alerts']
+
+    def close( self ):
+        """Tell all subprocesses to end; returns their timings, summed over subprocesses."""
+        for pid in self.procinfo.keys():
+            self.workqueue.put( { 'command': 'die' } )
+        subtimings = {}
+        for pid, proc in self.procinfo.items():
+            msg = proc['parentconn'].recv()
+            for key, val in msg.items():
+                if key != 'response':
+                    if key not in subtimings:
+                        subtimings[key] = val
+                    else:
+                        subtimings[key] += val
+        for pid, proc in self.procinfo.items():
+            proc['proc'].join()
+        return subtimings
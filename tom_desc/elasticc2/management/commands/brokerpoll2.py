@@ -74,6 +74,23 @@ class Command(BaseCommand):
         parser.add_argument( '-g', '--grouptag', default=None, help="Tag to add to end of kafka group ids" )
         parser.add_argument( '-r', '--reset', default=False, action='store_true',
                              help='Reset all stream pointers' )
+        parser.add_argument( '--manual-commit', default=False, action='store_true',
+                             help=( 'Turn off kafka auto commit; commit offsets only after a batch of '
+                                    'messages has been saved' ) )
+        parser.add_argument( '--consume-nmsgs', type=int, default=1000,
+                             help='Number of messages to consume from kafka at once (default 1000)' )
+        parser.add_argument( '--max-consume-nmsgs', type=int, default=None,
+                             help=( 'If given, consume up to this many messages at once when the consumer '
+                                    'is falling behind (default: always use --consume-nmsgs)' ) )
+        parser.add_argument( '--max-batch-bytes', type=int, default=None,
+                             help='Never grow batches past (about) this many bytes of messages' )
+        parser.add_argument( '--decode-workers', type=int, default=0,
+                             help=( 'Decode messages in this many processes per broker, and save them in a '
+                                    'separate thread, committing kafka offsets only after saving '
+                                    '(default 0: decode and save serially in the polling thread)' ) )
+        parser.add_argument( '--decode-queue-depth', type=int, default=None,
+                             help=( 'Maximum number of message batches waiting to be saved when using '
+                                    '--decode-workers (default: 2×decode-workers)' ) )
 
     def sigterm( self, sig="TERM" ):
         self.logger.warning( f"Got a {sig} signal, trying to die." )
@@ -160,6 +177,12 @@ class Command(BaseCommand):
                             else:
                                 self.logger.debug( f"Got heartbeat from {name}" )
                                 broker['lastheartbeat'] = time.monotonic()
+                                if 'lag' in msg:
+                                    lagstr = ", ".join( f"{topic}[{part}]={n}"
+                                                        for topic, parts in msg['lag'].items()
+                                                        for part, n in parts.items() )
+                                    self.logger.info( f"{name} consumer lag {msg['totlag']} "
+                                                      f"(batch size {msg['batchsize']}): {lagstr}" )
                     except Exception as ex:
                         self.logger.error( f"Got exception listening for heartbeat from {name}; will restart." )
                         brokerstorestart.add( name )
@@ -4,7 +4,6 @@ import time
 import pathlib
 import tarfile
 import logging
-import multiprocessing
 
 import django.db
 from django.core.management.base import BaseCommand, CommandError
@@ -13,7 +12,7 @@ import elasticc2.models
 
 _rundir = pathlib.Path(__file__).parent
 sys.path.insert(0, str(_rundir) )
-from _alertreconstructor import AlertReconstructor
+from _alertreconstructor import AlertReconstructorPool
 
 class Command(BaseCommand):
     help="Dump ELAsTiCC2 alerts to tar files"
@@ -44,6 +43,8 @@ class Command(BaseCommand):
                              help="Log alerts saved at this interval; 0=don't log" )
         parser.add_argument( '-n', '--num-reconstruct-processes', default=3, type=int,
                              help="Run this many alert reconstruction subprocesses (default 3)" )
+        parser.add_argument( '-b', '--batch-size', default=100, type=int,
+                             help="Send this many alerts at a time to each reconstruction subprocess (default 100)" )
         parser.add_argument( '-o', '--outdir', default='.', help="Directory to write output files." )
         parser.add_argument( '-g', '--gentype', type=int, default=None,
                              help="Only write objects with this gentype (default: write all)" )
@@ -66,22 +67,7 @@ class Command(BaseCommand):
         # connections so that there aren't any cached ones.
         django.db.connections.close_all()
 
-        def launchReconstructor( pipe ):
-            reconstructor = AlertReconstructor( self, pipe, options['alert_schema'] )
-            reconstructor.go()
-
-        procinfo = {}
-        freeprocs = set()
-        busyprocs = set()
-        self.logger.info( f'Launching {options["num_reconstruct_processes"]} alert reconstruction subprocesses.' )
-        for i in range( options['num_reconstruct_processes'] ):
-            parentconn, childconn = multiprocessing.Pipe()
-            proc = multiprocessing.Process( target=lambda: launchReconstructor( childconn ), daemon=True )
-            proc.start()
-            procinfo[ proc.pid ] = { 'proc': proc,
-                                     'parentconn': parentconn,
-                                     'childconn': childconn }
-            freeprocs.add( proc.pid )
+        pool = AlertReconstructorPool( options['num_reconstruct_processes'], options['alert_schema'], self.logger )
 
         outdir = pathlib.Path( options['outdir'] )
         outdir.mkdir( exist_ok=True, parents=True )
@@ -93,7 +79,8 @@ class Command(BaseCommand):
                        .filter( diasource__midpointtai__gte=mjd )
                        .filter( diasource__midpointtai__lt=mjd+1 )
                        .order_by( 'diasource__midpointtai' ) )
-            if len(alerts) == 0:
+            nalerts = alerts.count()
+            if nalerts == 0:
                 continue
 
             tarpath = outdir / f'{mjd}.tar'
@@ -105,63 +92,35 @@ class Command(BaseCommand):
                         tarpath.unlink()
                     else:
                         raise FileExistsError( f"Can't create {tarpath.resolve()}, it already exists." )
-                self.logger.info( f"Dumping {alerts.count()} alerts for MJD {mjd} to {tarpath}" )
+                self.logger.info( f"Dumping {nalerts} alerts for MJD {mjd} to {tarpath}" )
                 tarobj = tarfile.TarFile( tarpath, mode='w' )
             else:
-                self.logger.info( f"Simuilating dumping {alerts.count()} alerts for MJD {mjd} to {tarpath} "
+                self.logger.info( f"Simuilating dumping {nalerts} alerts for MJD {mjd} to {tarpath} "
                                   f"(but not really writing anything)." )
 
 
-            alerts = alerts.all()
-
-            alertdex = 0
+            ndone = 0
             nextlog = 0
-            donealerts = set()
-            while ( alertdex < len(alerts) ) or ( len(busyprocs) > 0 ):
-                if ( options['log_every'] > 0 ) and ( alertdex >= nextlog ):
-                    self.logger.info( f"Have saved {alertdex} of {len(alerts)} for MJD {mjd}" )
-                    nextlog += options['log_every']
-
-                # Submit alerts to any free process
-                while ( alertdex < len(alerts) ) and ( len(freeprocs) > 0 ):
-                    pid = freeprocs.pop()
-                    busyprocs.add( pid )
-                    procinfo[pid]['parentconn'].send( { 'command': 'do',
-                                                        'alertdex': alertdex,
-                                                        'alert': alerts[alertdex] } )
-                    alertdex += 1
-
-                # Check for response from busy procsses
-                doneprocs = set()
-                for pid in busyprocs:
-                    if not procinfo[pid]['parentconn'].poll():
-                        continue
-                    doneprocs.add( pid )
-
-                    msg = procinfo[pid]['parentconn'].recv()
-                    if ( 'response' not in msg ) or ( msg['response'] != 'alert produced' ):
-                        raise ValueError( f"Unexpected response from child process: {msg}" )
-
-                    alertid = msg['alertid']
-                    respalertdex = msg['alertdex']
-                    if alertid in donealerts:
-                        raise RuntimeError( f'{msg["alertid"]} got processed more than once' )
-                    donealerts.add( alertid )
-
-                    if options['do']:
-                        arcname = f'{alertid}.avro'
-                        with io.BytesIO( msg['fullhistory'] ) as bio:
+            for produced in pool.process( AlertReconstructorPool.chunk_alertids( alerts, options['batch_size'] ) ):
+                if options['do']:
+                    for alert in produced:
+                        arcname = f'{alert["alertid"]}.avro'
+                        with io.BytesIO( alert['fullhistory'] ) as bio:
                             ti = tarfile.TarInfo( name=arcname )
                             ti.size = bio.getbuffer().nbytes
                             ti.mtime = now
                             ti.mode = 0o664
                             tarobj.addfile( ti, bio )
 
-                for pid in doneprocs:
-                    busyprocs.remove( pid )
-                    freeprocs.add( pid )
+                ndone += len( produced )
+                if ( options['log_every'] > 0 ) and ( ndone >= nextlog ):
+                    self.logger.info( f"Have saved {ndone} of {nalerts} for MJD {mjd}" )
+                    nextlog += options['log_every']
+
+            if tarobj is not None:
+                tarobj.close()
 
-            tarobj.close()
+        pool.close()
 
         self.logger.info( "All done." )
 
@@ -115,7 +115,8 @@ class FITSFileHandler( ColumnMapper ):
 
         # Copy settings from parent
         for attr in [ 'simversion', 'max_sources_per_object', 'photflag_detect',
-                      'snana_zeropoint', 'alert_zeropoint', 'really_do', 'verbose', 'tableset' ]:
+                      'snana_zeropoint', 'alert_zeropoint', 'really_do', 'verbose', 'tableset',
+                      'direct_copy' ]:
             setattr( self, attr, getattr( parent, attr ) )
 
         self.logger = logging.getLogger( f"logger {os.getpid()}" )
@@ -148,6 +149,87 @@ class FITSFileHandler( ColumnMapper ):
             except EOFError:
                 done = True
 
+    def build_tables( self, orig_head, phot, headname='HEAD file' ):
+        """Turn the contents of a HEAD and a PHOT file into rows for the database tables.
+
+        orig_head and phot are astropy Tables as read from the files
+        (with SNID already converted to int64).  Everything is done with
+        whole-column numpy operations; there are no per-object or per-row
+        python loops, because those used to dominate the time it took to
+        load a file.
+
+        Returns head, forced, sources, alerts.  The first three are
+        astropy Tables with columns for the DiaObject, DiaForcedSource,
+        and DiaSource tables; alerts is a dict of columns for the Alert
+        table.
+
+        """
+        head = Table( orig_head )
+        self.diaobject_map_columns( head )
+        head.add_column( self.simversion, name='simversion' )
+
+        # All the -1 is because the files are 1-indexed, but numpy is 0-indexed
+        pmin = numpy.asarray( orig_head['PTROBS_MIN'], dtype=numpy.int64 ) - 1
+        pmax = numpy.asarray( orig_head['PTROBS_MAX'], dtype=numpy.int64 ) - 1
+        nobs = numpy.maximum( pmax - pmin + 1, 0 )
+
+        toomany = nobs > self.max_sources_per_object
+        if toomany.any():
+            dex = numpy.argmax( toomany )
+            self.logger.error( f'SNID {orig_head["SNID"][dex]} in {headname} has {nobs[dex]} sources, '
+                               f'which is more than max_sources_per_object={self.max_sources_per_object}' )
+            raise RuntimeError( "Too many sources" )
+
+        # Figure out which objects are "DDF" objects
+        # The right criterion for DDF isn't obvious
+        # Practically speaking, the issue was alerts
+        # with way too much photometry in them.  So,
+        # limit based on the total count.
+        head['isddf'] = nobs > 1000
+
+        # Another option would be to look at the
+        # maximum (or mean) number of observations
+        # in a single day.  (The 0.625 offsets
+        # to noon Chile time to divide nights.)
+        # mjds = numpy.floor( phot['MJD'][pmin:pmax+1] - 0.625 ).astype( numpy.int64 )
+        # hist, histbin = numpy.histogram( mjds, bins=range( mjds[0], mjds[-1]+1 ) )
+        # hist = hist[ hist > 0 ]
+        # if ( hist.mean() >= 10 ) or ( hist.max() >= 30 ):
+        #     row['isddf'] = True
+
+        # For every forced source, objdex is the index into orig_head of its
+        # object, and offset is where it is in that object's photometry.
+        objdex = numpy.repeat( numpy.arange( len(orig_head) ), nobs )
+        offset = numpy.arange( len(objdex) ) - numpy.repeat( numpy.cumsum( nobs ) - nobs, nobs )
+
+        # Pulling out just the rows that belong to objects also gets rid of
+        # the separator rows in the phot table.
+        phot = phot[ pmin[ objdex ] + offset ]
+
+        # Calculate some derived fields we'll need
+
+        phot['FLUXCAL'] *= 10 ** ( ( self.alert_zeropoint - self.snana_zeropoint ) / 2.5 )
+        phot['FLUXCALERR'] *= 10 ** ( ( self.alert_zeropoint - self.snana_zeropoint ) / 2.5 )
+
+        self.diasource_map_columns( phot )
+        snid = numpy.asarray( orig_head['SNID'], dtype=numpy.int64 )[ objdex ]
+        phot['diaobject_id'] = snid
+        phot['diaforcedsource_id'] = snid * self.max_sources_per_object + offset
+        phot['snr'] = phot['psflux'] / phot['psfluxerr']
+        # (The FITS column is bytes; the database wants str)
+        phot['filtername'] = numpy.char.strip( numpy.asarray( phot['filtername'] ).astype( str ) )
+        phot['ra'] = numpy.asarray( orig_head['RA'], dtype=numpy.float64 )[ objdex ]
+        phot['decl'] = numpy.asarray( orig_head['DEC'], dtype=numpy.float64 )[ objdex ]
+
+        sources = phot[ ( phot['photflag'] & self.photflag_detect ) != 0 ]
+        sources.rename_column( 'diaforcedsource_id', 'diasource_id' )
+
+        alerts = { 'alert_id': sources[ 'diasource_id' ],
+                   'diasource_id': sources[ 'diasource_id' ],
+                   'diaobject_id': sources[ 'diaobject_id' ] }
+
+        return head, phot, sources, alerts
+
     def load_one_file( self, headfile, photfile ):
         try:
             if self.tableset == 'ppdb':
@@ -168,81 +250,27 @@ class FITSFileHandler( ColumnMapper ):
             orig_head = Table.read( headfile )
             # SNID was written as a string, we need it to be a bigint
             orig_head['SNID'] = orig_head['SNID'].astype( numpy.int64 )
-            head = Table( orig_head )
 
-            if len(head) == 0:
+            if len(orig_head) == 0:
                 return { 'ok': True, 'msg': '0-length headfile' }
 
             phot = Table.read( photfile )
 
-            # Load the DiaObject table
+            head, phot, sources, alerts = self.build_tables( orig_head, phot, headfile.name )
 
-            self.diaobject_map_columns( head )
-            head.add_column( self.simversion, name='simversion' )
-            head.add_column( False, name='isddf' )
-
-            # Figure out which objects are "DDF" objects
-            for origrow, row in zip( orig_head, head ):
-                pmin = origrow['PTROBS_MIN'] - 1
-                pmax = origrow['PTROBS_MAX'] - 1
-                # The right criterion for DDF isn't obvious
-                # Practically speaking, the issue was alerts
-                # with way too much photometry in them.  So,
-                # limit based on the total count.
-                if ( pmax + 1 - pmin ) > 1000:
-                    row['isddf'] = True
-
-                # Another option would be to look at the
-                # maximum (or mean) number of observations
-                # in a single day.  (The 0.625 offsets
-                # to noon Chile time to divide nights.)
-                # mjds = numpy.floor( phot['MJD'][pmin:pmax+1] - 0.625 ).astype( numpy.int64 )
-                # hist, histbin = numpy.histogram( mjds, bins=range( mjds[0], mjds[-1]+1 ) )
-                # hist = hist[ hist > 0 ]
-                # if ( hist.mean() >= 10 ) or ( hist.max() >= 30 ):
-                #     row['isddf'] = True
+            # Load the DiaObject table
 
             if self.really_do:
-                nobj = DiaObject.bulk_insert_onlynew( dict( head ) )
+                nobj = DiaObject.bulk_insert_onlynew( dict( head ), direct=self.direct_copy )
                 self.logger.info( f"PID {os.getpid()} loaded {nobj} objects from {headfile.name}" )
             else:
                 nobj = len(head)
                 self.logger.info( f"PID {os.getpid()} would try to load {nobj} objects" )
 
-            # Calculate some derived fields we'll need
-
-            phot['FLUXCAL'] *= 10 ** ( ( self.alert_zeropoint - self.snana_zeropoint ) / 2.5 )
-            phot['FLUXCALERR'] *= 10 ** ( ( self.alert_zeropoint - self.snana_zeropoint ) / 2.5 )
-
-            self.diasource_map_columns( phot )
-            phot.add_column( numpy.int64(-1), name='diaobject_id' )
-            phot.add_column( numpy.int64(-1), name='diaforcedsource_id' )
-            phot['snr'] = phot['psflux'] / phot['psfluxerr']
-            phot['filtername'] = [ i.strip() for i in phot['filtername'] ]
-            phot.add_column( -999., name='ra' )
-            phot.add_column( -999., name='decl' )
-
             # Load the DiaForcedSource table
 
-            for obj in orig_head:
-                # All the -1 is because the files are 1-indexed, but astropy is 0-indexed
-                pmin = obj['PTROBS_MIN'] -1
-                pmax = obj['PTROBS_MAX'] -1
-                if ( pmax - pmin + 1 ) > self.max_sources_per_object:
-                    self.logger.error( f'SNID {obj["SNID"]} in {headfile.name} has {pmax-mpin+1} sources, '
-                                       f'which is more than max_sources_per_object={self.max_sources_per_object}' )
-                    raise RuntimeError( "Too many sources" )
-                phot['diaobject_id'][pmin:pmax+1] = obj['SNID']
-                phot['diaforcedsource_id'][pmin:pmax+1] = ( obj['SNID'] * self.max_sources_per_object
-                                                            + numpy.arange( pmax - pmin + 1 ) )
-                phot['ra'][pmin:pmax+1] = obj['RA']
-                phot['decl'][pmin:pmax+1] = obj['DEC']
-
-            # The phot table has separators, so there will still be some junk data in there I need to purge
-            phot = phot[ phot['diaobject_id'] >= 0 ]
-
             if self.really_do:
-                nfrc = DiaForcedSource.bulk_insert_onlynew( phot )
+                nfrc = DiaForcedSource.bulk_insert_onlynew( phot, direct=self.direct_copy )
                 self.logger.info( f"PID {os.getpid()} loaded {nfrc} forced photometry points from {photfile.name}" )
             else:
                 nfrc = len(phot)
@@ -250,23 +278,17 @@ class FITSFileHandler( ColumnMapper ):
 
             # Load the DiaSource table
 
-            phot.rename_column( 'diaforcedsource_id', 'diasource_id' )
-            phot = phot[ ( phot['photflag'] & self.photflag_detect ) !=0 ]
-
             if self.really_do:
-                nsrc = DiaSource.bulk_insert_onlynew( phot )
+                nsrc = DiaSource.bulk_insert_onlynew( sources, direct=self.direct_copy )
                 self.logger.info( f"PID {os.getpid()} loaded {nsrc} sources from {photfile.name}" )
             else:
-                nsrc = len(phot)
+                nsrc = len(sources)
                 self.logger.info( f"PID {os.getpid()} would try to load {nsrc} sources" )
 
-            # Load the alert table based on this
+            # Load the alert table
 
-            alerts = { 'alert_id': phot[ 'diasource_id' ],
-                       'diasource_id': phot[ 'diasource_id' ],
-                       'diaobject_id': phot[ 'diaobject_id' ] }
             if self.really_do:
-                nalrt = Alert.bulk_insert_onlynew( alerts )
+                nalrt = Alert.bulk_insert_onlynew( alerts, direct=self.direct_copy )
                 self.logger.info( f"PID {os.getpid()} loaded {nalrt} alerts" )
             else:
                 nalrt = len(alerts['alert_id'])
@@ -284,7 +306,8 @@ class FITSLoader( ColumnMapper ):
     def __init__( self, nprocs, directories, files=[], simversion='2023-04-01',
                   max_sources_per_object=100000, photflag_detect=4096,
                   snana_zeropoint=27.5, alert_zeropoint=31.4, tableset='ppdb',
-                  really_do=False, verbose=False, logger=logging.getLogger( "load_snana_fits") ):
+                  really_do=False, verbose=False, direct_copy=False,
+                  logger=logging.getLogger( "load_snana_fits") ):
 
         if tableset not in [ 'ppdb', 'training' ]:
             raise ValueError( f'tableset must be one of ppdb, training, not {tableset}' )
@@ -302,6 +325,11 @@ class FITSLoader( ColumnMapper ):
         self.logger = logger
         self.sublogger = None
         self.verbose = verbose
+        # Whether to COPY straight into the tables rather than through a
+        # temp table and INSERT ... ON CONFLICT DO NOTHING.  Only safe when
+        # the primary keys have been dropped (disable_indexes_and_fks), at
+        # which point there's nothing to conflict with anyway.
+        self.direct_copy = direct_copy
 
     def disable_indexes_and_fks( self ):
         # Disable all indexes and foreign keys on the relevant
@@ -630,6 +658,7 @@ class Command(BaseCommand):
                                  snana_zeropoint=options['snana_zeropoint'],
                                  alert_zeropoint=options['alert_zeropoint'],
                                  really_do=options['do'],
+                                 direct_copy=not options['dont_disable_indexes_fks'],
                                  verbose=options['verbose'] )
 
         # Disable indexes and foreign keys
@@ -8,7 +8,6 @@ import logging
 import json
 import time
 import datetime
-import multiprocessing
 import signal
 import queue
 import confluent_kafka
@@ -18,12 +17,11 @@ from django.core.management.base import BaseCommand, CommandError
 from django_extensions.management.signals import post_command
 from django_extensions.management.utils import signalcommand
 import django.db
-from django.db import transaction
 from elasticc2.models import PPDBAlert
 
 _rundir = pathlib.Path(__file__).parent
 sys.path.insert(0, str(_rundir) )
-from _alertreconstructor import AlertReconstructor
+from _alertreconstructor import AlertReconstructorPool
 
 class Command(BaseCommand):
     help = 'Send ELAsTiCC2 Alerts'
@@ -78,15 +76,15 @@ class Command(BaseCommand):
                                     "if this file exists." ) )
         parser.add_argument( '-n', '--num-reconstruct-processes', default=3, type=int,
                              help="Run this many alert reconstruction subprocesses (default 3)" )
+        parser.add_argument( '-b', '--batch-size', default=100, type=int,
+                             help="Send this many alerts at a time to each reconstruction subprocess (default 100)" )
         parser.add_argument( '--do', action='store_true', default=False,
                              help="Actually do it (otherwise, it's a dry run)" )
 
-    @transaction.atomic
     def update_alertsent( self, ids ):
-        sentalerts = PPDBAlert.objects.filter( pk__in=ids )
-        for sa in sentalerts:
-            sa.alertsenttimestamp = datetime.datetime.now( datetime.timezone.utc )
-            sa.save()
+        nupdated = PPDBAlert.mark_sent( ids )
+        if nupdated != len( ids ):
+            self.logger.warning( f"Tried to mark {len(ids)} alerts as sent, but only updated {nupdated}" )
 
     def interruptor( self, signum, frame ):
         self.logger.error( "Got an interrupt signal, cleaning up and existing." )
@@ -99,7 +97,7 @@ class Command(BaseCommand):
         # yelled at me to call terminate()
         # before close()... and... yet...
         # I just give up.
-        # for key, val in self.procinfo.items():
+        # for key, val in self.pool.procinfo.items():
         #     val['proc'].terminate()
         #     val['proc'].close()
         # for subproc in multiprocessing.active_children():
@@ -137,7 +135,7 @@ class Command(BaseCommand):
         # signal.signal( signal.SIGINT, lambda signum, frame: self.interruptor( signum, frame ) )
         # signal.signal( signal.SIGTERM, lambda signum, frame: self.interruptor( signum, frame ) )
 
-        self.procinfo = {}
+        self.pool = None
         try:
             with open( self.runningfile, "w" ) as ofp:
                 ofp.write( f"{datetime.datetime.now().isoformat()} on host {socket.gethostname()}\n" )
@@ -186,13 +184,13 @@ class Command(BaseCommand):
                        .filter( alertsenttimestamp__isnull=True, diasource__midpointtai__lte=through_day ) )
             if start_t is not None:
                 alerts = alerts.filter( diasource__midpointtai__gte=start_t )
-            alerts = alerts.order_by( 'diasource__midpointtai' )
-            self.logger.info( f"{alerts.count()} alerts to stream" )
+            alerts = alerts.order_by( 'diasource__midpointtai', 'alert_id' )
+            nalerts = alerts.count()
+            self.logger.info( f"{nalerts} alerts to stream" )
 
-            if alerts.count() == 0:
+            if nalerts == 0:
                 self.logger.info( "No alerts found, exiting." )
                 return
-            alerts = alerts.all()
 
             self.logger.info( "**** streaming starting ****" )
             self.logger.info( f"Streaming to {options['kafka_server']} topics "
@@ -207,6 +205,7 @@ class Command(BaseCommand):
             totflushed = 0
             nextlog = 0
             nddf = 0
+            ndone = 0
             _tottime = 0
             _commtime = 0
             _flushtime = 0
@@ -219,10 +218,6 @@ class Command(BaseCommand):
             # connections so that there aren't any cached ones.
             django.db.connections.close_all()
 
-            def launchReconstructor( pipe ):
-                reconstructor = AlertReconstructor( self, pipe, options['alert_schema'] )
-                reconstructor.go()
-
             if options[ 'do' ]:
                 with open( starttimefile, "w" ) as ofp:
                     ofp.write( datetime.datetime.now().isoformat( ' ', timespec='seconds' ) )
@@ -230,28 +225,50 @@ class Command(BaseCommand):
                 flushedupdatetimefile.unlink( missing_ok=True )
                 flushednumfile.unlink( missing_ok=True )
 
-            freeprocs = set()
-            busyprocs = set()
-            donealerts = set()
             ids_produced = []
-            self.logger.info( f'Launching {options["num_reconstruct_processes"]} alert reconstruction subprocesses.' )
-            for i in range( options['num_reconstruct_processes'] ):
-                parentconn, childconn = multiprocessing.Pipe()
-                proc = multiprocessing.Process( target=lambda: launchReconstructor( childconn ), daemon=True )
-                proc.start()
-                self.procinfo[ proc.pid ] = { 'proc': proc,
-                                              'parentconn': parentconn,
-                                              'childconn': childconn }
-                freeprocs.add( proc.pid )
-
-            alertdex = 0
-            nextlog = 0
-            while ( alertdex < len(alerts) ) or ( len(busyprocs) > 0 ):
-                # if ( alertdex >= len(alerts) ):
-                #     self.logger.debug( "Waiting on {len(busyprocs)} busy processes" )
-                #     time.sleep(1)
-                if ( options['log_every'] > 0 ) and ( alertdex >= nextlog ):
-                    self.logger.info( f"Have started {alertdex} of {len(alerts)} alerts, {totflushed} flushed." )
+            self.pool = AlertReconstructorPool( options['num_reconstruct_processes'], options['alert_schema'],
+                                                self.logger )
+
+            # The alert ids come out of a server-side cursor a batch at
+            # a time, and the pool never has more than a few batches
+            # in flight, so we never hold the whole night in memory.
+            idbatches = AlertReconstructorPool.chunk_alertids( alerts, options['batch_size'] )
+            t0 = time.perf_counter()
+            for produced in self.pool.process( idbatches ):
+                _commtime += time.perf_counter() - t0
+
+                for alert in produced:
+                    if alert['isddf']:
+                        nddf += 1
+                    if options['do']:
+                        t0 = time.perf_counter()
+                        if alert['isddf']:
+                            producer.produce( options['ddf_full_topic'], alert['fullhistory'] )
+                            producer.produce( options['ddf_limited_topic'], alert['limitedhistory'] )
+                        else:
+                            producer.produce( options['wfd_topic'], alert['fullhistory'] )
+                        ids_produced.append( alert['alertid'] )
+                        _producetime += time.perf_counter() - t0
+                ndone += len( produced )
+
+                if len(ids_produced) >= options['flush_every']:
+                    if options['do']:
+                        t0 = time.perf_counter()
+                        producer.flush()
+                        totflushed += len( ids_produced )
+                        t1 = time.perf_counter()
+                        self.update_alertsent( ids_produced )
+                        t2 = time.perf_counter()
+                        _flushtime += t1 - t0
+                        _updatealertsenttime += t2 - t1
+                        with open( flushednumfile, "w" ) as ofp:
+                            ofp.write( str(totflushed) )
+                        with open( flushedupdatetimefile, "w" ) as ofp:
+                            ofp.write( datetime.datetime.now().isoformat( ' ', timespec='seconds' ) )
+                    ids_produced = []
+
+                if ( options['log_every'] > 0 ) and ( ndone >= nextlog ):
+                    self.logger.info( f"Have produced {ndone} of {nalerts} alerts, {totflushed} flushed." )
                     self.logger.info( f"    Timings: overall {time.perf_counter() - overall_t0}\n"
                                       f"                    _commtime : {_commtime}\n"
                                       f"                   _flushtime : {_flushtime}\n"
@@ -259,77 +276,7 @@ class Command(BaseCommand):
                                       f"         _updatealertsenttime : {_updatealertsenttime}\n" )
                     nextlog += options['log_every']
 
-                # Submit alerts to any free processes
                 t0 = time.perf_counter()
-                # self.logger.debug( f"Sending work to {len(freeprocs)} free processes." )
-                while ( alertdex < len(alerts) ) and ( len(freeprocs) > 0 ):
-                    pid = freeprocs.pop()
-                    busyprocs.add( pid )
-                    # self.logger.debug( f"Sending alert dex {alertdex}, id {alerts[alertdex].alert_id} "
-                    #                    f"to process {pid}" )
-                    self.procinfo[pid]['parentconn'].send( { 'command': 'do',
-                                                             'alertdex': alertdex,
-                                                             'alert': alerts[alertdex] } )
-                    if alerts[alertdex].diaobject.isddf:
-                        nddf += 1
-                    alertdex += 1
-                _commtime += time.perf_counter() - t0
-
-                # Check for response from busy processes
-                # self.logger.debug( f'Checking {len(busyprocs)} busy processes for responses.' )
-                doneprocs = set()
-                for pid in busyprocs:
-                    t0 = time.perf_counter()
-                    if not self.procinfo[pid]['parentconn'].poll():
-                        continue
-                    doneprocs.add( pid )
-
-                    msg = self.procinfo[pid]['parentconn'].recv()
-                    if ( 'response' not in msg ) or ( msg['response'] != 'alert produced' ):
-                        raise ValueError( f"Unexpected response from child process: {msg}" )
-                    # self.logger.debug( f"Got response from {pid} for alertdex {msg['alertdex']}" )
-
-                    alertid = msg['alertid']
-                    respalertdex = msg['alertdex']
-                    if alertid in donealerts:
-                        raise RuntimeError( f'{msg["alertid"]} got processed more than once' )
-                    donealerts.add( alertid )
-                    _commtime += time.perf_counter() - t0
-
-                    if options['do']:
-                        t0 = time.perf_counter()
-                        if alerts[respalertdex].diaobject.isddf:
-                            producer.produce( options['ddf_full_topic'], msg['fullhistory'] )
-                            producer.produce( options['ddf_limited_topic'], msg['limitedhistory'] )
-                        else:
-                            producer.produce( options['wfd_topic'], msg['fullhistory'] )
-                        ids_produced.append( alertid )
-                        _producetime += time.perf_counter() - t0
-
-                    if len(ids_produced) >= options['flush_every']:
-                        if options['do']:
-                            t0 = time.perf_counter()
-                            producer.flush()
-                            totflushed += len( ids_produced )
-                            t1 = time.perf_counter()
-                            self.update_alertsent( ids_produced )
-                            t2 = time.perf_counter()
-                            _flushtime += t1 - t0
-                            _updatealertsenttime += t2 - t1
-                            with open( flushednumfile, "w" ) as ofp:
-                                ofp.write( str(totflushed) )
-                            with open( flushedupdatetimefile, "w" ) as ofp:
-                                ofp.write( datetime.datetime.now().isoformat( ' ', timespec='seconds' ) )
-                        ids_produced = []
-
-                # self.logger.debug( f"{len(doneprocs)} finished, adding them back to freeprocs" )
-                # ****
-                # if len(doneprocs) == 0:
-                #     time.sleep(1)
-                # ****
-                for pid in doneprocs:
-                    busyprocs.remove( pid )
-                    freeprocs.add( pid )
 
             if len(ids_produced) > 0:
                 if options['do']:
@@ -349,26 +296,20 @@ class Command(BaseCommand):
                 ids_produced = []
 
             # Tell all subprocesses to end
-            subtimings = {}
-            for pid, proc in self.procinfo.items():
-                proc['parentconn'].send( { 'command': 'die' } )
-                msg = proc['parentconn'].recv()
-                for key, val in msg.items():
-                    if key != 'response':
-                        if key not in subtimings:
-                            subtimings[key] = val
-                        else:
-                            subtimings[key] += val
+            subtimings = self.pool.close()
 
             _tottime += time.perf_counter() - overall_t0
 
-            self.logger.info( f"**** Done sending {len(alerts)} alerts (incl. {nddf} DDF); {totflushed} flushed ****" )
+            self.logger.info( f"**** Done sending {ndone} alerts (incl. {nddf} DDF); {totflushed} flushed ****" )
             strio = io.StringIO()
             strio.write( f"Timings: overall {_tottime}\n"
                          f"                _commtime : {_commtime}\n"
                          f"               _flushtime : {_flushtime}\n"
                          f"             _producetime : {_producetime}\n"
                          f"     _updatealertsenttime : {_updatealertsenttime}\n"
+                         f"       ...per 1000 alerts : "
+                         f"{1000 * _updatealertsenttime / totflushed if totflushed > 0 else 0}\n"
+                         f"  PPDBAlert._marksenttime : {PPDBAlert._marksenttime}\n"
                          f"                      Sum over subprocesses:\n"
                          f"                      ----------------------\n" )
             for key,  val in subtimings.items():
@@ -14,7 +14,6 @@ import confluent_kafka
 import fastavro
 
 from django.core.management.base import BaseCommand, CommandError
-from django.db import transaction
 from elasticc2.models import TrainingAlert, TrainingDiaObject, TrainingDiaSource, TrainingDiaForcedSource
 from elasticc2.models import ClassIdOfGentype, TrainingDiaObjectTruth
 
@@ -57,12 +56,10 @@ class Command(BaseCommand):
         parser.add_argument( '--stop-after', default=None, type=int,
                              help="Stop after this many alerts (for testing purposes)" )
 
-    @transaction.atomic
     def update_alertsent( self, ids ):
-        sentalerts = TrainingAlert.objects.filter( pk__in=ids )
-        for sa in sentalerts:
-            sa.alertsenttimestamp = datetime.datetime.now( datetime.timezone.utc )
-            sa.save()
+        nupdated = TrainingAlert.mark_sent( ids )
+        if nupdated != len( ids ):
+            self.logger.warning( f"Tried to mark {len(ids)} alerts as sent, but only updated {nupdated}" )
         
     def handle( self, *args, **options ):
 
@@ -1,15 +1,21 @@
 import sys
+import os
 import re
+import time
+import json
 import pathlib
 import datetime
 import logging
 import random
+import multiprocessing
+import multiprocessing.connection
 import psycopg2
 import psycopg2.extras
 import django.db
 from django.core.management.base import BaseCommand, CommandError
 from elasticc2.models import PPDBDiaObject, PPDBDiaSource, PPDBDiaForcedSource
 from elasticc2.models import DiaObject, DiaSource, DiaForcedSource, BrokerSourceIds, DiaObjectOfTarget
+from db.models import QueryResultCache
 
 _rundir = pathlib.Path(__file__).parent
 
@@ -22,6 +28,229 @@ _formatter = logging.Formatter( f'[%(asctime)s - %(levelname)s] - %(message)s',
 _logout.setFormatter( _formatter )
 _logger.setLevel( logging.INFO )
 
+
+def _stage( cursor, stages, description, query, subdict=None, logger=_logger ):
+    """Run one stage of the import, recording how long it took and how many rows it hit in stages."""
+    logger.debug( description )
+    t0 = time.perf_counter()
+    cursor.execute( query, subdict )
+    dt = time.perf_counter() - t0
+    rows = cursor.rowcount if cursor.rowcount >= 0 else None
+    stages.append( { 'stage': description, 'seconds': dt, 'rows': rows } )
+    logger.debug( f"...{description} took {dt:.2f} s ({rows} rows)" )
+
+
+class ChunkWorker:
+    """Runs in a subprocess; imports chunks of objects for a run of update_elasticc2_sources.
+
+    Waits for { 'command': 'go', 'run_id': <int>, 'incremental': <bool> }
+    or { 'command': 'die' } on pipe.  After a go, claims chunks of the run
+    that aren't done (using SELECT ... FOR UPDATE SKIP LOCKED, so workers
+    never step on each other), and does each one in its own transaction,
+    marking the chunk done in that same transaction.  Sends
+    { 'response': 'finished', 'nchunks': <int>, 'error': <str or None> }
+    back when there are no chunks left, or when something goes wrong.
+
+    """
+
+    def __init__( self, pipe ):
+        self.pipe = pipe
+        self.logger = logging.getLogger( f"update_elasticc2_sources_{os.getpid()}" )
+        self.logger.propagate = False
+        logout = logging.StreamHandler( sys.stderr )
+        self.logger.addHandler( logout )
+        formatter = logging.Formatter( f'[%(asctime)s - {os.getpid()} - %(levelname)s] - %(message)s',
+                                       datefmt='%Y-%m-%d %H:%M:%S' )
+        logout.setFormatter( formatter )
+        self.logger.setLevel( logging.INFO )
+
+    def go( self ):
+        msg = self.pipe.recv()
+        if msg['command'] != 'go':
+            return
+
+        nchunks = 0
+        error = None
+        conn = None
+        gratuitous = None
+        cursor = None
+        try:
+            gratuitous = django.db.connection.cursor()
+            conn = gratuitous.connection
+            conn.autocommit = False
+            cursor = conn.cursor( cursor_factory=psycopg2.extras.RealDictCursor )
+            while True:
+                cursor.execute( "SELECT chunk_id, minobjid, maxobjid FROM elasticc2_importppdbchunk "
+                                "WHERE run_id=%(run)s AND NOT done "
+                                "ORDER BY chunk_id LIMIT 1 FOR UPDATE SKIP LOCKED",
+                                { 'run': msg['run_id'] } )
+                rows = cursor.fetchall()
+                if len(rows) == 0:
+                    conn.rollback()
+                    break
+                self.do_chunk( cursor, msg['run_id'], rows[0], msg['incremental'] )
+                conn.commit()
+                nchunks += 1
+        except Exception as ex:
+            self.logger.exception( "Exception importing chunk, rolling back." )
+            if conn is not None:
+                conn.rollback()
+            error = str(ex)
+        finally:
+            if cursor is not None:
+                cursor.close()
+            if gratuitous is not None:
+                gratuitous.close()
+
+        self.pipe.send( { 'response': 'finished', 'nchunks': nchunks, 'error': error } )
+
+    # The DiaObjectInfo summaries: ( stage, column prefix, table of new
+    # rows, which row wins within the new rows, when a new row beats the
+    # existing summary ).  Each summary only ever moves one way (earlier,
+    # later, or brighter), so it can be updated from the new rows alone.
+    _infosummaries = [
+        ( "Updating DiaObjectInfo -- first source in each filter", "firstsource",
+          "tmp_newsources", "midpointtai, diasource_id", "excluded.firstsourcemjd < {t}.firstsourcemjd" ),
+        ( "Updating DiaObjectInfo -- latest source in each filter", "latestsource",
+          "tmp_newsources", "midpointtai DESC, diasource_id DESC",
+          "excluded.latestsourcemjd > {t}.latestsourcemjd" ),
+        ( "Updating DiaObjectInfo -- latest forced source in each filter", "latestforcedsource",
+          "tmp_newforcedsources", "midpointtai DESC, diaforcedsource_id DESC",
+          "excluded.latestforcedsourcemjd > {t}.latestforcedsourcemjd" ),
+        ( "Updating DiaObjectInfo -- brightest forced source in each filter", "maxforcedsource",
+          "tmp_newforcedsources", "psflux DESC NULLS LAST, diaforcedsource_id",
+          "excluded.maxforcedsourceflux > {t}.maxforcedsourceflux" ),
+    ]
+
+    def update_info( self, cursor, stages, stage, summary, table, order, better ):
+        idcol = 'diasource_id' if table == 'tmp_newsources' else 'diaforcedsource_id'
+        t = 'elasticc2_diaobjectinfo'
+        _stage( cursor, stages, stage,
+                f"INSERT INTO {t}(diaobject_id,filtername,"
+                f"  {summary}_id,{summary}flux,{summary}fluxerr,{summary}mjd) "
+                f"  SELECT DISTINCT ON (diaobject_id,filtername) "
+                f"    diaobject_id,filtername,{idcol},psflux,psfluxerr,midpointtai "
+                f"  FROM {table} "
+                f"  ORDER BY diaobject_id,filtername,{order} "
+                f"ON CONFLICT ON CONSTRAINT diaobjectinfo_unique DO UPDATE "
+                f"  SET {summary}_id=excluded.{summary}_id, "
+                f"      {summary}flux=excluded.{summary}flux, "
+                f"      {summary}fluxerr=excluded.{summary}fluxerr, "
+                f"      {summary}mjd=excluded.{summary}mjd "
+                f"  WHERE {t}.{summary}_id IS NULL OR {better.format( t=t )}",
+                logger=self.logger )
+
+    def do_chunk( self, cursor, run_id, chunk, incremental ):
+        t0 = time.perf_counter()
+        stages = []
+        subdict = { 'run': run_id, 'min': chunk['minobjid'], 'max': chunk['maxobjid'] }
+
+        # The objects that got new sources.  (In --full mode, the forced source
+        # import also looks at every object in the chunk's range.)
+        cursor.execute( "CREATE TEMP TABLE tmp_updatedobjects( diaobject_id bigint ) ON COMMIT DROP" )
+        _stage( cursor, stages, "Finding updated and unknown objects",
+                "INSERT INTO tmp_updatedobjects "
+                "  SELECT DISTINCT diaobject_id FROM elasticc2_importppdbsource "
+                "  WHERE run_id=%(run)s AND diaobject_id>=%(min)s AND diaobject_id<=%(max)s",
+                subdict, logger=self.logger )
+
+        _stage( cursor, stages, "Importing unknown objects",
+                "INSERT INTO elasticc2_diaobject "
+                "  ( SELECT o.* FROM elasticc2_ppdbdiaobject o "
+                "    INNER JOIN tmp_updatedobjects t ON o.diaobject_id=t.diaobject_id ) "
+                "ON CONFLICT DO NOTHING", logger=self.logger )
+
+        # Keep track of the sources and forced sources actually inserted, so
+        # that the DiaObjectInfo summaries can be updated from just those.
+        cursor.execute( "CREATE TEMP TABLE tmp_newsources( diasource_id bigint, diaobject_id bigint, "
+                        "  filtername text, psflux real, psfluxerr real, midpointtai double precision ) "
+                        "ON COMMIT DROP" )
+        cursor.execute( "CREATE TEMP TABLE tmp_newforcedsources( diaforcedsource_id bigint, diaobject_id bigint, "
+                        "  filtername text, psflux real, psfluxerr real, midpointtai double precision ) "
+                        "ON COMMIT DROP" )
+
+        _stage( cursor, stages, "Importing unknown sources",
+                "WITH ins AS ( "
+                "  INSERT INTO elasticc2_diasource "
+                "    ( SELECT s.* FROM elasticc2_importppdbsource i "
+                "      INNER JOIN elasticc2_ppdbdiasource s ON s.diasource_id=i.diasource_id "
+                "      WHERE i.run_id=%(run)s AND i.diaobject_id>=%(min)s AND i.diaobject_id<=%(max)s ) "
+                "  ON CONFLICT DO NOTHING "
+                "  RETURNING diasource_id, diaobject_id, filtername, psflux, psfluxerr, midpointtai ) "
+                "INSERT INTO tmp_newsources SELECT * FROM ins",
+                subdict, logger=self.logger )
+
+        # For each object, forced sources need to be copied through the time of
+        # the latest known source.  Everything through the object's watermark
+        # was copied on a previous run, so (in incremental mode) only look at
+        # objects that got new sources this time, and only at forced sources
+        # after the watermark.  (Objects that didn't get new sources can't
+        # have new forced sources to copy, as the latest source didn't move.)
+        cursor.execute( "CREATE TEMP TABLE tmp_latestsource "
+                        "  ( diaobject_id bigint, midpointtai double precision, "
+                        "    prevmjd double precision ) ON COMMIT DROP" )
+        if incremental:
+            _stage( cursor, stages, "Finding latest known source for each updated object",
+                    "INSERT INTO tmp_latestsource "
+                    "  SELECT t.diaobject_id, MAX(s.midpointtai), MAX(w.throughmjd) "
+                    "  FROM tmp_updatedobjects t "
+                    "  INNER JOIN elasticc2_diasource s ON t.diaobject_id=s.diaobject_id "
+                    "  LEFT JOIN elasticc2_diaobjectforcedsourcewatermark w "
+                    "    ON t.diaobject_id=w.diaobject_id "
+                    "  GROUP BY t.diaobject_id", logger=self.logger )
+        else:
+            _stage( cursor, stages, "Finding latest known source for each object",
+                    "INSERT INTO tmp_latestsource "
+                    "  SELECT diaobject_id, MAX(midpointtai), NULL "
+                    "  FROM elasticc2_diasource "
+                    "  WHERE diaobject_id>=%(min)s AND diaobject_id<=%(max)s "
+                    "  GROUP BY diaobject_id",
+                    subdict, logger=self.logger )
+
+        _stage( cursor, stages, "Importing new forced sources",
+                "WITH ins AS ( "
+                "  INSERT INTO elasticc2_diaforcedsource "
+                "    ( SELECT p.* FROM tmp_latestsource t "
+                "      INNER JOIN elasticc2_ppdbdiaforcedsource p "
+                "        ON t.diaobject_id=p.diaobject_id AND p.midpointtai <= t.midpointtai "
+                "        AND ( t.prevmjd IS NULL OR p.midpointtai > t.prevmjd ) ) "
+                "  ON CONFLICT DO NOTHING "
+                "  RETURNING diaforcedsource_id, diaobject_id, filtername, psflux, psfluxerr, midpointtai ) "
+                "INSERT INTO tmp_newforcedsources SELECT * FROM ins", logger=self.logger )
+
+        _stage( cursor, stages, "Updating forced source watermarks",
+                "INSERT INTO elasticc2_diaobjectforcedsourcewatermark(diaobject_id,throughmjd) "
+                "  SELECT diaobject_id, midpointtai FROM tmp_latestsource "
+                "ON CONFLICT (diaobject_id) DO UPDATE "
+                "  SET throughmjd=GREATEST(elasticc2_diaobjectforcedsourcewatermark.throughmjd,"
+                "                          excluded.throughmjd)", logger=self.logger )
+
+        # In --full mode, fold everything we have for the chunk's objects
+        # into the summaries, not just what was inserted this time.
+        if not incremental:
+            _stage( cursor, stages, "Collecting all sources for summaries",
+                    "INSERT INTO tmp_newsources "
+                    "  SELECT diasource_id, diaobject_id, filtername, psflux, psfluxerr, midpointtai "
+                    "  FROM elasticc2_diasource WHERE diaobject_id>=%(min)s AND diaobject_id<=%(max)s",
+                    subdict, logger=self.logger )
+            _stage( cursor, stages, "Collecting all forced sources for summaries",
+                    "INSERT INTO tmp_newforcedsources "
+                    "  SELECT diaforcedsource_id, diaobject_id, filtername, psflux, psfluxerr, midpointtai "
+                    "  FROM elasticc2_diaforcedsource WHERE diaobject_id>=%(min)s AND diaobject_id<=%(max)s",
+                    subdict, logger=self.logger )
+
+        for stage, summary, table, order, better in self._infosummaries:
+            self.update_info( cursor, stages, stage, summary, table, order, better )
+
+        cursor.execute( "UPDATE elasticc2_importppdbchunk SET done=true, finished=%(t)s, stages=%(stages)s "
+                        "WHERE chunk_id=%(chunk)s",
+                        { 't': datetime.datetime.now( tz=datetime.timezone.utc ),
+                          'stages': json.dumps( stages ),
+                          'chunk': chunk['chunk_id'] } )
+        self.logger.info( f"Chunk {chunk['chunk_id']} (objects {chunk['minobjid']}–{chunk['maxobjid']}) "
+                          f"took {time.perf_counter()-t0:.2f} s" )
+
+
 class Command(BaseCommand):
     help = 'Update DiaObject, DiaSources, and DiaSorcedSources from PPDB with new sources learned from brokers.'
 
@@ -29,15 +258,185 @@ class Command(BaseCommand):
         parser.add_argument( '--doall', action='store_true', default=False,
                              help=( "Search the whole broker message table, not just the "
                                     "brokersourceids table." ) )
+        parser.add_argument( '--full', action='store_true', default=False,
+                             help=( "Look for new forced sources for every object in elasticc2_diasource, "
+                                    "not just the forced sources since the last run for objects that "
+                                    "got new sources this run.  (Slow.)" ) )
+        parser.add_argument( '-n', '--nprocs', type=int, default=4,
+                             help="Number of worker processes (database connections) importing chunks" )
+        parser.add_argument( '-c', '--chunk-size', type=int, default=1000,
+                             help="Number of objects per chunk (each chunk is committed separately)" )
+
+    def setup_run( self, cursor, options ):
+        """Start a new run: figure out what to import, and make the chunks.  Returns the run_id.
+
+        Everything here happens in one (short) transaction, which the
+        caller commits.
+
+        """
+        stages = []
+        incremental = not options['full']
+        cursor.execute( "INSERT INTO elasticc2_importppdbrun(started,incremental,success,stages) "
+                        "VALUES (%(t)s,%(inc)s,false,'[]') RETURNING run_id",
+                        { 't': datetime.datetime.now( tz=datetime.timezone.utc ), 'inc': incremental } )
+        run_id = cursor.fetchone()['run_id']
+        subdict = { 'run': run_id, 'chunksize': options['chunk_size'] }
+
+        # The broker messages to fold into DiaObjectClassification are the
+        # ones that have shown up since the last successful run.  Read the
+        # MAX before copying the unknown sources below, so that the source
+        # of every message through throughmsg gets imported by this run;
+        # otherwise, update_classifications would drop a message committed
+        # in between, and the next run would start after it.  (This still
+        # won't see a message whose transaction got its id before, but
+        # committed after, this MAX.  That's a very narrow window, and the
+        # next message from that classifier for the object fixes it.)
+        cursor.execute( "SELECT throughbrokermessage_id FROM elasticc2_importppdbrun "
+                        "WHERE success AND throughbrokermessage_id IS NOT NULL "
+                        "ORDER BY run_id DESC LIMIT 1" )
+        rows = cursor.fetchall()
+        frommsg = rows[0]['throughbrokermessage_id'] if ( incremental and len(rows) > 0 ) else 0
+        cursor.execute( "SELECT COALESCE( MAX(brokermessage_id), 0 ) AS maxid FROM elasticc2_brokermessage" )
+        throughmsg = max( frommsg, cursor.fetchone()['maxid'] )
+        cursor.execute( "UPDATE elasticc2_importppdbrun "
+                        "SET frombrokermessage_id=%(from)s, throughbrokermessage_id=%(through)s "
+                        "WHERE run_id=%(run)s",
+                        { 'from': frommsg, 'through': throughmsg, 'run': run_id } )
+
+        # Figure out which sources we don't know about
+
+        sourcetab = 'elasticc2_brokermessage' if options['doall'] else 'elasticc2_brokersourceids'
+
+        cursor.execute( f"CREATE TEMP TABLE tmp_orig_unknownsources( diasource_id bigint ) ON COMMIT DROP" )
+        _stage( cursor, stages, "Copying unknown sources",
+                f"INSERT INTO tmp_orig_unknownsources "
+                f"  SELECT diasource_id FROM {sourcetab}" )
+
+        _stage( cursor, stages, "Finding unknown sources",
+                "INSERT INTO elasticc2_importppdbsource(run_id,diasource_id,diaobject_id) "
+                "  SELECT %(run)s, bid, p.diaobject_id FROM "
+                "    ( SELECT DISTINCT ON (b.diasource_id) b.diasource_id AS bid "
+                "      FROM tmp_orig_unknownsources b "
+                "      LEFT JOIN elasticc2_diasource s ON b.diasource_id=s.diasource_id "
+                "      WHERE s.diasource_id IS NULL ) subq "
+                "  INNER JOIN elasticc2_ppdbdiasource p ON subq.bid=p.diasource_id",
+                subdict )
+
+        # Chunk boundaries: every chunksize'th object, ordered by id.  In
+        # --full mode, chunks must cover every object, not just those
+        # that got new sources.
+        cursor.execute( "CREATE TEMP TABLE tmp_chunkobjects( diaobject_id bigint ) ON COMMIT DROP" )
+        _stage( cursor, stages, "Finding objects to chunk",
+                "INSERT INTO tmp_chunkobjects "
+                "  SELECT DISTINCT diaobject_id FROM elasticc2_importppdbsource WHERE run_id=%(run)s" +
+                ( "" if incremental else " UNION SELECT diaobject_id FROM elasticc2_diaobject" ),
+                subdict )
+        _stage( cursor, stages, "Making chunks",
+                "INSERT INTO elasticc2_importppdbchunk(run_id,minobjid,maxobjid,done,stages) "
+                "  SELECT %(run)s, MIN(diaobject_id), MAX(diaobject_id), false, '[]' FROM "
+                "    ( SELECT diaobject_id, "
+                "             ( ROW_NUMBER() OVER (ORDER BY diaobject_id) - 1 ) / %(chunksize)s AS chunk "
+                "      FROM tmp_chunkobjects ) subq "
+                "  GROUP BY chunk",
+                subdict )
+        _logger.info( f"Run {run_id} has {cursor.rowcount} chunks" )
+
+        if ( not options['doall'] ):
+            _stage( cursor, stages, "Cleaning up elasticc2_brokersourceids",
+                    "DELETE FROM elasticc2_brokersourceids "
+                    "WHERE diasource_id IN "
+                    "  ( SELECT diasource_id FROM tmp_orig_unknownsources )" )
+
+        cursor.execute( "UPDATE elasticc2_importppdbrun SET stages=%(stages)s WHERE run_id=%(run)s",
+                        { 'stages': json.dumps( stages ), 'run': run_id } )
+        return run_id
+
+    def update_classifications( self, cursor, run, stages ):
+        """Fold the run's new broker messages into DiaObjectClassification.
+
+        Only messages for sources that are in elasticc2_diasource count, so
+        this has to happen after all the chunks are done.
+
+        """
+        t = 'elasticc2_diaobjectclassification'
+        _stage( cursor, stages, "Updating DiaObjectClassification",
+                f"INSERT INTO {t}(diaobject_id,classifier_id,"
+                f"  latestclass1id,latestclass2id,latestclass3id,latestclass4id,"
+                f"  latestclass1prob,latestclass2prob,latestclass3prob,latestclass4prob,"
+                f"  latestsourcemjd,latestbrokermessage_id) "
+                f"  SELECT l.diaobject_id, l.classifier_id, "
+                f"    top.cls[1], top.cls[2], top.cls[3], top.cls[4], "
+                f"    top.probs[1], top.probs[2], top.probs[3], top.probs[4], "
+                f"    l.midpointtai, l.brokermessage_id "
+                f"  FROM ( SELECT DISTINCT ON (s.diaobject_id,m.classifier_id) "
+                f"           s.diaobject_id, m.classifier_id, s.midpointtai, m.brokermessage_id, "
+                f"           m.classid, m.probability "
+                f"         FROM elasticc2_brokermessage m "
+                f"         INNER JOIN elasticc2_diasource s ON m.diasource_id=s.diasource_id "
+                f"         WHERE m.brokermessage_id>%(from)s AND m.brokermessage_id<=%(through)s "
+                f"           AND cardinality(m.classid)>0 "
+                f"         ORDER BY s.diaobject_id, m.classifier_id, "
+                f"                  s.midpointtai DESC, m.brokermessage_id DESC ) l "
+                f"  CROSS JOIN LATERAL "
+                f"    ( SELECT array_agg(u.c ORDER BY u.p DESC) AS cls, array_agg(u.p ORDER BY u.p DESC) AS probs "
+                f"      FROM unnest(l.classid,l.probability) AS u(c,p) ) top "
+                f"ON CONFLICT ON CONSTRAINT diaobjectclassification_unique DO UPDATE "
+                f"  SET latestclass1id=excluded.latestclass1id, latestclass2id=excluded.latestclass2id, "
+                f"      latestclass3id=excluded.latestclass3id, latestclass4id=excluded.latestclass4id, "
+                f"      latestclass1prob=excluded.latestclass1prob, latestclass2prob=excluded.latestclass2prob, "
+                f"      latestclass3prob=excluded.latestclass3prob, latestclass4prob=excluded.latestclass4prob, "
+                f"      latestsourcemjd=excluded.latestsourcemjd, "
+                f"      latestbrokermessage_id=excluded.latestbrokermessage_id "
+                f"  WHERE {t}.latestsourcemjd IS NULL "
+                f"     OR ( excluded.latestsourcemjd, excluded.latestbrokermessage_id ) "
+                f"        > ( {t}.latestsourcemjd, {t}.latestbrokermessage_id )",
+                { 'from': run['frombrokermessage_id'], 'through': run['throughbrokermessage_id'] } )
+
+    def finish_run( self, cursor, run_id, success ):
+        """Record the run as finished, summing up the stage timings from all the chunks."""
+        cursor.execute( "SELECT stages, frombrokermessage_id, throughbrokermessage_id "
+                        "FROM elasticc2_importppdbrun WHERE run_id=%(run)s", { 'run': run_id } )
+        run = cursor.fetchone()
+        stages = run['stages']
+        if success:
+            self.update_classifications( cursor, run, stages )
+        cursor.execute( "SELECT stages FROM elasticc2_importppdbchunk WHERE run_id=%(run)s AND done",
+                        { 'run': run_id } )
+        chunkstages = {}
+        for row in cursor.fetchall():
+            for stage in row['stages']:
+                if stage['stage'] not in chunkstages:
+                    chunkstages[ stage['stage'] ] = { 'stage': stage['stage'], 'seconds': 0, 'rows': 0 }
+                chunkstages[ stage['stage'] ]['seconds'] += stage['seconds']
+                chunkstages[ stage['stage'] ]['rows'] += stage['rows'] if stage['rows'] is not None else 0
+        stages = [ s for s in stages if s['stage'] not in chunkstages ] + list( chunkstages.values() )
+        cursor.execute( "UPDATE elasticc2_importppdbrun SET finished=%(t)s, success=%(success)s, stages=%(stages)s "
+                        "WHERE run_id=%(run)s",
+                        { 't': datetime.datetime.now( tz=datetime.timezone.utc ),
+                          'success': success,
+                          'stages': json.dumps( stages ),
+                          'run': run_id } )
+        if success:
+            cursor.execute( "DELETE FROM elasticc2_importppdbsource WHERE run_id=%(run)s", { 'run': run_id } )
 
     def handle( self, *args, **options ):
+        # Launch the workers first, before this process opens its database
+        # connection, so that they don't share it.
+        django.db.connections.close_all()
+        workers = []
+        for i in range( options['nprocs'] ):
+            parentconn, childconn = multiprocessing.Pipe()
+            proc = multiprocessing.Process( target=lambda: ChunkWorker( childconn ).go(), daemon=True )
+            proc.start()
+            workers.append( { 'proc': proc, 'pipe': parentconn } )
+
         conn = None
         origautocommit = None
         gratuitous = None
         cursor = None
         setrunningflag = False
-        tmpsourcetable = None
-        newobjs = []
+        run_id = None
+        success = False
         try:
             # Have to jump through some hoops to get the actual psycopg2
             # connection from django; we need this to turn off autocommit
@@ -50,153 +449,118 @@ class Command(BaseCommand):
             # Make sure that one of these commands isn't already running.  It would
             # probably be a mess if multiple were running it once.  (It might
             # actually be OK, but it would be gratuitous load on the database.)
-            _logger.info( "Setting elasticc2_importppdbrunning to true" )
+            # This process holds a session advisory lock for as long as it's
+            # running, which goes away by itself if the process dies.  So, if
+            # the importppdbrunning flag is set but we can get the lock, then a
+            # previous run died, and we can resume it.  (If the flag is set and
+            # there's no unfinished run, it may be update_elasticc2_sources_old,
+            # which doesn't know about the lock, that's running.)
             cursor = conn.cursor( cursor_factory=psycopg2.extras.RealDictCursor )
+            cursor.execute( "SELECT pg_try_advisory_lock( hashtext( 'update_elasticc2_sources' ) ) AS gotlock" )
+            if not cursor.fetchone()['gotlock']:
+                _logger.error( "Another update_elasticc2_sources holds the lock" )
+                raise RuntimeError( "update_elasticc2_sources already running" )
+            conn.commit()
+
+            _logger.info( "Setting elasticc2_importppdbrunning to true" )
             cursor.execute( "LOCK TABLE elasticc2_importppdbrunning" )
             cursor.execute( "SELECT running FROM elasticc2_importppdbrunning" )
             rows = cursor.fetchall()
             if ( len(rows) == 0 ) or ( len(rows) > 1 ):
                 _logger.error( f"There are {len(rows)} rows in the importppdbrunning table; should only be 1" )
                 raise RuntimeError( "importppdbrunning table corrupted" )
-            if rows[0]['running']:
+            cursor.execute( "SELECT run_id FROM elasticc2_importppdbrun WHERE finished IS NULL "
+                            "ORDER BY run_id DESC LIMIT 1" )
+            rows2 = cursor.fetchall()
+            if len( rows2 ) > 0:
+                run_id = rows2[0]['run_id']
+                _logger.warning( f"Resuming unfinished run {run_id}" )
+            elif rows[0]['running']:
                 _logger.error( "importppdbrunning table indicates this command is already running" )
                 raise RuntimeError( "update_elasticc2_sources already running" )
             cursor.execute( "UPDATE elasticc2_importppdbrunning SET running=true" )
             setrunningflag = True
             conn.commit()
 
-            cursor = conn.cursor( cursor_factory=psycopg2.extras.RealDictCursor )
+            if run_id is None:
+                newrun_id = self.setup_run( cursor, options )
+                conn.commit()
+                run_id = newrun_id
+            cursor.execute( "SELECT incremental FROM elasticc2_importppdbrun WHERE run_id=%(run)s",
+                            { 'run': run_id } )
+            incremental = cursor.fetchone()['incremental']
+            conn.commit()
+
+            # Let the workers loose on the chunks, and wait for them all to finish
 
+            for worker in workers:
+                worker['pipe'].send( { 'command': 'go', 'run_id': run_id, 'incremental': incremental } )
+            errors = []
+            nchunks = 0
+            for worker in workers:
+                try:
+                    msg = worker['pipe'].recv()
+                    nchunks += msg['nchunks']
+                    if msg['error'] is not None:
+                        errors.append( msg['error'] )
+                except EOFError:
+                    errors.append( f"Worker process {worker['proc'].pid} died" )
+            _logger.info( f"Workers imported {nchunks} chunks" )
 
-            # Figure out which sources we don't know about
-
-            sourcetab = 'elasticc2_brokermessage' if options['doall'] else 'elasticc2_brokersourceids'
-
-            _logger.info( "Copying unknown sources" )
-            cursor.execute( f"CREATE TEMP TABLE tmp_orig_unknownsources( diasource_id bigint )" )
-            cursor.execute( f"INSERT INTO tmp_orig_unknownsources "
-                            f"  SELECT diasource_id FROM {sourcetab}" )
-
-            _logger.info( "Finding unknown sources" )
-            cursor.execute( "CREATE TEMP TABLE tmp_unknownsources( diasource_id bigint )" )
-            cursor.execute( f"INSERT INTO tmp_unknownsources "
-                            f"  SELECT bid FROM "
-                            f"    ( SELECT DISTINCT ON (b.diasource_id) b.diasource_id AS bid, s.diasource_id AS sid "
-                            f"      FROM tmp_orig_unknownsources b "
-                            f"      LEFT JOIN elasticc2_diasource s ON b.diasource_id=s.diasource_id "
-                            f"      WHERE s.diasource_id IS NULL ) subq" )
-
-            _logger.info( "Finding updated and unknown objects" )
-            cursor.execute( "CREATE TEMP TABLE tmp_updatedobjects( diaobject_id bigint )" )
-            cursor.execute( "INSERT INTO tmp_updatedobjects "
-                            "  SELECT pid FROM "
-                            "  ( SELECT DISTINCT ON (p.diaobject_id) p.diaobject_id AS pid "
-                            "    FROM tmp_unknownsources t "
-                            "    INNER JOIN elasticc2_ppdbdiasource p ON t.diasource_id=p.diasource_id ) subq" )
-
-            _logger.info( "Finding unknown objects" )
-            cursor.execute( "CREATE TEMP TABLE tmp_unknownobjects( diaobject_id bigint )" )
-            cursor.execute( "INSERT INTO tmp_unknownobjects "
-                            "  SELECT pid FROM "
-                            "  ( SELECT t.diaobject_id AS pid "
-                            "    FROM tmp_updatedobjects t"
-                            "    LEFT JOIN elasticc2_diaobject o ON t.diaobject_id=o.diaobject_id "
-                            "    WHERE o.diaobject_id IS NULL ) subq" )
-            # cursor.execute( "INSERT INTO tmp_unknownobjects "
-            #                 "  SELECT pid FROM "
-            #                 "    ( SELECT DISTINCT ON (p.diaobject_id) p.diaobject_id AS pid, o.diaobject_id AS oid"
-            #                 "      FROM tmp_unknownsources t "
-            #                 "      INNER JOIN elasticc2_ppdbdiasource p ON t.diasource_id=p.diasource_id "
-            #                 "      LEFT JOIN elasticc2_diaobject o ON p.diaobject_id=o.diaobject_id "
-            #                 "      WHERE o.diaobject_id IS NULL ) subq" )
-
-            _logger.info( "Importing unknown objects" )
-            cursor.execute( "INSERT INTO elasticc2_diaobject "
-                            "  ( SELECT o.* FROM elasticc2_ppdbdiaobject o "
-                            "    INNER JOIN tmp_unknownobjects t "
-                            "    ON o.diaobject_id=t.diaobject_id )" )
-
-            _logger.info( "Importing unknown sources" )
-            cursor.execute( "INSERT INTO elasticc2_diasource "
-                            "  ( SELECT s.* FROM tmp_unknownsources t "
-                            "    INNER JOIN elasticc2_ppdbdiasource s "
-                            "    ON s.diasource_id=t.diasource_id )" )
-
-            _logger.info( "Finding latest known source for each object" )
-            cursor.execute( "CREATE TEMP TABLE tmp_latestsource "
-                            "  ( diaobject_id bigint, midpointtai double precision )" )
-            cursor.execute( "INSERT INTO tmp_latestsource "
-                            "  SELECT diaobject_id, MAX(midpointtai) "
-                            "  FROM elasticc2_diasource "
-                            "  GROUP BY diaobject_id" )
-
-            # This one takes freaking forever
-            _logger.info( "Importing new forced sources" )
-            cursor.execute( "INSERT INTO elasticc2_diaforcedsource "
-                            "  ( SELECT p.* FROM tmp_latestsource t "
-                            "    INNER JOIN elasticc2_ppdbdiaforcedsource p "
-                            "      ON t.diaobject_id=p.diaobject_id AND p.midpointtai <= t.midpointtai ) "
-                            "ON CONFLICT DO NOTHING" )
-
-            # ...this one will usually be a slow null operation,
-            # as the first source is not likely to change as additional sources are added
-            _logger.info( "Updating DiaObjectInfo -- first source in each filter" )
-            cursor.execute( "INSERT INTO elasticc2_diaobjectinfo(diaobject_id,filtername,"
-                            "                                    firstsource_id,firstsourceflux,"
-                            "                                    firstsourcefluxerr,firstsourcemjd) "
-                            "  SELECT DISTINCT ON (t.diaobject_id,s.filtername) "
-                            "     t.diaobject_id,s.filtername,s.diasource_id,s.psflux,s.psfluxerr,s.midpointtai "
-                            "  FROM tmp_updatedobjects t "
-                            "  INNER JOIN elasticc2_diasource s ON t.diaobject_id=s.diaobject_id "
-                            "  ORDER BY t.diaobject_id,s.filtername,s.midpointtai "
-                            "ON CONFLICT ON CONSTRAINT diaobjectinfo_unique DO UPDATE "
-                            "  SET firstsource_id=excluded.firstsource_id, "
-                            "      firstsourceflux=excluded.firstsourceflux, "
-                            "      firstsourcefluxerr=excluded.firstsourcefluxerr, "
-                            "      firstsourcemjd=excluded.firstsourcemjd" )
-
-            _logger.info( "Updating DiaObjectInfo -- latest source in each filter" )
-            cursor.execute( "INSERT INTO elasticc2_diaobjectinfo(diaobject_id,filtername,"
-                            "                                    latestsource_id,latestsourceflux,"
-                            "                                    latestsourcefluxerr,latestsourcemjd) "
-                            "  SELECT DISTINCT ON (t.diaobject_id,s.filtername) "
-                            "     t.diaobject_id,s.filtername,s.diasource_id,s.psflux,s.psfluxerr,s.midpointtai "
-                            "  FROM tmp_updatedobjects t "
-                            "  INNER JOIN elasticc2_diasource s ON t.diaobject_id=s.diaobject_id "
-                            "  ORDER BY t.diaobject_id,s.filtername,s.midpointtai DESC "
-                            "ON CONFLICT ON CONSTRAINT diaobjectinfo_unique DO UPDATE "
-                            "  SET latestsource_id=excluded.latestsource_id, "
-                            "      latestsourceflux=excluded.latestsourceflux, "
-                            "      latestsourcefluxerr=excluded.latestsourcefluxerr, "
-                            "      latestsourcemjd=excluded.latestsourcemjd" )
-
-
-            if ( not options['doall'] ):
-                _logger.info( "Cleaning up elasticc2_brokersourceids" )
-                cursor.execute( "DELETE FROM elasticc2_brokersourceids "
-                                "WHERE diasource_id IN "
-                                "  ( SELECT diasource_id FROM tmp_orig_unknownsources )" )
+            cursor.execute( "SELECT COUNT(*) AS n FROM elasticc2_importppdbchunk WHERE run_id=%(run)s AND NOT done",
+                            { 'run': run_id } )
+            nleft = cursor.fetchone()['n']
+            if ( len(errors) > 0 ) or ( nleft > 0 ):
+                raise RuntimeError( f"Run {run_id} has {nleft} chunks not done; errors from workers: {errors}.  "
+                                    f"Run again to resume." )
+
+            self.finish_run( cursor, run_id, True )
+            conn.commit()
+            success = True
 
         except Exception as e:
-            _logger.exception( "Exception during transaction, rolling back." )
-            conn.rollback()
+            _logger.exception( "Exception during import, rolling back." )
+            if conn is not None:
+                conn.rollback()
 
         finally:
+            for worker in workers:
+                if worker['proc'].is_alive():
+                    try:
+                        worker['pipe'].send( { 'command': 'die' } )
+                    except Exception:
+                        pass
+                worker['proc'].join( timeout=10 )
             if cursor is not None:
                 cursor.close()
                 cursor = None
-            # TODO: drop temp tables
-            if setrunningflag:
+            # Leave the flag set if a run was started but didn't finish; it'll get resumed next time
+            if setrunningflag and ( success or run_id is None ):
                 _logger.info( "Setting elasticc2_importppdbrunning to false" )
                 cursor = conn.cursor()
                 # Not bothering to lock the table here, since we don't read-then-write
                 cursor.execute( "UPDATE elasticc2_importppdbrunning SET running=false" )
                 conn.commit()
+                cursor.close()
+                cursor = None
+            if conn is not None:
+                cursor = conn.cursor()
+                cursor.execute( "SELECT pg_advisory_unlock( hashtext( 'update_elasticc2_sources' ) )" )
+                conn.commit()
+                cursor.close()
+                cursor = None
             if origautocommit is not None and conn is not None:
                 conn.autocommit = origautocommit
                 origautocommit = None
                 conn = None
 
+        # Cached query results that involve elasticc2 tables may now be out
+        # of date.  (Even if the run failed, as some chunks may have been
+        # committed.)
+        ninvalidated = QueryResultCache.invalidate( 'elasticc2' )
+        _logger.info( f"Threw out {ninvalidated} cached query results" )
 
+        if not success:
+            raise CommandError( "update_elasticc2_sources failed" )
 
         _logger.info( "Done." )
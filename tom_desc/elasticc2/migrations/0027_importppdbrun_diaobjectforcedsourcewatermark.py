@@ -0,0 +1,33 @@
+# Generated by Django 4.2.7 on 2026-10-18 09:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('elasticc2', '0026_wantedspectra_spectruminfo_plannedspectra'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportPPDBRun',
+            fields=[
+                ('run_id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('started', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('finished', models.DateTimeField(default=None, null=True)),
+                ('incremental', models.BooleanField(default=False)),
+                ('success', models.BooleanField(default=False)),
+                ('stages', models.JSONField(default=list)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DiaObjectForcedSourceWatermark',
+            fields=[
+                ('diaobject', models.OneToOneField(db_column='diaobject_id', on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='elasticc2.diaobject')),
+                ('throughmjd', models.FloatField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.7 on 2026-10-18 09:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('elasticc2', '0027_importppdbrun_diaobjectforcedsourcewatermark'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportPPDBChunk',
+            fields=[
+                ('chunk_id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('minobjid', models.BigIntegerField()),
+                ('maxobjid', models.BigIntegerField()),
+                ('done', models.BooleanField(default=False)),
+                ('finished', models.DateTimeField(default=None, null=True)),
+                ('stages', models.JSONField(default=list)),
+                ('run', models.ForeignKey(db_column='run_id', on_delete=django.db.models.deletion.CASCADE, to='elasticc2.importppdbrun')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ImportPPDBSource',
+            fields=[
+                ('_id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('diasource_id', models.BigIntegerField()),
+                ('diaobject_id', models.BigIntegerField()),
+                ('run', models.ForeignKey(db_column='run_id', on_delete=django.db.models.deletion.CASCADE, to='elasticc2.importppdbrun')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['run', 'diaobject_id'], name='elasticc2_i_run_id_a73dd5_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.7 on 2026-10-18 14:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('elasticc2', '0028_importppdbchunk_importppdbsource'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='diaobjectclassification',
+            name='latestbrokermessage_id',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='diaobjectclassification',
+            name='latestsourcemjd',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='importppdbrun',
+            name='frombrokermessage_id',
+            field=models.BigIntegerField(default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='importppdbrun',
+            name='throughbrokermessage_id',
+            field=models.BigIntegerField(default=None, null=True),
+        ),
+        migrations.AlterField(
+            model_name='diaobjectclassification',
+            name='diaobject',
+            field=models.ForeignKey(db_column='diaobject_id', on_delete=django.db.models.deletion.CASCADE, to='elasticc2.diaobject'),
+        ),
+    ]
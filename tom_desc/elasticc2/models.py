@@ -1,12 +1,13 @@
 import sys
+import os
 import io
 import re
 import math
 import time
+import bisect
 import datetime
 import pytz
 import logging
-import itertools
 import uuid
 import psqlextra.types
 import psqlextra.models
@@ -245,6 +246,202 @@ _reconstruct_forcedsourcefieldmap[ "diaForcedSourceId" ] = "diaforcedsource_id"
 _reconstruct_forcedsourcefieldmap[ "diaObjectId" ] = "diaobject_id"
 _reconstruct_forcedkwargs = { f: F(_reconstruct_forcedsourcefieldmap[f]) for f in _reconstruct_forcedsourcefieldmap }
 
+_reconstruct_sourcefields = [ "diaSourceId", "diaObjectId", "midPointTai",
+                              "filterName", "ra", "decl", "psFlux", "psFluxErr", "snr" ]
+_reconstruct_sourcefieldmap = { i: i.lower() for i in _reconstruct_sourcefields }
+_reconstruct_sourcefieldmap[ "diaSourceId" ] = "diasource_id"
+_reconstruct_sourcefieldmap[ "diaObjectId" ] = "diaobject_id"
+
+_reconstruct_objectfields = [ "diaObjectId", "simVersion", "ra", "decl", "mwebv", "mwebv_err",
+                              "z_final", "z_final_err" ]
+for _suffix in [ "", "2" ]:
+    for _hgfield in [ "ellipticity", "sqradius", "zspec", "zspec_err", "zphot", "zphot_err",
+                      "zphot_q000", "zphot_q010", "zphot_q020", "zphot_q030", "zphot_q040",
+                      "zphot_q050", "zphot_q060", "zphot_q070", "zphot_q080", "zphot_q090", "zphot_q100",
+                      "mag_u", "mag_g", "mag_r", "mag_i", "mag_z", "mag_Y",
+                      "ra", "dec", "snsep",
+                      "magerr_u", "magerr_g", "magerr_r", "magerr_i", "magerr_z", "magerr_Y" ]:
+        _reconstruct_objectfields.append( f"hostgal{_suffix}_{_hgfield}" )
+_reconstruct_objectfieldmap = { i: i.lower() for i in _reconstruct_objectfields }
+_reconstruct_objectfieldmap[ "diaObjectId" ] = "diaobject_id"
+
+
+class AlertReconstructionSession:
+    """Per-process state for BaseAlert.reconstruct.
+
+    Resolves the name of the forced source diaobject_id index once,
+    PREPAREs the previous source and previous forced source queries on
+    the database connection, and reuses a single tuple cursor, turning
+    rows into Avro-named dicts with precomputed field lists.  If django
+    closes and reopens its connection, the statements are prepared
+    again on the new one.
+
+    Don't make one of these directly; use BaseAlert.session() (which
+    keeps one per alert class per process).  Timings are accumulated in
+    the same class counters (_sourcetime, _prvforcedsourcetime, etc.)
+    that AlertReconstructor reports.
+
+    """
+
+    def __init__( self, alertclass ):
+        self.alertclass = alertclass
+        self.pid = os.getpid()
+        self.conn = None
+        self.cursor = None
+        self.prvsourcestmt = f"{alertclass._meta.db_table}_prvsources"
+        self.prvforcedstmt = f"{alertclass._meta.db_table}_prvforced"
+        self.sourcefields = tuple( _reconstruct_sourcefields )
+        self.sourcetaidex = self.sourcefields.index( "midPointTai" )
+        self.forcedfields = tuple( _reconstruct_forcedsourcefields )
+        # Building the object field list is what _objectoverheadtime has always counted
+        t0 = time.perf_counter()
+        self.objectfields = tuple( ( f, _reconstruct_objectfieldmap[f] ) for f in _reconstruct_objectfields )
+        alertclass._objectoverheadtime += time.perf_counter() - t0
+        self.diasourcefields = tuple( ( f, _reconstruct_sourcefieldmap[f] ) for f in _reconstruct_sourcefields )
+
+    def _connect( self ):
+        # Django may have closed and reopened its connection since the
+        # last call, in which case the prepared statements are gone
+        django.db.connection.ensure_connection()
+        conn = django.db.connection.connection
+        if ( conn is self.conn ) and ( not conn.closed ):
+            return
+
+        self.conn = conn
+        self.cursor = conn.cursor()
+        with conn.cursor( cursor_factory=psycopg2.extras.RealDictCursor ) as dictcursor:
+            frcdex = self.alertclass._find_forcedsource_objectindex( dictcursor )
+
+        srctab = self.alertclass._sourceclass._meta.db_table
+        frctab = self.alertclass._forcedsourceclass._meta.db_table
+        srccols = ", ".join( _reconstruct_sourcefieldmap[f] for f in self.sourcefields )
+        frccols = ", ".join( _reconstruct_forcedsourcefieldmap[f] for f in self.forcedfields )
+
+        # Witout the hint (which requires the pg_hint_plan postgres
+        # extension, which is included in the postgres Dockerfile
+        # packed with this archive) postgres was sometimes doing a
+        # parallel index scan on diaobject_id midpointtai, and then
+        # ANDing the results of those two scans together.  This is
+        # absurd, however, because the diaobject_id index scan is
+        # simpler, and cuts the list down WAY more (by 4-6 orders of
+        # magnitude)... and EXPLAIN ANALYZE shows that it runs a two
+        # orders of magnitude faster than the other index scan.
+        # And, of course, I could have predicted this ahead of time
+        # because I know that the diaobject filter is going to cut
+        # the number of rows down by (to first approximation) 4
+        # million (the number of different objects), whereas the
+        # midpointtai query is going to cut the number of rows down
+        # by a factor of ~3 or ~30 (1 year, or 0.1 year, out of 3
+        # years).
+        #
+        # The IndexScan hint makes it do an index scan with JUST the
+        # diaobject_id index; my current belief is that even in
+        # extreme cases, the subsequent sequential scan of
+        # midpointttai on the sources just for the object will be
+        # faster than the midpointtai index scan of the whole table.
+        # I should learn how to use pg_hint_plan better to tell it
+        # to do first one then the other index scan.
+        #
+        # (Why even have the midpointtai index? you ask.  Well, you might
+        # want to search by time without searching first by object, in
+        # which case you really want that index.)
+        #
+        # (pg_hint_plan only looks at the start of the statement, so the
+        # hint goes before PREPARE, not after AS.)
+
+        self.cursor.execute( "SELECT name FROM pg_prepared_statements" )
+        existing = { row[0] for row in self.cursor.fetchall() }
+        if self.prvsourcestmt not in existing:
+            self.cursor.execute( f"PREPARE {self.prvsourcestmt}(bigint) AS "
+                                 f"SELECT {srccols} FROM {srctab} "
+                                 f"WHERE diaobject_id=$1 "
+                                 f"ORDER BY midpointtai" )
+        if self.prvforcedstmt not in existing:
+            self.cursor.execute( f"/*+ IndexScan( {frctab} {frcdex} ) */ "
+                                 f"PREPARE {self.prvforcedstmt}(bigint,double precision,double precision) AS "
+                                 f"SELECT {frccols} FROM {frctab} "
+                                 f"WHERE diaobject_id=$1 AND midpointtai>=$2 AND midpointtai<$3 "
+                                 f"ORDER BY midpointtai" )
+
+    def _explain( self, stmt, args ):
+        strio = io.StringIO()
+        strio.write( f"Query: EXECUTE {stmt}{args}\n" )
+        self.cursor.execute( f"EXPLAIN ANALYZE EXECUTE {stmt}(" + ",".join( ["%s"] * len(args) ) + ")", args )
+        for r in self.cursor.fetchall():
+            strio.write( f"{r[0]}\n" )
+        _logger.info( strio.getvalue() )
+
+    def reconstruct( self, alert, daysprevious=365, nprevious=None, debug=False ):
+        """See BaseAlert.reconstruct"""
+        cls = self.alertclass
+        self._connect()
+
+        # Bobby Tables
+        daysprevious = float( daysprevious )
+
+        rec = { "alertId": alert.alert_id,
+                "diaSource": {},
+                "prvDiaSources": [],
+                "prvDiaForcedSources": [],
+                "diaObject": {},
+               }
+
+        isddf = alert.diaobject.isddf
+
+        # Extract the source that triggered this alert
+
+        t0 = time.perf_counter()
+        diasource = alert.diasource
+        rec["diaSource"] = { f: getattr( diasource, col ) for f, col in self.diasourcefields }
+        cls._sourcetime += time.perf_counter() - t0
+        if isddf: cls._ddfsourcetime += time.perf_counter() - t0
+
+        # Extract the object of this source
+
+        t0 = time.perf_counter()
+        diaobject = alert.diaobject
+        rec["diaObject"] = { f: getattr( diaobject, col ) for f, col in self.objectfields }
+        cls._objecttime += time.perf_counter() - t0
+        if isddf: cls._ddfobjecttime += time.perf_counter() - t0
+
+        # Extract previous sources
+
+        t0 = time.perf_counter()
+        tai = diasource.midpointtai
+        args = ( diasource.diaobject_id, )
+        if debug:
+            self._explain( self.prvsourcestmt, args )
+        self.cursor.execute( f"EXECUTE {self.prvsourcestmt}(%s)", args )
+        rows = self.cursor.fetchall()
+        taidex = self.sourcetaidex
+        firstsourcetime = rows[0][taidex]
+        rec["prvDiaSources"] = [ dict( zip( self.sourcefields, row ) ) for row in rows
+                                 if ( row[taidex] >= tai - daysprevious ) and ( row[taidex] < tai ) ]
+        cls._prvsourcetime += time.perf_counter() - t0
+        if isddf: cls._ddfprvsourcetime += time.perf_counter() - t0
+
+        # Extract previous forced sources
+
+        t0 = time.perf_counter()
+
+        # If this source is the same night as the original detection, then
+        # there will be no forced source information
+
+        if tai - firstsourcetime > 0.5:
+            args = ( diasource.diaobject_id, max( tai - daysprevious, firstsourcetime - 30 ), tai )
+            if debug:
+                self._explain( self.prvforcedstmt, args )
+            self.cursor.execute( f"EXECUTE {self.prvforcedstmt}(%s,%s,%s)", args )
+            rows = self.cursor.fetchall()
+            if ( nprevious is not None ) and ( len(rows) > nprevious ):
+                rows = rows[-nprevious:]
+            rec["prvDiaForcedSources"] = [ dict( zip( self.forcedfields, row ) ) for row in rows ]
+
+        cls._prvforcedsourcetime += time.perf_counter() - t0
+        if isddf: cls._ddfprvforcedsourcetime += time.perf_counter() - t0
+
+        return rec
+
 
 class BaseAlert(Createable):
     alert_id = models.BigIntegerField( primary_key=True, unique=True, db_index=True )
@@ -284,12 +481,42 @@ class BaseAlert(Createable):
 
     _hackqueryshown = 0
 
-    def __init__( self, *args, **kwargs ):
-        super().__init__( *args, **kwargs )
-        self._objectfields = None
-        self._objectfieldmap = None
-        self._sourcefields = None
-        self._sourcefieldmap = None
+    _bulkalerttime = 0
+    _bulksourcetime = 0
+    _bulkforcedsourcetime = 0
+    _bulkassembletime = 0
+    _marksenttime = 0
+
+    _session = None
+
+    @classmethod
+    def _find_forcedsource_objectindex( cls, cursor ):
+        """Figure out (and cache) the name of the diaobject_id index on the forced source table.
+
+        cursor must be a RealDictCursor.  Needed for the pg_hint_plan
+        hint in the forced source queries; see the long comment in
+        AlertReconstructionSession.
+
+        """
+        if cls._forcedsourceclass._objectindex is None:
+            dexre = re.compile( 'USING\s+btree\s*\(\s*diaobject_id\s*\)' )
+            cursor.execute( "SELECT * FROM pg_indexes WHERE tablename=%(tab)s",
+                            { "tab": cls._forcedsourceclass._meta.db_table } )
+            for row in cursor.fetchall():
+                match = dexre.search( row['indexdef'] )
+                if match is not None:
+                    cls._forcedsourceclass._objectindex = row['indexname']
+                    break
+            if cls._forcedsourceclass._objectindex is None:
+                raise RuntimeError( f"Failed to find the diaobject_id index for {cls._forcedsourceclass}" )
+        return cls._forcedsourceclass._objectindex
+
+    @classmethod
+    def session( cls ):
+        """Return this process' AlertReconstructionSession for this class, creating it if necessary."""
+        if ( cls._session is None ) or ( cls._session.pid != os.getpid() ):
+            cls._session = AlertReconstructionSession( cls )
+        return cls._session
 
     def reconstruct( self, daysprevious=365, nprevious=None, debug=False ):
         """Reconstruct the dictionary that represents this alert.
@@ -305,179 +532,243 @@ class BaseAlert(Createable):
            should be an integer; will only include this many previous
            sources and forcedsources.
 
-        """
-        # Bobby Tables
-        daysprevious = float( daysprevious )
-
-        alert = { "alertId": self.alert_id,
-                  "diaSource": {},
-                  "prvDiaSources": [],
-                  "prvDiaForcedSources": [],
-                  "diaObject": {},
-                 }
+        The work is done by the per-process AlertReconstructionSession
+        (see session()).  To do a lot of alerts at once, bulk_reconstruct
+        is much faster.
 
-        gratuitous = django.db.connection.cursor()
-        conn = gratuitous.connection
-        cursor = conn.cursor( cursor_factory=psycopg2.extras.RealDictCursor )
+        """
+        return self.session().reconstruct( self, daysprevious=daysprevious, nprevious=nprevious, debug=debug )
 
-        isddf = self.diaobject.isddf
+    @staticmethod
+    def limit_history( alert, daysprevious ):
+        """Return a copy of a reconstructed alert with its history cut down to daysprevious days.
 
-        # Make sure we know the name of the forced source index
+        alert must have been reconstructed with a daysprevious at least
+        this big, and with nprevious=None; the result is then the same
+        as if it had been reconstructed with this daysprevious, without
+        going back to the database.
 
-        if self._forcedsourceclass._objectindex is None:
-            dexre = re.compile( 'USING\s+btree\s*\(\s*diaobject_id\s*\)' )
-            cursor.execute( "SELECT * FROM pg_indexes WHERE tablename=%(tab)s",
-                            { "tab": self._forcedsourceclass._meta.db_table } )
-            for row in cursor.fetchall():
-                match = dexre.search( row['indexdef'] )
-                if match is not None:
-                    self._forcedsourceclass._objectindex = row['indexname']
-                    break
-            if self._forcedsourceclass._objectindex is None:
-                raise RuntimeError( f"Failed to find the diaobject_id index for {self._forcedsourceclass}" )
+        """
+        mintai = alert["diaSource"]["midPointTai"] - float( daysprevious )
+        limited = dict( alert )
+        for which in [ "prvDiaSources", "prvDiaForcedSources" ]:
+            hist = alert[ which ]
+            dex = bisect.bisect_left( hist, mintai, key=lambda row: row["midPointTai"] )
+            limited[ which ] = hist[dex:]
+        return limited
 
-        # Extract the source that triggered this alert
+    @classmethod
+    def mark_sent( cls, alertids, senttime=None ):
+        """Set alertsenttimestamp for a bunch of alerts with a single UPDATE.
 
-        t0 = time.perf_counter()
-        if self._sourcefields is None:
-            self._sourcefields = [ "diaSourceId", "diaObjectId", "midPointTai",
-                                   "filterName", "ra", "decl", "psFlux", "psFluxErr", "snr" ]
-            self._sourcefieldmap = { i: i.lower() for i in self._sourcefields }
-            self._sourcefieldmap["diaSourceId"] = 'diasource_id'
-            self._sourcefieldmap["diaObjectId"] = 'diaobject_id'
-        alert["diaSource"] = { f: getattr( self.diasource, self._sourcefieldmap[ f ] ) for f in self._sourcefields }
-        # for field in sourcefields:
-        #     alert["diaSource"][field] = getattr( self.diasource, sourcefieldmap[ field ] )
-        self.__class__._sourcetime += time.perf_counter() - t0
-        if isddf: self.__class__._ddfsourcetime += time.perf_counter() - t0
+        alertids : list of alert ids
+        senttime : datetime to set; defaults to now
 
-        # Extract the object of this source
+        Returns the number of alerts updated.
 
+        """
+        if len( alertids ) == 0:
+            return 0
+        if senttime is None:
+            senttime = datetime.datetime.now( datetime.timezone.utc )
         t0 = time.perf_counter()
-        if self._objectfields is None:
-            self._objectfields = [ "diaObjectId", "simVersion", "ra", "decl", "mwebv", "mwebv_err",
-                                   "z_final", "z_final_err" ]
-            for suffix in [ "", "2" ]:
-                for hgfield in [ "ellipticity", "sqradius", "zspec", "zspec_err", "zphot", "zphot_err",
-                                 "zphot_q000", "zphot_q010", "zphot_q020", "zphot_q030", "zphot_q040",
-                                 "zphot_q050", "zphot_q060", "zphot_q070", "zphot_q080", "zphot_q090", "zphot_q100",
-                                 "mag_u", "mag_g", "mag_r", "mag_i", "mag_z", "mag_Y",
-                                 "ra", "dec", "snsep",
-                                 "magerr_u", "magerr_g", "magerr_r", "magerr_i", "magerr_z", "magerr_Y" ]:
-                    self._objectfields.append( f"hostgal{suffix}_{hgfield}" )
-            self._objectfieldmap = { i: i.lower() for i in self._objectfields }
-            self._objectfieldmap["diaObjectId"] = "diaobject_id"
-        self.__class__._objectoverheadtime += time.perf_counter() - t0
-
-        alert["diaObject"] = { f : getattr( self.diaobject, self._objectfieldmap[ f ] ) for f in self._objectfields }
-        # for field in self._objectfields:
-        #     alert["diaObject"][field] = getattr( self.diaobject, self._objectfieldmap[ field ] )
-        self.__class__._objecttime += time.perf_counter() - t0
-        if isddf: self.__class__._ddfobjecttime += time.perf_counter() - t0
+        with django.db.connection.cursor() as cursor:
+            cursor.execute( f"UPDATE {cls._meta.db_table} SET alertsenttimestamp=%(t)s "
+                            f"WHERE alert_id = ANY(%(ids)s)",
+                            { 't': senttime, 'ids': [ int(i) for i in alertids ] } )
+            nupdated = cursor.rowcount
+        cls._marksenttime += time.perf_counter() - t0
+        return nupdated
 
-        # Extract previous sources
-
-        t0 = time.perf_counter()
-        q = ( f'SELECT diasource_id AS "diaSourceId", '
-              f'       diaobject_id AS "diaObjectId", '
-              f'       midpointtai AS "midPointTai", '
-              f'       filtername AS "filterName", '
-              f'       ra, '
-              f'       decl, '
-              f'       psflux AS "psFlux", '
-              f'       psfluxerr AS "psFluxErr", '
-              f'       snr '
-              f'FROM {self._sourceclass._meta.db_table} '
-              f'WHERE diaobject_id={self.diasource.diaobject_id} '
-              f'ORDER BY midpointtai' )
-        if debug:
-            strio = io.StringIO()
-            strio.write( f"Query: {q}\n" )
-            cursor.execute( f"EXPLAIN ANALYZE {q}" )
-            for r in cursor.fetchall():
-                strio.write( f"{r['QUERY PLAN']}\n" )
-            _logger.info( strio.getvalue() )
-        cursor.execute( q )
-        allsources = [ dict(row) for row in cursor.fetchall() ]
-        firstsourcetime = allsources[0]['midPointTai']
-        alert["prvDiaSources"] = [ row for row in allsources
-                                   if row['midPointTai'] >= self.diasource.midpointtai - daysprevious
-                                   and row['midPointTai'] < self.diasource.midpointtai ]
-        self.__class__._prvsourcetime += time.perf_counter() - t0
-        if isddf: self.__class__._ddfprvsourcetime += time.perf_counter() - t0
-
-        # Extra previous forced sources
+    @classmethod
+    def bulk_reconstruct( cls, alertids=None, mintai=None, maxtai=None, daysprevious=365, nprevious=None,
+                          withisddf=False ):
+        """Reconstruct the dictionaries for a whole batch of alerts at once.
+
+        Produces the same thing as reconstruct, but instead of issuing
+        several queries per alert, it does a handful of set-based
+        queries for the whole batch (alerts joined to their sources and
+        objects; all sources of the batch's objects; the relevant forced
+        sources of the batch's objects), and then slices out each
+        alert's history in memory.
+
+        alertids : A list of alert ids to reconstruct.
+        mintai, maxtai : Ignored if alertids is not None.  Otherwise,
+           reconstruct all alerts whose triggering source has
+           mintai <= midpointtai < maxtai.  One may be None, but not
+           both.
+        daysprevious, nprevious : See reconstruct.
+        withisddf : If True, returns a list of (alert, isddf) tuples
+           instead of just a list of alerts.
+
+        Returns a list of alert dicts.  If alertids was given, they are
+        in the same order as alertids (with ids not found in the
+        database omitted); otherwise, they are sorted by the midpointtai
+        of the alert's source.  Note that dicts in prvDiaSources and
+        prvDiaForcedSources may be shared between different alerts
+        on the same object, so don't modify them in place.
 
-        t0 = time.perf_counter()
+        """
+        # Bobby Tables
+        daysprevious = float( daysprevious )
 
-        # If this source is the same night as the original detection, then
-        # there will be no forced source information
+        subdict = {}
+        if alertids is not None:
+            alertids = [ int(i) for i in alertids ]
+            if len( alertids ) == 0:
+                return []
+            where = "a.alert_id = ANY(%(alertids)s)"
+            subdict['alertids'] = alertids
+        elif ( mintai is not None ) or ( maxtai is not None ):
+            conds = []
+            if mintai is not None:
+                conds.append( "s.midpointtai >= %(mintai)s" )
+                subdict['mintai'] = float( mintai )
+            if maxtai is not None:
+                conds.append( "s.midpointtai < %(maxtai)s" )
+                subdict['maxtai'] = float( maxtai )
+            where = " AND ".join( conds )
+        else:
+            raise ValueError( "bulk_reconstruct needs either alertids or at least one of mintai and maxtai" )
 
-        if self.diasource.midpointtai - firstsourcetime > 0.5:
-            # Witout the hint (which requires the pg_hint_plan postgres
-            # extension, which is included in the postgres Dockerfile
-            # packed with this archive) postgres was sometimes doing a
-            # parallel index scan on diaobject_id midpointtai, and then
-            # ANDing the results of those two scans together.  This is
-            # absurd, however, because the diaobject_id index scan is
-            # simpler, and cuts the list down WAY more (by 4-6 orders of
-            # magnitude)... and EXPLAIN ANALYZE shows that it runs a two
-            # orders of magnitude faster than the other index scan.
-            # And, of course, I could have predicted this ahead of time
-            # because I know that the diaobject filter is going to cut
-            # the number of rows down by (to first approximation) 4
-            # million (the number of different objects), whereas the
-            # midpointtai query is going to cut the number of rows down
-            # by a factor of ~3 or ~30 (1 year, or 0.1 year, out of 3
-            # years).
-            #
-            # The IndexScan hint makes it do an index scan with JUST the
-            # diaobject_id index; my current belief is that even in
-            # extreme cases, the subsequent sequential scan of
-            # midpointttai on the sources just for the object will be
-            # faster than the midpointtai index scan of the whole table.
-            # I should learn how to use pg_hint_plan better to tell it
-            # to do first one then the other index scan.
-            #
-            # (Why even have the midpointtai index? you ask.  Well, you might
-            # want to search by time without searching first by object, in
-            # which case you really want that index.)
-
-            q = ( f'/*+ IndexScan( {self._forcedsourceclass._meta.db_table} {self._forcedsourceclass._objectindex} ) '
-                  f'*/ '
-                  f'SELECT diaforcedsource_id as "diaForcedSourceId",'
-                  f'       diaobject_id as "diaObjectId",'
-                  f'       midpointtai as "midPointTai",'
-                  f'       filtername as "filterName",'
-                  f'       psflux as "psFlux",'
-                  f'       psfluxerr as "psFluxErr" '
-                  f'FROM {self._forcedsourceclass._meta.db_table} '
-                  f'WHERE diaobject_id={self.diasource.diaobject_id} '
-                  f'  AND midpointtai>={self.diasource.midpointtai - daysprevious} '
-                  f'  AND midpointtai>={firstsourcetime - 30} '
-                  f'  AND midpointtai<{self.diasource.midpointtai} '
-                  f'ORDER BY midpointtai' )
+        alerttab = cls._meta.db_table
+        srctab = cls._sourceclass._meta.db_table
+        objtab = cls._objectclass._meta.db_table
+        frctab = cls._forcedsourceclass._meta.db_table
 
-            if debug:
-                strio = io.StringIO()
-                strio.write( f"Query: {q}\n" )
-                cursor.execute( f"EXPLAIN ANALYZE {q}" )
-                for r in cursor.fetchall():
-                    strio.write( f"{r['QUERY PLAN']}\n" )
-                _logger.info( strio.getvalue() )
-            cursor.execute( q )
-            alert["prvDiaForcedSources"] = [ dict(o) for o in cursor.fetchall() ]
-            if ( nprevious is not None ) and ( len(alert["prvDiaForcedSources"]) > nprevious ):
-                alert["prvDiaForcedSources"] = alert["prvDiaForcedSources"][-nprevious:]
+        gratuitous = django.db.connection.cursor()
+        conn = gratuitous.connection
+        cursor = conn.cursor( cursor_factory=psycopg2.extras.RealDictCursor )
 
-        # else:
-        #     _logger.warn( "Not adding previous" )
-        self.__class__._prvforcedsourcetime += time.perf_counter() - t0
-        if isddf: self.__class__._ddfprvforcedsourcetime += time.perf_counter() - t0
+        try:
+            frcdex = cls._find_forcedsource_objectindex( cursor )
+
+            # The alerts themselves, with their objects
+
+            t0 = time.perf_counter()
+            objcols = ", ".join( f'o.{_reconstruct_objectfieldmap[f]} AS "{f}"' for f in _reconstruct_objectfields )
+            q = ( f'SELECT a.alert_id AS "_alertid", a.diasource_id AS "_diasourceid", '
+                  f'       s.midpointtai AS "_midpointtai", o.isddf AS "_isddf", {objcols} '
+                  f'FROM {alerttab} a '
+                  f'INNER JOIN {srctab} s ON a.diasource_id=s.diasource_id '
+                  f'INNER JOIN {objtab} o ON a.diaobject_id=o.diaobject_id '
+                  f'WHERE {where} '
+                  f'ORDER BY s.midpointtai, a.alert_id' )
+            cursor.execute( q, subdict )
+            alertrows = cursor.fetchall()
+            cls._bulkalerttime += time.perf_counter() - t0
+            if len( alertrows ) == 0:
+                return []
+
+            # All sources of all of the objects in the batch, in one ordered scan.
+            # We need all of them, not just the ones before each alert,
+            # because reconstruct uses the very first source to decide
+            # whether or not to include forced sources.
+
+            t0 = time.perf_counter()
+            objids = list( { row['diaObjectId'] for row in alertrows } )
+            srccols = ", ".join( f'{_reconstruct_sourcefieldmap[f]} AS "{f}"' for f in _reconstruct_sourcefields )
+            q = ( f'SELECT {srccols} FROM {srctab} '
+                  f'WHERE diaobject_id = ANY(%(objids)s) '
+                  f'ORDER BY diaobject_id, midpointtai' )
+            cursor.execute( q, { 'objids': objids } )
+            sourcebyid = {}
+            objsources = { i: [] for i in objids }
+            for row in cursor.fetchall():
+                sourcebyid[ row['diaSourceId'] ] = row
+                objsources[ row['diaObjectId'] ].append( row )
+            objsourcetimes = { objid: [ s['midPointTai'] for s in srcs ] for objid, srcs in objsources.items() }
+            cls._bulksourcetime += time.perf_counter() - t0
+
+            # Forced sources.  Figure out, for each object, the widest
+            # window any alert on that object in this batch needs, and
+            # pull everything in those windows with a single query.
+
+            t0 = time.perf_counter()
+            frcwindows = {}
+            for row in alertrows:
+                objid = row['diaObjectId']
+                tai = row['_midpointtai']
+                firsttai = objsourcetimes[objid][0]
+                # Same night as the original detection means no forced sources
+                if tai - firsttai <= 0.5:
+                    continue
+                lower = max( tai - daysprevious, firsttai - 30 )
+                if objid not in frcwindows:
+                    frcwindows[objid] = [ lower, tai ]
+                else:
+                    frcwindows[objid][0] = min( frcwindows[objid][0], lower )
+                    frcwindows[objid][1] = max( frcwindows[objid][1], tai )
+
+            objforced = { i: [] for i in frcwindows.keys() }
+            if len( frcwindows ) > 0:
+                frcobjids = list( frcwindows.keys() )
+                frccols = ", ".join( f'f.{_reconstruct_forcedsourcefieldmap[f]} AS "{f}"'
+                                     for f in _reconstruct_forcedsourcefields )
+                # See the comment in AlertReconstructionSession about the pg_hint_plan hint
+                q = ( f'/*+ IndexScan( f {frcdex} ) */ '
+                      f'SELECT {frccols} FROM {frctab} f '
+                      f'INNER JOIN unnest( %(objids)s::bigint[], %(mint)s::double precision[], '
+                      f'                   %(maxt)s::double precision[] ) AS b(objid,mint,maxt) '
+                      f'  ON f.diaobject_id=b.objid '
+                      f'WHERE f.midpointtai>=b.mint AND f.midpointtai<b.maxt '
+                      f'ORDER BY f.diaobject_id, f.midpointtai' )
+                cursor.execute( q, { 'objids': frcobjids,
+                                     'mint': [ frcwindows[i][0] for i in frcobjids ],
+                                     'maxt': [ frcwindows[i][1] for i in frcobjids ] } )
+                for row in cursor.fetchall():
+                    objforced[ row['diaObjectId'] ].append( row )
+            objforcedtimes = { objid: [ f['midPointTai'] for f in frcs ] for objid, frcs in objforced.items() }
+            cls._bulkforcedsourcetime += time.perf_counter() - t0
+
+        finally:
+            conn.rollback()
+            cursor.close()
+
+        # Slice out each alert's history
 
-        conn.rollback()
+        t0 = time.perf_counter()
+        alerts = {}
+        isddfs = {}
+        for row in alertrows:
+            objid = row['diaObjectId']
+            tai = row['_midpointtai']
+            if row['_diasourceid'] not in sourcebyid:
+                raise RuntimeError( f"Alert {row['_alertid']} has source {row['_diasourceid']} that is not "
+                                    f"associated with object {objid}" )
+            srcs = objsources[ objid ]
+            srctimes = objsourcetimes[ objid ]
+            lo = bisect.bisect_left( srctimes, tai - daysprevious )
+            hi = bisect.bisect_left( srctimes, tai )
+
+            alert = { "alertId": row['_alertid'],
+                      "diaSource": sourcebyid[ row['_diasourceid'] ],
+                      "prvDiaSources": srcs[lo:hi],
+                      "prvDiaForcedSources": [],
+                      "diaObject": { f: row[f] for f in _reconstruct_objectfields },
+                     }
+
+            if tai - srctimes[0] > 0.5:
+                frctimes = objforcedtimes[ objid ]
+                lo = bisect.bisect_left( frctimes, max( tai - daysprevious, srctimes[0] - 30 ) )
+                hi = bisect.bisect_left( frctimes, tai )
+                if ( nprevious is not None ) and ( hi - lo > nprevious ):
+                    lo = hi - nprevious
+                alert["prvDiaForcedSources"] = objforced[ objid ][lo:hi]
+
+            alerts[ row['_alertid'] ] = alert
+            isddfs[ row['_alertid'] ] = row['_isddf']
+
+        if alertids is not None:
+            order = [ i for i in alertids if i in alerts ]
+        else:
+            order = [ row['_alertid'] for row in alertrows ]
+        cls._bulkassembletime += time.perf_counter() - t0
 
-        return alert
+        if withisddf:
+            return [ ( alerts[i], isddfs[i] ) for i in order ]
+        else:
+            return [ alerts[i] for i in order ]
 
 
 # ======================================================================
@@ -832,6 +1123,86 @@ class BrokerClassifier(models.Model):
             models.Index(fields=["brokername", "brokerversion", "classifiername", "classifierparams"]),
         ]
 
+    # A process-wide cache of { ( brokername, brokerversion, classifiername, classifierparams ) : classifier_id }
+    # There are only hundreds of classifiers, and they almost never change,
+    # so there's no reason to go to the database for them with every batch
+    # of broker messages.  Classifiers never get deleted or modified, so
+    # the cache never goes stale; it can only be missing things.
+    _registry = {}
+    _registryhits = 0
+    _registrymisses = 0
+
+    @classmethod
+    def warm_registry( cls ):
+        """Load all known classifiers into the registry; returns the number in the registry."""
+        for cfer in cls.objects.all().values( 'classifier_id', 'brokername', 'brokerversion',
+                                              'classifiername', 'classifierparams' ):
+            brokertag = ( cfer['brokername'], cfer['brokerversion'],
+                          cfer['classifiername'], cfer['classifierparams'] )
+            # If there are duplicates in the table, be consistent about which one we use
+            if ( brokertag not in cls._registry ) or ( cfer['classifier_id'] < cls._registry[brokertag] ):
+                cls._registry[ brokertag ] = cfer['classifier_id']
+        return len( cls._registry )
+
+    @classmethod
+    def clear_registry( cls ):
+        """Forget everything in the registry.  Only needed if classifiers are deleted (e.g. in tests)."""
+        cls._registry = {}
+        cls._registryhits = 0
+        cls._registrymisses = 0
+
+    @classmethod
+    def registry_stats( cls ):
+        return { 'classifiers': len( cls._registry ),
+                 'hits': cls._registryhits,
+                 'misses': cls._registrymisses }
+
+    @classmethod
+    def ids_for( cls, brokertags ):
+        """Get classifier_ids, creating classifiers as necessary.
+
+        brokertags is an iterable of ( brokername, brokerversion,
+        classifiername, classifierparams ).
+
+        Returns ( { brokertag: classifier_id }, number of classifiers created )
+
+        In the steady state, this doesn't touch the database.  Classifiers
+        not in the registry are looked for and (if necessary) created while
+        holding a postgres advisory lock, so that the several processes
+        that brokerpoll2 launches can't create the same classifier twice.
+        (There's no unique constraint on the table to lean on; brokerversion
+        and classifierparams are nullable.)
+
+        """
+        brokertags = set( brokertags )
+        missing = [ t for t in brokertags if t not in cls._registry ]
+        cls._registryhits += len( brokertags ) - len( missing )
+        cls._registrymisses += len( missing )
+
+        nadded = 0
+        if len( missing ) > 0:
+            with django.db.transaction.atomic():
+                with django.db.connection.cursor() as cursor:
+                    cursor.execute( f"SELECT pg_advisory_xact_lock( hashtext( '{cls._meta.db_table}' ) )" )
+                    for brokertag in missing:
+                        subdict = { 'bn': brokertag[0], 'bv': brokertag[1], 'cn': brokertag[2], 'cp': brokertag[3] }
+                        cursor.execute( f"SELECT classifier_id FROM {cls._meta.db_table} "
+                                        f"WHERE brokername=%(bn)s AND brokerversion IS NOT DISTINCT FROM %(bv)s "
+                                        f"  AND classifiername=%(cn)s AND classifierparams IS NOT DISTINCT FROM %(cp)s "
+                                        f"ORDER BY classifier_id LIMIT 1", subdict )
+                        row = cursor.fetchone()
+                        if row is None:
+                            cursor.execute( f"INSERT INTO {cls._meta.db_table}"
+                                            f"(brokername,brokerversion,classifiername,classifierparams,modified) "
+                                            f"VALUES (%(bn)s,%(bv)s,%(cn)s,%(cp)s,NOW()) "
+                                            f"RETURNING classifier_id", subdict )
+                            row = cursor.fetchone()
+                            nadded += 1
+                        cls._registry[ brokertag ] = row[0]
+
+        return { t: cls._registry[t] for t in brokertags }, nadded
+
+
 class BrokerMessage( models.Model ):
     brokermessage_id = models.BigAutoField( primary_key=True )
     streammessage_id = models.BigIntegerField( null=True )
@@ -848,84 +1219,129 @@ class BrokerMessage( models.Model ):
     classid = ArrayField( models.SmallIntegerField(), default=list )
     probability = ArrayField( Float32Field(), default=list )
 
+    # So that things like BrokerConsumer can get at the classifier registry
+    _classifiermodel = BrokerClassifier
+
     @staticmethod
     def load_batch( messages, logger=_logger ):
 
         # Identify classifiers, create new ones as necessary
 
-        classifiers = {}
-        seenbrokers = set()
-        cferconds = models.Q()
-        for msg in messages:
-            brokertag = ( msg['msg']['brokerName'], msg['msg']['brokerVersion'],
-                          msg['msg']['classifierName'], msg['msg']['classifierParams'] )
-            if brokertag not in seenbrokers:
-                seenbrokers.add( brokertag )
-                newcond = ( models.Q( brokername = msg['msg']['brokerName'] ) &
-                            models.Q( brokerversion = msg['msg']['brokerVersion'] ) &
-                            models.Q( classifiername = msg['msg']['classifierName'] ) &
-                            models.Q( classifierparams = msg['msg']['classifierParams'] ) )
-                cferconds |= newcond
-        curcfers = BrokerClassifier.objects.filter( cferconds )
-        for cur in curcfers:
-            brokertag = ( cur.brokername, cur.brokerversion, cur.classifiername, cur.classifierparams )
-            classifiers[ brokertag ] = cur
-
-        kwargses = []
-        for brokertag in seenbrokers:
-            if brokertag not in classifiers.keys():
-                kwargses.append( { 'brokername': brokertag[0],
-                                   'brokerversion': brokertag[1],
-                                   'classifiername': brokertag[2],
-                                   'classifierparams': brokertag[3] } )
-        ncferstoadd = len(kwargses)
-        logger.debug( f"Adding {ncferstoadd} new classifiers" )
-        if ncferstoadd > 0:
-            objs = ( BrokerClassifier( **k ) for k in kwargses )
-            batch = list( itertools.islice( objs, len(kwargses ) ) )
-            newcfers = BrokerClassifier.objects.bulk_create( batch, len(kwargses) )
-            for cfer in newcfers:
-                brokertag = ( cfer.brokername, cfer.brokerversion, cfer.classifiername, cfer.classifierparams )
-                classifiers[ brokertag ] = cfer
-
-        # Now add the messages
-
-        kwargses = []
+        classifiers, ncferstoadd = BrokerClassifier.ids_for(
+            ( msg['msg']['brokerName'], msg['msg']['brokerVersion'],
+              msg['msg']['classifierName'], msg['msg']['classifierParams'] ) for msg in messages )
+        logger.debug( f"Added {ncferstoadd} new classifiers" )
+
+        # Now add the messages.  Rather than building model objects
+        # and using bulk_create, write the rows straight into a COPY
+        # buffer, COPY them into a temp table, and from there insert
+        # into both this table and BrokerSourceIds in one transaction.
+
+        descingesttimestamp = datetime.datetime.now( tz=pytz.utc )
         messtags = set()
-        sourceids = set()
+        strio = io.StringIO()
         for msg in messages:
             brokertag = ( msg['msg']['brokerName'], msg['msg']['brokerVersion'],
                           msg['msg']['classifierName'], msg['msg']['classifierParams'] )
             msgtag = ( brokertag, msg['msgoffset'], msg['topic'], msg['msg']['alertId'] )
             if msgtag not in messtags:
                 messtags.add( msgtag )
-                kwargs = { 'streammessage_id': msg['msgoffset'],
-                           'topicname': msg['topic'],
-                           'alert_id': msg['msg']['alertId'],
-                           'diasource_id': msg['msg']['diaSourceId'],
-                           'msghdrtimestamp': msg['timestamp'],
-                           'descingesttimestamp': datetime.datetime.now( tz=pytz.utc ),
-                           'elasticcpublishtimestamp': msg['msg']['elasticcPublishTimestamp'],
-                           'brokeringesttimestamp': msg['msg']['brokerIngestTimestamp'],
-                           'classifier_id': classifiers[brokertag].classifier_id,
-                           'classid': [ c['classId'] for c in msg['msg']['classifications'] ],
-                           'probability': [ c['probability'] for c in msg['msg']['classifications'] ]
-                          }
-                kwargses.append( kwargs )
-                sourceids.add( msg['msg']['diaSourceId'] )
-        BrokerSourceIds.add_batch( sourceids )
-        if len(kwargses) > 0:
-            # This is byzantine, but I'm copying django documentation here
-            objs = ( BrokerMessage( **k ) for k in kwargses )
-            batch = list( itertools.islice( objs, len(kwargses) ) )
-            if batch is None:
-                raise RunTimeError( "Something bad has happened." )
-            addedmsgs = BrokerMessage.objects.bulk_create( batch, len(kwargses) )
-
-        return { "addedmsgs": len(addedmsgs),
+                row = ( msg['msgoffset'],
+                        msg['topic'],
+                        msg['msg']['alertId'],
+                        msg['msg']['diaSourceId'],
+                        msg['timestamp'],
+                        descingesttimestamp,
+                        msg['msg']['elasticcPublishTimestamp'],
+                        msg['msg']['brokerIngestTimestamp'],
+                        classifiers[brokertag],
+                        [ c['classId'] for c in msg['msg']['classifications'] ],
+                        [ c['probability'] for c in msg['msg']['classifications'] ] )
+                strio.write( "\t".join( BrokerMessage._copyval( v ) for v in row ) )
+                strio.write( "\n" )
+
+        naddedmsgs = 0
+        firstbrokermessage_id = None
+        if len( messtags ) > 0:
+            strio.seek( 0 )
+            naddedmsgs, firstbrokermessage_id = BrokerMessage._copy_batch( strio )
+
+        return { "addedmsgs": naddedmsgs,
                  "addedclassifiers": ncferstoadd,
                  "addedclassifications": None,
-                 "firstbrokermessage_id": None if len(addedmsgs)==0 else addedmsgs[0].brokermessage_id }
+                 "firstbrokermessage_id": firstbrokermessage_id }
+
+    _copycolumns = ( 'streammessage_id', 'topicname', 'alert_id', 'diasource_id',
+                     'msghdrtimestamp', 'descingesttimestamp', 'elasticcpublishtimestamp', 'brokeringesttimestamp',
+                     'classifier_id', 'classid', 'probability' )
+
+    @staticmethod
+    def _copyval( val ):
+        """Format val for a postgres COPY text-format column."""
+        if val is None:
+            return "\\N"
+        if isinstance( val, list ):
+            return "{" + ",".join( str(v) for v in val ) + "}"
+        if isinstance( val, datetime.datetime ):
+            return val.isoformat()
+        if isinstance( val, str ):
+            return ( val.replace( "\\", "\\\\" ).replace( "\t", "\\t" )
+                     .replace( "\n", "\\n" ).replace( "\r", "\\r" ) )
+        return str( val )
+
+    @staticmethod
+    def _copy_batch( strio ):
+        """COPY the rows in strio (columns BrokerMessage._copycolumns) into the database.
+
+        Also adds the diasource_ids of those rows to BrokerSourceIds.
+        It all happens in one transaction.
+
+        Returns ( number of messages added, lowest brokermessage_id added )
+
+        """
+        conn = None
+        origautocommit = None
+        gratuitous = None
+        cursor = None
+        columns = ",".join( BrokerMessage._copycolumns )
+        try:
+            # Same hoop-jumping as in Createable.bulk_insert_onlynew
+            gratuitous = django.db.connection.cursor()
+            conn = gratuitous.connection
+            origautocommit = conn.autocommit
+            conn.autocommit = False
+            cursor = conn.cursor()
+            # Don't use CREATE TABLE ... LIKE here, because that would copy
+            # the NOT NULL on brokermessage_id, which we leave for the
+            # sequence to fill in.
+            cursor.execute( f"CREATE TEMP TABLE bulk_brokermessage ON COMMIT DROP AS "
+                            f"SELECT {columns} FROM {BrokerMessage._meta.db_table} WITH NO DATA" )
+            cursor.copy_from( strio, "bulk_brokermessage", columns=BrokerMessage._copycolumns, size=1048576 )
+            cursor.execute( f"INSERT INTO {BrokerMessage._meta.db_table}({columns}) "
+                            f"SELECT {columns} FROM bulk_brokermessage "
+                            f"RETURNING brokermessage_id" )
+            ids = [ row[0] for row in cursor.fetchall() ]
+            # Sort so that simultaneous loaders take row locks in the same order
+            cursor.execute( f"INSERT INTO {BrokerSourceIds._meta.db_table}(diasource_id) "
+                            f"SELECT DISTINCT diasource_id FROM bulk_brokermessage ORDER BY diasource_id "
+                            f"ON CONFLICT DO NOTHING" )
+            conn.commit()
+            return len(ids), ( min(ids) if len(ids) > 0 else None )
+        except Exception as e:
+            if conn is not None:
+                conn.rollback()
+            raise e
+        finally:
+            if cursor is not None:
+                cursor.close()
+                cursor = None
+            if gratuitous is not None:
+                gratuitous.close()
+                gratuitous = None
+            if origautocommit is not None and conn is not None:
+                conn.autocommit = origautocommit
+                origautocommit = None
+                conn = None
 
 
 
@@ -999,48 +1415,14 @@ class CassBrokerMessageBySource(DjangoCassandraModel):
                                      'classifier_id': None }
             sourceids.append( msg['diaSourceId'] )
 
-        # Create any classifiers that don't already exist; this
-        # is one place where we do get efficiency by calling
-        # this batch method.
-        cferconds = models.Q()
-        logger.debug( f"Looking for pre-existing classifiers" )
-        cferconds = models.Q()
-        i = 0
-        for cferkey, cfer in cfers.items():
-            newcond = ( models.Q( brokername = cfer['brokername'] ) &
-                        models.Q( brokerversion = cfer['brokerversion'] ) &
-                        models.Q( classifiername = cfer['classifiername'] ) &
-                        models.Q( classifierparams = cfer['classifierparams'] ) )
-            cferconds |= newcond
-        curcfers = BrokerClassifier.objects.filter( cferconds )
-        numknown = 0
-        for cur in curcfers:
-            keycfer = f"{cur.brokername}_{cur.brokerversion}_{cur.classifiername}_{cur.classifierparams}"
-            cfers[ keycfer ][ 'classifier_id' ] = cur.classifier_id
-            numknown += 1
-        logger.debug( f'Found {numknown} existing classifiers that match the ones in this batch.' )
-
-        # Create new classifiers as necessary
-
-        kwargses = []
-        ncferstoadd = 0
-        for keycfer, cfer in cfers.items():
-            if cfer[ 'classifier_id' ] is None:
-                kwargses.append( { 'brokername': cfer['brokername'],
-                                   'brokerversion': cfer['brokerversion'],
-                                   'classifiername': cfer['classifiername'],
-                                   'classifierparams': cfer['classifierparams'] } )
-                ncferstoadd += 1
-        ncferstoadd = len(kwargses)
-        logger.debug( f'Adding {ncferstoadd} new classifiers.' )
-        if ncferstoadd > 0:
-            objs = ( BrokerClassifier( **k ) for k in kwargses )
-            batch = list( itertools.islice( objs, len(kwargses) ) )
-            newcfers = BrokerClassifier.objects.bulk_create( batch, len(kwargses) )
-            for newcfer in newcfers:
-                keycfer = ( f'{newcfer.brokername}_{newcfer.brokerversion}_'
-                            f'{newcfer.classifiername}_{newcfer.classifierparams}' )
-                cfers[keycfer]['classifier_id'] = newcfer.classifier_id
+        # Find (and create if necessary) classifier ids
+        cferids, ncferstoadd = BrokerClassifier.ids_for(
+            ( cfer['brokername'], cfer['brokerversion'], cfer['classifiername'], cfer['classifierparams'] )
+            for cfer in cfers.values() )
+        for cfer in cfers.values():
+            cfer['classifier_id'] = cferids[ ( cfer['brokername'], cfer['brokerversion'],
+                                               cfer['classifiername'], cfer['classifierparams'] ) ]
+        logger.debug( f'Added {ncferstoadd} new classifiers.' )
 
         # It's pretty clear that django really wants
         # to mediate your database access... otherwise
@@ -1149,9 +1531,15 @@ class DiaObjectInfo(models.Model):
             models.UniqueConstraint( fields=[ 'diaobject_id', 'filtername' ], name='diaobjectinfo_unique' )
         ]
 
+# The top four classes (by probability) from the most recent broker
+# message (by the midpointtai of the source it classified) from each
+# classifier for each object.  latestsourcemjd and latestbrokermessage_id
+# identify which message that was, so update_elasticc2_sources can fold in
+# new messages without going back to the old ones.
+
 class DiaObjectClassification(models.Model):
     _id = models.BigAutoField( primary_key=True )
-    diaobject = models.ForeignKey( DiaObjectInfo, db_column='diaobject_id',
+    diaobject = models.ForeignKey( DiaObject, db_column='diaobject_id',
                                    on_delete=models.CASCADE, null=False )
     classifier = models.ForeignKey( BrokerClassifier, db_column='classifier_id',
                                     on_delete=models.CASCADE, null=False )
@@ -1166,6 +1554,9 @@ class DiaObjectClassification(models.Model):
     latestclass3prob = Float32Field( null=True )
     latestclass4prob = Float32Field( null=True )
 
+    latestsourcemjd = models.FloatField( null=True )
+    latestbrokermessage_id = models.BigIntegerField( null=True )
+
     class Meta:
         constraints = [
             models.UniqueConstraint( fields=[ 'diaobject_id', 'classifier_id' ],
@@ -1254,3 +1645,58 @@ class PlannedSpectra(Createable):
 class ImportPPDBRunning(models.Model):
     running = models.BooleanField( default=False )
 
+# A record of each run of update_elasticc2_sources.  stages is a list of
+# { "stage": <description>, "seconds": <float>, "rows": <int or null> }
+# The run folds broker messages with frombrokermessage_id < brokermessage_id
+# <= throughbrokermessage_id into DiaObjectClassification; the next run
+# starts where this one left off.
+
+class ImportPPDBRun(models.Model):
+    run_id = models.BigAutoField( primary_key=True )
+    started = models.DateTimeField( default=django.utils.timezone.now, db_index=True )
+    finished = models.DateTimeField( null=True, default=None )
+    incremental = models.BooleanField( default=False )
+    success = models.BooleanField( default=False )
+    stages = models.JSONField( default=list )
+    frombrokermessage_id = models.BigIntegerField( null=True, default=None )
+    throughbrokermessage_id = models.BigIntegerField( null=True, default=None )
+
+# update_elasticc2_sources splits its work up into chunks of objects
+# (diaobject_id between minobjid and maxobjid inclusive), each of which is
+# committed separately.  These are the progress journal; if a run dies,
+# the next run picks up the chunks that aren't done.
+
+class ImportPPDBChunk(models.Model):
+    chunk_id = models.BigAutoField( primary_key=True )
+    run = models.ForeignKey( ImportPPDBRun, db_column='run_id', on_delete=models.CASCADE, db_index=True )
+    minobjid = models.BigIntegerField()
+    maxobjid = models.BigIntegerField()
+    done = models.BooleanField( default=False )
+    finished = models.DateTimeField( null=True, default=None )
+    stages = models.JSONField( default=list )
+
+# The new sources that a run of update_elasticc2_sources is importing,
+# saved so that a resumed run knows what they were.  (The broker source
+# ids they came from are deleted from BrokerSourceIds when the run
+# starts.)  Rows are deleted when the run finishes.
+
+class ImportPPDBSource(models.Model):
+    _id = models.BigAutoField( primary_key=True )
+    run = models.ForeignKey( ImportPPDBRun, db_column='run_id', on_delete=models.CASCADE )
+    diasource_id = models.BigIntegerField()
+    diaobject_id = models.BigIntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index( fields=[ 'run', 'diaobject_id' ] ),
+        ]
+
+# For each object, all forced sources with midpointtai <= throughmjd have
+# been copied from PPDBDiaForcedSource to DiaForcedSource by
+# update_elasticc2_sources; the next run only needs to copy later ones.
+
+class DiaObjectForcedSourceWatermark(models.Model):
+    diaobject = models.OneToOneField( DiaObject, db_column='diaobject_id', on_delete=models.CASCADE,
+                                      primary_key=True )
+    throughmjd = models.FloatField()
+
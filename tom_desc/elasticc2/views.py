@@ -637,17 +637,25 @@ class GetAlert(PermissionRequiredMixin, django.views.View):
                 raise ValueError( f"Must supply either alertid or sourceid" )
 
             if 'alertid' in data.keys():
-                alert = PPDBAlert.objects.get( pk=int( data['alertid'] ) )
+                alertids = [ int( data['alertid'] ) ]
             else:
                 # Just assume it's not multiply defined...
-                alert = PPDBAlert.objects.filter( diasource_id=int( data['sourceid'] ) ).first()
-
-            if alert is None:
+                alertids = list( PPDBAlert.objects
+                                 .filter( diasource_id=int( data['sourceid'] ) )
+                                 .values_list( 'alert_id', flat=True )[:1] )
+
+            kwargs = {}
+            if 'daysprevious' in data.keys():
+                kwargs['daysprevious'] = float( data['daysprevious'] )
+            if 'nprevious' in data.keys():
+                kwargs['nprevious'] = int( data['nprevious'] )
+            alerts = PPDBAlert.bulk_reconstruct( alertids=alertids, **kwargs )
+
+            if len(alerts) == 0:
                 raise ValueError( f"Unknown {'alertid' if 'alertid' in data.keys() else 'sourceid'} "
                                   f"{data['alertid'] if 'alertid' in data.keys() else data['sourceid']}" )
 
-            # TODO: nprevious, daysprevious
-            return JsonResponse( alert.reconstruct() )
+            return JsonResponse( alerts[0] )
 
         except Exception as ex:
             sys.stderr.write( f"Exception in GetAlert: {ex}\n" )
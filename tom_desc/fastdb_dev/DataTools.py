@@ -1,15 +1,18 @@
+import io
 import datetime
 import json
 import os
 import pathlib
 import psycopg2
-from psycopg2.extras import execute_batch
+from psycopg2.extras import execute_values
+import pyarrow
+import pyarrow.ipc
 from time import sleep
 import logging
 
 from fastdb_dev.models import LastUpdateTime, ProcessingVersions, HostGalaxy, Snapshots, DiaObject, DiaSource, DiaForcedSource,SnapshotTags
 from fastdb_dev.models import DStoPVtoSS, DFStoPVtoSS, BrokerClassifier, BrokerClassification
-from db.models import QueryQueue
+from db.models import QueryQueue, QueryResultCache
 
 from fastdb_dev.serializers import DiaSourceSerializer
 from fastdb_dev.serializers import DiaObjectSerializer
@@ -174,6 +177,20 @@ def SubmitShortQuery(request):
             
         queries, subdicts, data = _extract_queries( request )
 
+        # Optional result caching; the POST data can include an element
+        # {'cache': True} (cache for QueryResultCache.defaultttl seconds)
+        # or {'cache': <seconds>}.  See db.models.QueryResultCache.
+        c = next( ( d['cache'] for d in data if isinstance( d, dict ) and 'cache' in d ), None )
+        cachettl = QueryResultCache.ttl( c )
+        if cachettl is not None:
+            cachekey = QueryResultCache.make_key( 'fastdb_dev/submit_short_query', queries, subdicts )
+            cached = QueryResultCache.lookup( cachekey )
+            if cached is not None:
+                _logger.debug( "Returning cached query sequence results" )
+                response = HttpResponse( cached[0], content_type=cached[1] )
+                response['X-Cache'] = 'hit'
+                return response
+
         dbconn = psycopg2.connect( dbname=os.getenv('DB_NAME'), host=os.getenv('DB_HOST'),
                                    user=dbuser, password=password,
                                    cursor_factory=psycopg2.extras.RealDictCursor )
@@ -191,7 +208,16 @@ def SubmitShortQuery(request):
         rows = cursor.fetchall()
 
         _logger.debug( f"Returning {len(rows)} rows from query sequence." )
-        return Response( {'status': 'ok', 'data':rows} )
+        if cachettl is None:
+            return Response( {'status': 'ok', 'data':rows} )
+
+        # Render it here (rather than letting DRF do it) so that the
+        # bytes that go into the cache are the bytes we send back
+        body = JSONRenderer().render( {'status': 'ok', 'data':rows} )
+        QueryResultCache.store( cachekey, queries, body, 'application/json', cachettl )
+        response = HttpResponse( body, content_type='application/json' )
+        response['X-Cache'] = 'miss'
+        return response
 
 
     except Exception as ex:
@@ -321,6 +347,242 @@ def GetLongSQLQuery(request):
             return HttpResponse( str(ex), content_type="text/plain; charset=utf-8", status=500 )
 
     
+# The write endpoints (store_*, bulk_create_*, update_*, bulk_update_*)
+# all work on whole sets of rows: one query to look up the DiaObjects
+# that dia_source rows refer to, a COPY into dia_source or ds_to_pv_to_ss,
+# or a single UPDATE ... FROM (VALUES ...) for valid flag changes.  Each
+# request is one transaction.
+#
+# The rows can come the way fastdb_api has always sent them (a JSON
+# string of a JSON list, with the rows under 'insert', 'update', or
+# 'query'); requests like that bigger than these limits are refused.
+# Or, the body can be a stream of rows, either newline-delimited JSON
+# (one row dict per line) or an Arrow IPC stream, with the corresponding
+# content type.  Those are read and written _stream_chunk_rows at a
+# time, so they can be as big as you like, and may be sent with chunked
+# transfer encoding.  (fastdb_api's data_insert_stream and
+# data_update_stream do this.)
+
+_max_write_rows = 100000
+_max_write_bytes = 64 * 1024 * 1024
+_stream_chunk_rows = 50000
+_ndjson_content_type = 'application/x-ndjson'
+_arrow_content_type = 'application/vnd.apache.arrow.stream'
+
+_dia_source_copycolumns = ( 'uuid', 'dia_source', 'dia_object', 'season', 'fake_id', 'mid_point_tai',
+                            'filter_name', 'ra', 'decl', 'ps_flux', 'ps_flux_err', 'snr', 'processing_version',
+                            'broker_count', 'ccd_visit_id', 'parent_dia_source_id', 'valid_flag', 'insert_time' )
+_ds_pv_ss_copycolumns = ( 'processing_version', 'snapshot_name', 'dia_source', 'valid_flag', 'insert_time' )
+
+
+class _WriteTooLarge( Exception ):
+    pass
+
+
+class _LengthRequired( Exception ):
+    pass
+
+
+def _copyval( val ):
+    """Format val for a postgres COPY text-format column."""
+    if val is None:
+        return "\\N"
+    if isinstance( val, datetime.datetime ):
+        return val.isoformat()
+    if isinstance( val, str ):
+        return ( val.replace( "\\", "\\\\" ).replace( "\t", "\\t" )
+                 .replace( "\n", "\\n" ).replace( "\r", "\\r" ) )
+    return str( val )
+
+
+def _write_rows( request, key ):
+    """Return the list of row dicts in the element of the POST data with key (e.g. 'insert')."""
+
+    nbytes = int( request.META.get( 'CONTENT_LENGTH' ) or 0 )
+    if nbytes > _max_write_bytes:
+        raise _WriteTooLarge( f"Request is {nbytes} bytes; the limit is {_max_write_bytes}" )
+
+    raw_data = json.loads(request.body)
+    data = json.loads(raw_data)
+
+    rows = next( ( d[key] for d in data if isinstance( d, dict ) and key in d ), None )
+    if rows is None:
+        raise ValueError( f"POST data must include '{key}'" )
+    if not isinstance( rows, list ):
+        raise TypeError( f"'{key}' must be a list of dicts" )
+    if len( rows ) > _max_write_rows:
+        raise _WriteTooLarge( f"Request has {len(rows)} rows; the limit is {_max_write_rows}" )
+    return rows
+
+
+def _request_stream( request ):
+    """Return a file-like object for reading the body of request.
+
+    Django doesn't see the body of a request sent with chunked transfer
+    encoding (there's no Content-Length), so read those straight from
+    the WSGI server, if it says it can handle that.  If it doesn't,
+    raise _LengthRequired rather than reading an empty body.
+
+    """
+    meta = request.META
+    if meta.get( 'HTTP_TRANSFER_ENCODING', '' ).lower() == 'chunked':
+        if not meta.get( 'wsgi.input_terminated', False ):
+            raise _LengthRequired( "This server can't read chunked request bodies; "
+                                   "send a Content-Length" )
+        return meta['wsgi.input']
+    return request._request
+
+
+def _stream_chunks( stream, content_type, chunksize=_stream_chunk_rows ):
+    """Yield lists of (at most chunksize) row dicts, parsed from stream (see _request_stream) as it's read."""
+
+    if content_type == _ndjson_content_type:
+        rows = []
+        for line in iter( stream.readline, b'' ):
+            line = line.strip()
+            if len( line ) == 0:
+                continue
+            row = json.loads( line )
+            if not isinstance( row, dict ):
+                raise TypeError( f"Each line of a {_ndjson_content_type} body must be a JSON object" )
+            rows.append( row )
+            if len( rows ) >= chunksize:
+                yield rows
+                rows = []
+        if len( rows ) > 0:
+            yield rows
+
+    elif content_type == _arrow_content_type:
+        for batch in pyarrow.ipc.open_stream( stream ):
+            for offset in range( 0, batch.num_rows, chunksize ):
+                yield batch.slice( offset, chunksize ).to_pylist()
+
+    else:
+        raise ValueError( f"Unknown stream content type {content_type}" )
+
+
+def _write_chunks( cursor, chunks, writer, *args ):
+    """Call writer( cursor, rows, *args ) for each list of rows in chunks; returns the total of what it returns."""
+    n = 0
+    for rows in chunks:
+        n += writer( cursor, rows, *args )
+    return n
+
+
+def _in_transaction( func, *args ):
+    """Call func( cursor, *args ) in a transaction on django's database connection; return what it returns."""
+
+    # Doing our own transaction on the psycopg2 connection underneath
+    # django's, the same as Createable.bulk_insert_onlynew
+    conn = connection.cursor().connection
+    origautocommit = conn.autocommit
+    conn.autocommit = False
+    try:
+        with conn.cursor() as cursor:
+            result = func( cursor, *args )
+        conn.commit()
+        return result
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.autocommit = origautocommit
+
+
+def _insert_dia_sources( cursor, rows ):
+    """COPY rows (dicts of DiaSource fields) into dia_source; returns the number of rows added.
+
+    fake_id and season come from the DiaObject, which must already exist.
+
+    """
+    objids = list( set( r['dia_object'] for r in rows ) )
+    cursor.execute( "SELECT dia_object, fake_id, season FROM dia_object WHERE dia_object = ANY(%(ids)s)",
+                    { 'ids': objids } )
+    objs = { row[0]: row for row in cursor.fetchall() }
+    missing = [ o for o in objids if o not in objs ]
+    if len( missing ) > 0:
+        raise ValueError( f"{len(missing)} unknown dia_objects, including {missing[:10]}" )
+
+    now = datetime.datetime.now( tz=datetime.timezone.utc )
+    strio = io.StringIO()
+    for r in rows:
+        obj = objs[ r['dia_object'] ]
+        vals = ( uuid.uuid4(), r['dia_source'], r['dia_object'], obj[2], obj[1], r['mid_point_tai'],
+                 r['filter_name'], r['ra'], r['decl'], r['ps_flux'], r['ps_flux_err'], r['snr'],
+                 r['processing_version'], r['broker_count'], r.get( 'ccd_visit_id' ),
+                 r.get( 'parent_dia_source_id' ), r.get( 'valid_flag', 1 ), now )
+        strio.write( "\t".join( _copyval( v ) for v in vals ) )
+        strio.write( "\n" )
+    strio.seek( 0 )
+    cursor.copy_from( strio, 'dia_source', columns=_dia_source_copycolumns, size=1048576 )
+    return len( rows )
+
+
+def _insert_ds_pv_ss( cursor, rows ):
+    """COPY rows (dicts of DStoPVtoSS fields) into ds_to_pv_to_ss; returns the number of rows added."""
+    now = datetime.datetime.now( tz=datetime.timezone.utc )
+    strio = io.StringIO()
+    for r in rows:
+        vals = ( r['processing_version'], r['snapshot_name'], r['dia_source'], r.get( 'valid_flag', 1 ), now )
+        strio.write( "\t".join( _copyval( v ) for v in vals ) )
+        strio.write( "\n" )
+    strio.seek( 0 )
+    cursor.copy_from( strio, 'ds_to_pv_to_ss', columns=_ds_pv_ss_copycolumns, size=1048576 )
+    return len( rows )
+
+
+def _update_valid_flags( cursor, rows, table, keycols ):
+    """Set valid_flag in table for the rows matching each dict in rows on keycols, with one UPDATE.
+
+    keycols is a list of ( column, postgres type ).  Returns the number of rows updated.
+
+    """
+    if len( rows ) == 0:
+        return 0
+    cols = [ c for c, t in keycols ] + [ 'valid_flag' ]
+    template = "(" + ",".join( f"%s::{t}" for c, t in keycols ) + ",%s::integer)"
+    where = " AND ".join( f"{table}.{c}=v.{c}" for c, t in keycols )
+    # page_size=len(rows) so it's all one statement (rows is limited to _max_write_rows)
+    execute_values( cursor,
+                    f"UPDATE {table} SET valid_flag=v.valid_flag FROM (VALUES %s) AS v({','.join(cols)}) "
+                    f"WHERE {where}",
+                    [ tuple( r[c] for c in cols ) for r in rows ], template=template, page_size=len(rows) )
+    return cursor.rowcount
+
+
+def _do_write( request, key, writer, *args ):
+    """Run writer on the rows of a write request in one transaction, and make the response."""
+    try:
+        content_type = request.content_type.split( ';' )[0].strip().lower()
+        if content_type in ( _ndjson_content_type, _arrow_content_type ):
+            stream = _request_stream( request )
+            n = _in_transaction( _write_chunks, _stream_chunks( stream, content_type ), writer, *args )
+        else:
+            rows = _write_rows( request, key )
+            n = _in_transaction( writer, rows, *args )
+        # Cached query results that involve fastdb_dev tables may now be out of date
+        if n > 0:
+            QueryResultCache.invalidate( 'fastdb_dev' )
+        return Response( '%d Rows of Data stored' % n )
+    except _WriteTooLarge as ex:
+        return Response( { 'status': 'error', 'error': str(ex) },
+                         status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE )
+    except _LengthRequired as ex:
+        return Response( { 'status': 'error', 'error': str(ex) }, status=status.HTTP_411_LENGTH_REQUIRED )
+    except ( ValueError, TypeError, KeyError, pyarrow.ArrowInvalid,
+             psycopg2.DataError, psycopg2.IntegrityError ) as ex:
+        _logger.exception( ex )
+        return Response( { 'status': 'error', 'error': f"{type(ex).__name__}: {ex}" },
+                         status=status.HTTP_400_BAD_REQUEST )
+    except Exception as ex:
+        _logger.exception( ex )
+        return Response( { 'status': 'error', 'error': str(ex) }, status=status.HTTP_500_INTERNAL_SERVER_ERROR )
+
+
+_ds_pv_ss_keys = [ ( 'dia_source', 'bigint' ), ( 'processing_version', 'text' ), ( 'snapshot_name', 'text' ) ]
+_dia_source_keys = [ ( 'dia_source', 'bigint' ), ( 'processing_version', 'text' ) ]
+
+
 @api_view(['POST'])
 @parser_classes([JSONParser])
 @authentication_classes([TokenAuthentication])
@@ -331,40 +593,7 @@ def store_dia_source_data(request):
     if not request.user.is_authenticated:
         return Response(serializer.error, status=HTTP_403_FORBIDDEN)
 
-    raw_data = json.loads(request.body)
-    data = json.loads(raw_data)
-
-    for d in data:
-        print(d)
-        if 'query' in d:
-            dia_source_data = d['query']
-
-    count = len(dia_source_data)
-
-    for data in dia_source_data:
-        ds_uuid = uuid.uuid4()
-        ds = DiaSource(uuid=ds_uuid)
-        ds.dia_source=data['dia_source']
-        ds.filter_name = data['filter_name']
-        ds.ra = data['ra']
-        ds.decl = data['decl']
-        ds.ps_flux = data['ps_flux']
-        ds.ps_flux_err = data['ps_flux_err']
-        ds.snr = data['snr']
-        ds.mid_point_tai = data['mid_point_tai']
-        ds.valid_flag = data['valid_flag']
-
-        do = DiaObject.objects.get(dia_object=data['dia_object'])
-        ds.dia_object = do
-        ds.fake_id = do.fake_id
-        ds.season = do.season
-        ds.processing_version = data['processing_version']
-        ds.broker_count = data['broker_count']
-        
-        ds.save()
-
-    status = '%d Rows of Data stored' % count
-    return Response(status)
+    return _do_write( request, 'query', _insert_dia_sources )
                 
 @api_view(['POST'])
 def store_ds_pv_ss_data(request):
@@ -372,25 +601,7 @@ def store_ds_pv_ss_data(request):
     if not request.user.is_authenticated:
         return Response(serializer.error, status=HTTP_403_FORBIDDEN)
 
-    raw_data = json.loads(request.body)
-    data = json.loads(raw_data)
-    for d in data:
-        if 'query' in d:
-             ds_pv_ss_data = d['query']
-    count = len(ds_pv_ss_data)
-
-    for data in ds_pv_ss_data:
-
-        dspvss = DStoPVtoSS(dia_source=data['dia_source'])
-        dspvss.processing_version = data['processing_version']
-        dspvss.snapshot_name = data['snapshot_name']
-        dspvss.valid_flag = data['valid_flag']
-        dspvss.insert_time =  datetime.datetime.now(tz=datetime.timezone.utc)
-    
-        dspvss.save()
-
-        status = '%d Rows of Data stored' % count
-    return Response(status)
+    return _do_write( request, 'query', _insert_ds_pv_ss )
 
 @api_view(['POST'])
 def update_ds_pv_ss_valid_flag(request):
@@ -398,22 +609,7 @@ def update_ds_pv_ss_valid_flag(request):
     if not request.user.is_authenticated:
         return Response(serializer.error, status=HTTP_403_FORBIDDEN)
 
-    raw_data = json.loads(request.body)
-    data = json.loads(raw_data)
-    for d in data:
-        if 'query' in d:
-             ds_pv_ss_data = d['query']
-    count = len(ds_pv_ss_data)
-
-    cursor = connection.cursor()
-
-    for data in ds_pv_ss_data:
-
-        query = "update ds_to_pv_to_ss set valid_flag = %d where dia_source = %d and processing_version = '%s' and snapshot_name = '%s'" % (data['valid_flag'],data['dia_source'],data['processing_version'],data['snapshot_name'])
-        cursor.execute(query)
-
-        status = '%d Rows of Data stored' % count
-    return Response(status)
+    return _do_write( request, 'query', _update_valid_flags, 'ds_to_pv_to_ss', _ds_pv_ss_keys )
 
 @api_view(['POST'])
 def update_dia_source_valid_flag(request):
@@ -421,22 +617,7 @@ def update_dia_source_valid_flag(request):
     if not request.user.is_authenticated:
         return Response(serializer.error, status=HTTP_403_FORBIDDEN)
 
-    raw_data = json.loads(request.body)
-    data = json.loads(raw_data)
-    for d in data:
-        if 'query' in d:
-             dia_source_data = d['query']
-    count = len(dia_source_data)
-
-    cursor = connection.cursor()
-
-    for data in dia_source_data:
-
-        query = "update dia_source set valid_flag = %d where dia_source = %d and processing_version = '%s'" % (data['valid_flag'],data['dia_source'],data['processing_version'])
-        cursor.execute(query)
-
-        status = '%d Rows of Data stored' % count
-    return Response(status)
+    return _do_write( request, 'query', _update_valid_flags, 'dia_source', _dia_source_keys )
 
 @api_view(['POST'])
 @parser_classes([JSONParser])
@@ -448,45 +629,7 @@ def bulk_create_dia_source_data(request):
     if not request.user.is_authenticated:
         return Response(serializer.error, status=HTTP_403_FORBIDDEN)
 
-    raw_data = json.loads(request.body)
-    data = json.loads(raw_data)
-
-    bc = next((i for i,d in enumerate(data) if 'insert' in d), None)
-
-    if not bc:
-        raise ValueError( "POST data must include 'insert'" )
-    else:
-        bc_data = data[1]['insert']
-        count = len(bc_data)
-
-    dia_source_data = []
-    
-    for data in bc_data:
-
-        ds_uuid = uuid.uuid4()
-        ds = DiaSource(uuid=ds_uuid)
-        ds.dia_source=data['dia_source']
-        ds.filter_name = data['filter_name']
-        ds.ra = data['ra']
-        ds.decl = data['decl']
-        ds.ps_flux = data['ps_flux']
-        ds.ps_flux_err = data['ps_flux_err']
-        ds.snr = data['snr']
-        ds.mid_point_tai = data['mid_point_tai']
-        ds.valid_flag = data['valid_flag']
-
-        do = DiaObject.objects.get(dia_object=data['dia_object'])
-        ds.dia_object = do
-        ds.fake_id = do.fake_id
-        ds.season = do.season
-        ds.processing_version = data['processing_version']
-        ds.broker_count = data['broker_count']
-        
-        dia_source_data.append(ds)
-
-    objs = DiaSource.objects.bulk_create(dia_source_data)
-    status = '%d Rows of Data stored' % count
-    return Response(status)
+    return _do_write( request, 'insert', _insert_dia_sources )
                 
 @api_view(['POST'])
 def bulk_create_ds_pv_ss_data(request):
@@ -494,32 +637,7 @@ def bulk_create_ds_pv_ss_data(request):
     if not request.user.is_authenticated:
         return Response(serializer.error, status=HTTP_403_FORBIDDEN)
 
-    raw_data = json.loads(request.body)
-    data = json.loads(raw_data)
-
-    bc = next((i for i,d in enumerate(data) if 'insert' in d), None)
-    
-    if not bc:
-        raise ValueError( "POST data must include 'insert'" )
-    else:
-        bc_data = data[1]['insert']
-        count = len(bc_data)
-
-    dspvss_data = []
-
-    for data in bc_data:
-
-        dspvss = DStoPVtoSS(dia_source=data['dia_source'])
-        dspvss.processing_version = data['processing_version']
-        dspvss.snapshot_name = data['snapshot_name']
-        dspvss.valid_flag = data['valid_flag']
-        dspvss.insert_time =  datetime.datetime.now(tz=datetime.timezone.utc)
-    
-        dspvss_data.append(dspvss)
-
-    objs = DStoPVtoSS.objects.bulk_create(dspvss_data)
-    status = '%d Rows of Data stored' % count
-    return Response(status)
+    return _do_write( request, 'insert', _insert_ds_pv_ss )
 
 @api_view(['POST'])
 def bulk_update_ds_pv_ss_valid_flag(request):
@@ -527,37 +645,7 @@ def bulk_update_ds_pv_ss_valid_flag(request):
     if not request.user.is_authenticated:
         return Response(serializer.error, status=HTTP_403_FORBIDDEN)
 
-    raw_data = json.loads(request.body)
-    data = json.loads(raw_data)
-
-    bu = next((i for i,d in enumerate(data) if 'update' in d), None)
-
-    if not bu:
-        raise ValueError( "POST data must include 'update'" )
-    else:
-        bu_data = data[1]['update']
-        count = len(bu_data)
-
-    dspvss_data = []
-
-    cursor = connection.cursor()
-
-    for data in bu_data:
-
-        d = {}
-        d['valid_flag'] = data['valid_flag']
-        d['dia_source'] = data['dia_source']
-        d['processing_version'] = data['processing_version']
-        d['snapshot_name'] = data['snapshot_name']
-
-        dspvss_data.append(d)
-        
-    query = "update ds_to_pv_to_ss set valid_flag = %(valid_flag)s where dia_source = %(dia_source)s and processing_version = %(processing_version)s and snapshot_name = %(snapshot_name)s"
-
-    execute_batch(cursor,query,dspvss_data)
-
-    status = '%d Rows of Data stored' % count
-    return Response(status)
+    return _do_write( request, 'update', _update_valid_flags, 'ds_to_pv_to_ss', _ds_pv_ss_keys )
 
 @api_view(['POST'])
 def bulk_update_dia_source_valid_flag(request):
@@ -565,33 +653,4 @@ def bulk_update_dia_source_valid_flag(request):
     if not request.user.is_authenticated:
         return Response(serializer.error, status=HTTP_403_FORBIDDEN)
 
-    raw_data = json.loads(request.body)
-    data = json.loads(raw_data)
-
-    bu = next((i for i,d in enumerate(data) if 'update' in d), None)
-
-    if not bu:
-        raise ValueError( "POST data must include 'update'" )
-    else:
-        bu_data = data[1]['update']
-        count = len(bu_data)
-
-    cursor = connection.cursor()
-
-    dia_source_data = []
-    
-    for data in bu_data:
-
-        d = {}
-        d['valid_flag'] = data['valid_flag']
-        d['dia_source'] = data['dia_source']
-        d['processing_version'] = data['processing_version']
-
-        dia_source_data.append(d)
-
-    query = "update dia_source set valid_flag = %(valid_flag)s where dia_source = %(dia_source)s and processing_version = %(processing_version)s"
-
-    execute_batch(cursor,query,dia_source_data)
-
-    status = '%d Rows of Data stored' % count
-    return Response(status)
+    return _do_write( request, 'update', _update_valid_flags, 'dia_source', _dia_source_keys )
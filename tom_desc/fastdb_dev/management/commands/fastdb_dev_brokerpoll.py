@@ -74,8 +74,21 @@ class Command(BaseCommand):
         parser.add_argument( '-g', '--grouptag', default=None, help="Tag to add to end of kafka group ids" )
         parser.add_argument( '-r', '--reset', default=False, action='store_true',
                              help='Reset all stream pointers' )
+        parser.add_argument( '--manual-commit', default=False, action='store_true',
+                             help=( 'Turn off kafka auto commit; commit offsets only after a batch of '
+                                    'messages has been saved' ) )
+        parser.add_argument( '--consume-nmsgs', type=int, default=1000,
+                             help='Number of messages to consume from kafka at once (default 1000)' )
+        parser.add_argument( '--max-consume-nmsgs', type=int, default=None,
+                             help=( 'If given, consume up to this many messages at once when the consumer '
+                                    'is falling behind (default: always use --consume-nmsgs)' ) )
+        parser.add_argument( '--max-batch-bytes', type=int, default=None,
+                             help='Never grow batches past (about) this many bytes of messages' )
         parser.add_argument( '-m', '--mongodb-dbname', default='alerts',
                              help="Name of the database on $MONGOHOST to write alerts to (default: alerts)" )
+        parser.add_argument( '-w', '--mongodb-write-concern', default=None,
+                             help=( "Write concern (the 'w' value, e.g. 1 or majority) for writing alerts "
+                                    "to mongodb (default: server default)" ) )
 
     def sigterm( self, sig="TERM" ):
         self.logger.warning( f"Got a {sig} signal, trying to die." )
@@ -88,9 +101,13 @@ class Command(BaseCommand):
                        lambda sig, stack: self.logger.warning( f"{brokerclass.__name__} ignoring SIGTERM" ) )
         signal.signal( signal.SIGUSR1,
                        lambda sig, stack: self.logger.warning( f"{brokerclass.__name__} ignoring SIGUSR1" ) )
+        wc = options.pop( 'mongodb_write_concern' )
+        if wc is not None:
+            wc = { 'w': int(wc) if wc.isdigit() else wc }
         consumer = brokerclass( pipe=pipe,
                                 loggername_prefix='fastdb_dev_',
                                 mongodb_collection=brokerclass._brokername,
+                                mongodb_write_concern=wc,
                                 **options )
         consumer.poll()
 
@@ -162,6 +179,12 @@ class Command(BaseCommand):
                             else:
                                 self.logger.debug( f"Got heartbeat from {name}" )
                                 broker['lastheartbeat'] = time.monotonic()
+                                if 'lag' in msg:
+                                    lagstr = ", ".join( f"{topic}[{part}]={n}"
+                                                        for topic, parts in msg['lag'].items()
+                                                        for part, n in parts.items() )
+                                    self.logger.info( f"{name} consumer lag {msg['totlag']} "
+                                                      f"(batch size {msg['batchsize']}): {lagstr}" )
                     except Exception as ex:
                         self.logger.error( f"Got exception listening for heartbeat from {name}; will restart." )
                         brokerstorestart.add( name )
@@ -1,6 +1,8 @@
 import sys
 import pathlib
 import logging
+import itertools
+import collections
 import fastavro
 import json
 import multiprocessing
@@ -14,15 +16,19 @@ import time
 from psycopg2.extras import execute_values
 from psycopg2 import sql
 import psycopg2
+import psycopg2.extras
+import django.db
 import pymongo
+import pymongo.errors
 from pymongo import MongoClient
 from bson.objectid import ObjectId
 import pprint
 import urllib.parse
 import os
 from fastdb_dev.models import LastUpdateTime, ProcessingVersions, HostGalaxy, Snapshots
-from fastdb_dev.models import DiaObject, DiaSource, DiaForcedSource
-from fastdb_dev.models import DStoPVtoSS, DFStoPVtoSS, BrokerClassifier, BrokerClassification
+from fastdb_dev.models import DiaObject, DiaSource
+from fastdb_dev.models import DStoPVtoSS, BrokerClassifier, BrokerClassification
+from db.models import QueryResultCache
 from django.core.exceptions import ObjectDoesNotExist
 
 _logdir = pathlib.Path( os.getenv( 'LOGDIR', '/logs' ) )
@@ -30,6 +36,32 @@ _logdir = pathlib.Path( os.getenv( 'LOGDIR', '/logs' ) )
 class Command(BaseCommand):
     help = 'Store alerts in FASTDB'
 
+    mongodb_collections = { 'alerce': 'alerce',
+                            'antares': 'antares',
+                            'fink': 'fink',
+                            'ztf': 'ztf',
+                            'test': 'test',
+                            'fakebroker': 'fakebroker' }
+    brokerNames = { 'test': 'FakeBroker',
+                    'fakebroker': 'FakeBroker' }
+
+    # Broker messages are loaded if at least one of these classIds has at least this probability
+    default_classids = [ 2222, 2223, 2224, 2225, 2226, 2242, 2232 ]
+    default_min_probability = 0.1
+
+    # The fields of a broker message that get loaded
+    mongo_projection = { '_id': 0, 'topic': 1, 'timestamp': 1,
+                         'msg.diaSourceId': 1, 'msg.alertId': 1,
+                         'msg.brokerName': 1, 'msg.brokerVersion': 1,
+                         'msg.classifierName': 1, 'msg.classifierParams': 1,
+                         'msg.classifications': 1 }
+
+    # The index that mongo_query needs on each broker collection
+    mongo_index = [ ( 'msg.brokerName', pymongo.ASCENDING ),
+                    ( 'timestamp', pymongo.ASCENDING ),
+                    ( 'msg.classifications.classId', pymongo.ASCENDING ) ]
+    mongo_index_name = 'brokername_timestamp_classid'
+
     def __init__( self, *args, **kwargs ):
         super().__init__( *args, **kwargs )
         self.logger = logging.getLogger( "load_fastdb" )
@@ -48,17 +80,59 @@ class Command(BaseCommand):
         parser.add_argument( '--snapshot', help="Snapshot name" )
         parser.add_argument( '--pv', help="Processing version" )
         parser.add_argument( '--tag', help="Snapshot Tag" )
+        parser.add_argument( '--bulk', action='store_true', default=False,
+                             help=( "Load in batches with set-based queries and inserts "
+                                    "instead of one broker message and one source at a time" ) )
+        parser.add_argument( '--batch-size', default=10000, type=int,
+                             help="Number of broker messages or sources per batch with --bulk (default 10000)" )
+        parser.add_argument( '--classids', nargs="+", type=int, default=self.default_classids,
+                             help=( f"Load broker messages that give at least one of these classIds at least "
+                                    f"--min-probability (default {' '.join(str(c) for c in self.default_classids)})" ) )
+        parser.add_argument( '--min-probability', type=float, default=self.default_min_probability,
+                             help=f"See --classids (default {self.default_min_probability})" )
+
+    def mongo_query( self, brokername, last_update_time, current_datetime ):
+        """The mongo query for messages from brokername that pass at least one of the SN criteria."""
+        return { "msg.brokerName": brokername,
+                 "timestamp": { '$gte': last_update_time, '$lt': current_datetime },
+                 "msg.classifications": { '$elemMatch': { "classId": { '$in': self.classids },
+                                                          "probability": { '$gte': self.min_probability } } } }
+
+    def ensure_mongo_index( self, collection ):
+        """Make sure collection has an index that mongo_query can use, creating it if necessary.
+
+        Any index with the right keys will do, whatever it's called.  If
+        the index can't be created (e.g. because we don't have permission),
+        log a warning and carry on; the queries will just be slower.
+
+        """
+        for name, info in collection.index_information().items():
+            if list( info['key'] ) == self.mongo_index:
+                self.logger.debug( f"Collection {collection.name} has index {name}" )
+                return
+        try:
+            self.logger.info( f"Creating index {self.mongo_index_name} on collection {collection.name}" )
+            collection.create_index( self.mongo_index, name=self.mongo_index_name )
+        except pymongo.errors.PyMongoError as ex:
+            self.logger.warning( f"Failed to create index on collection {collection.name}: {ex}" )
 
-    def handle( self, *args, **options ):
+    def source_broker_counts( self, brokerstodo, last_update_time, current_datetime ):
+        """Count the broker messages for each diaSourceId, letting mongo do the work.
 
-        mongodb_collections = { 'alerce': 'alerce',
-                                'antares': 'antares',
-                                'fink': 'fink',
-                                'ztf': 'ztf',
-                                'test': 'test',
-                                'fakebroker': 'fakebroker' }
-        brokerNames = { 'test': 'FakeBroker',
-                        'fakebroker': 'FakeBroker' }
+        Returns a collections.Counter of diaSourceId -> number of messages
+        from all the brokers in brokerstodo.
+
+        """
+        brokercount = collections.Counter()
+        for name in brokerstodo:
+            collection = self.db[self.mongodb_collections[name]]
+            pipeline = [ { '$match': self.mongo_query( self.brokerNames[name], last_update_time, current_datetime ) },
+                         { '$group': { '_id': '$msg.diaSourceId', 'n': { '$sum': 1 } } } ]
+            for row in collection.aggregate( pipeline, allowDiskUse=True ):
+                brokercount[ row['_id'] ] += row['n']
+        return brokercount
+
+    def handle( self, *args, **options ):
 
         self.logger.info( "********load_fastdb starting ***********" )
 
@@ -129,46 +203,57 @@ class Command(BaseCommand):
                     exit
 
 
-        # get all the alerts that pass at least one of the SN criteria with probability > 0.1 since last_update_time
-        # (TODO: make this 0.1 a passable option?)
-        # (TODO: also need to make the list of types we care about a passable option.)
+        # get all the alerts that pass at least one of the SN criteria
+        # (a classId in --classids with probability >= --min-probability) since last_update_time
         # Loop over the brokers that were passed in via the argument list
 
+        self.classids = options['classids']
+        self.min_probability = options['min_probability']
         brokerstodo = options['brokers']
         print(brokerstodo)
 
-        list_diaSourceId = []
+        for name in brokerstodo:
+            self.ensure_mongo_index( self.db[self.mongodb_collections[name]] )
+
+        if options['bulk']:
+            self.load_bulk( conn, brokerstodo, last_update_time, current_datetime,
+                            season, snapshot, processing_version, options['batch_size'] )
+        else:
+            self.load_row_by_row( cursor, brokerstodo, last_update_time, current_datetime,
+                                  season, snapshot, processing_version )
+
+        # Store last_update_time
+        lst.last_update_time = current_datetime
+        lst.save()
+
+        # Cached query results that involve fastdb_dev tables may now be out of date
+        ninvalidated = QueryResultCache.invalidate( 'fastdb_dev' )
+        self.logger.info( f"Threw out {ninvalidated} cached query results" )
+
+        cursor.close()
+        conn.close()
+
+
+    def load_row_by_row( self, cursor, brokerstodo, last_update_time, current_datetime,
+                         season, snapshot, processing_version ):
+        """Load broker messages one at a time, and sources one at a time, with the django ORM."""
 
         for name in brokerstodo:
-            self.logger.debug( f"Doing broker {name} {f'(brokerNames[name])' if name in brokerNames else ''}" )
-            collection = self.db[mongodb_collections[name]]
+            self.logger.debug( f"Doing broker {name} {f'(self.brokerNames[name])' if name in self.brokerNames else ''}" )
+            collection = self.db[self.mongodb_collections[name]]
             # Is the 'timestamp' set by when the document is added to the database, or is it set by
             #  the broker when it sent the message?  If the latter, then there could be trouble here:
             #  it's possible that we'll ingest messages *after* this script runs that are timestamped
             #  _before_ current_datetime, and then those messages will never get processed.  (If 'timestamp'
             #  is when it's loaded into the database, then we should be safer.)
-            results = collection.find( {"$and": [ {"msg.brokerName": brokerNames[name]},
-                                                  {"timestamp": {'$gte':last_update_time, '$lt':current_datetime}},
-                                                  {"msg.classifications": {
-                                                      '$elemMatch':{
-                                                          '$and':[ {"classId": {'$in':[2222,2223,2224,2225,
-                                                                                       2226,2242,2232]}},
-                                                                   {"probability": {'$gte':0.1}} ]
-                                                      }
-                                                  }
-                                                   }
-                                                 ] } )
-
-            # TODO: we're probably going to want to have a bulk load here.
-            # (For elasticc2, I needed to bulk load broker messages to avoid
-            # getting totally killed by overhead.)
-            #
-            # TODO : cache known broker ids so we don't have to
-            # read that table for every row of results.
-            # (Does django do internal caching?)
+            results = collection.find( self.mongo_query( self.brokerNames[name], last_update_time, current_datetime ),
+                                       projection=self.mongo_projection )
+
+            # (load_bulk, used with --bulk, does this in batches, and caches
+            # known broker classifiers.  For elasticc2, I needed to bulk load
+            # broker messages to avoid getting totally killed by overhead.)
 
             for r in results:
-                diaSource_id = r['msg']['diaSourceId']
                 alert_id = r['msg']['alertId']
 
                 bc = BrokerClassification(alert_id=alert_id)
@@ -207,23 +292,23 @@ class Command(BaseCommand):
 
                 bc.save()
 
-                list_diaSourceId.append(diaSource_id)
-
 
-        # Get unique set of source Ids across all broker alerts
+        # Get unique set of source Ids across all broker alerts, and how many
+        # brokers alerted on each
 
-        uniqueSourceId = set(list_diaSourceId)
+        brokercount = self.source_broker_counts( brokerstodo, last_update_time, current_datetime )
+        uniqueSourceId = set(brokercount.keys())
         self.logger.info("Number of Unique Source Ids %s" % len(uniqueSourceId))
 
         # Look for DiaSourceIds in the PPDB DiaSource table
 
         #columns = diaSourceId,diaObjectId,psFlux,psFluxSigma,midPointTai,ra,decl,snr,filterName,observeDate
 
-        # TODO: another place we may well want a bulk loader.  More complicated here
-        #   because right now, the code as is does both adding and updating, whereas
-        #   with bulk stuff that's probably thornier.
+        # (load_bulk does this in batches of sources; see there for how it
+        #   handles both adding and updating.)
         # (Hopefully for the real PPDB it will be possible to send a list of source ids and
         # get all the information at once.)
+        touchedobjects = set()
         for d in uniqueSourceId:
 
             # self.logger.debug("Source Id %d" % d)
@@ -260,7 +345,7 @@ class Command(BaseCommand):
                 ds.mid_point_tai = result[1]
 
                 # Count how many brokers alerted on this Source Id
-                ds.broker_count = list_diaSourceId.count(d)
+                ds.broker_count = brokercount[d]
 
                 # TODO: shouldn't this only be set if the source doesn't already exist?
                 ds.insert_time =  datetime.datetime.now(tz=datetime.timezone.utc)
@@ -325,60 +410,298 @@ class Command(BaseCommand):
 
                 dspvss.save()
 
-                # Look to see if there any ForcedSource entries for this object
-
-                # Now look to see whether we already have any ForcedSource in FASTDB
-
-                dfs = DiaForcedSource.objects.filter(dia_object_id=diaObjectId)
-                if len(dfs) == 0:
-
-                     # diaForcedSourceId,diaObjectId,psFlux,psFluxSigma,filterName,observeDate
-                    # TODO NOTE : at least for elasticc2, where the "ppbd", we may
-                    #  want to put in a check that the midpointtai of the forced source is not newer
-                    #  than the midpointtai of the source in question.  Right now, it imports the
-                    #  future, as the elasticc2 ppdb tables have all sources and forced sources
-                    #  that either have been or will be detected.
-                    #
-                    # (elasticc2/management/commands/update_elasticc2_sources.py does this)
-                    #
-                    # This also relevant for real LSST.  When we get more sources on a pre-existing
-                    #   object, we want to get any new forced source photometry for that object.
-                    #   If we only look for forced sources if the object doesn't already have any,
-                    #   then we will only get forced sources from times before the first source
-                    #   we load.
-                    query = ( sql.SQL("SELECT * from {} where {} = %s")
-                              .format(sql.Identifier('elasticc2_ppdbdiaforcedsource'),sql.Identifier('diaobject_id')) )
-                    cursor.execute(query,(diaObjectId,))
-                    if cursor.rowcount != 0:
-                        results = cursor.fetchall()
-                        self.logger.debug( f"Loading {len(results)} forced sources for object {diaObjectId}" )
-                        for r in results:
-                            dfs = DiaForcedSource(dia_forced_source=r[0])
-                            dfs.dia_force_source = r[0]
-                            dfs.dia_object = do
-                            dfs.season = season
-                            dfs.fake_id = 0
-                            dfs.filter_name = r[2]
-                            dfs.ps_flux = r[3]
-                            dfs.ps_flux_err = r[4]
-                            dfs.mid_point_tai = r[1]
-                            dfs.insert_time =  datetime.datetime.now(tz=datetime.timezone.utc)
-                            dfs.processing_version = processing_version
-                            dfs.save()
-
-                            dfspvss = DFStoPVtoSS(dia_forced_source=r[0])
-                            dfspvss.processing_version = processing_version
-                            dfspvss.snapshot_name = snapshot
-                            dfspvss.insert_time =  datetime.datetime.now(tz=datetime.timezone.utc)
-
-                            dfspvss.save()
-
-
-
-        # Store last_update_time
-        lst.last_update_time = current_datetime
-        lst.save()
-
-        cursor.close()
-        conn.close()
+                # Forced sources for this object get synced below, once all
+                # the sources are in
+                touchedobjects.add( diaObjectId )
 
+        # Bring the forced sources of every object that got a new source up
+        # to date, through that object's latest source.
+        pcursor = cursor.connection.cursor( cursor_factory=psycopg2.extras.RealDictCursor )
+        fcursor = django.db.connection.cursor().connection.cursor()
+        try:
+            nforced = self.sync_forced_sources( pcursor, fcursor, list( touchedobjects ),
+                                                season, snapshot, processing_version )
+            self.logger.info( f"Loaded {nforced} forced sources for {len(touchedobjects)} objects" )
+        finally:
+            fcursor.close()
+            pcursor.close()
+
+    def sync_forced_sources( self, pcursor, fcursor, objids, season, snapshot, processing_version ):
+        """Import the forced sources of objects from the PPDB through each object's latest source.
+
+        For each object, only the forced sources after its watermark (in
+        dia_object_forced_source_watermark) and no later than its latest
+        source in FASTDB are imported; that way, an object that gets a
+        new source gets the new forced photometry that goes with it,
+        without looking at forced sources it already has, or importing
+        forced sources from the future.  (Objects with forced sources but
+        no watermark, from before there were watermarks, start from their
+        latest forced source.)  All the objects' forced sources come from
+        the PPDB in one query.
+
+        pcursor is a RealDictCursor on the PPDB, fcursor a cursor on
+        FASTDB.  Returns the number of forced sources added.
+
+        """
+        if len( objids ) == 0:
+            return 0
+
+        fcursor.execute( "SELECT o.id, "
+                         "  COALESCE( w.through_mjd, "
+                         "            ( SELECT MAX(f.mid_point_tai) FROM dia_forced_source f "
+                         "              WHERE f.dia_object=o.id AND f.processing_version=%(pv)s ) ), "
+                         "  ( SELECT MAX(s.mid_point_tai) FROM dia_source s "
+                         "    WHERE s.dia_object=o.id AND s.processing_version=%(pv)s ) "
+                         "FROM unnest(%(ids)s::bigint[]) AS o(id) "
+                         "LEFT JOIN dia_object_forced_source_watermark w "
+                         "  ON w.dia_object=o.id AND w.processing_version=%(pv)s",
+                         { 'ids': list( objids ), 'pv': processing_version } )
+        windows = [ row for row in fcursor.fetchall()
+                    if ( row[2] is not None ) and ( ( row[1] is None ) or ( row[2] > row[1] ) ) ]
+        if len( windows ) == 0:
+            return 0
+
+        pcursor.execute( "SELECT f.diaforcedsource_id, f.diaobject_id, f.midpointtai, f.filtername, "
+                         "       f.psflux, f.psfluxerr "
+                         "FROM elasticc2_ppdbdiaforcedsource f "
+                         "INNER JOIN unnest( %(ids)s::bigint[], %(lo)s::double precision[], "
+                         "                   %(hi)s::double precision[] ) AS w(id,lo,hi) "
+                         "  ON f.diaobject_id=w.id AND f.midpointtai<=w.hi "
+                         "  AND ( w.lo IS NULL OR f.midpointtai>w.lo )",
+                         { 'ids': [ w[0] for w in windows ], 'lo': [ w[1] for w in windows ],
+                           'hi': [ w[2] for w in windows ] } )
+        forced = pcursor.fetchall()
+        self.logger.debug( f"Loading {len(forced)} forced sources for {len(windows)} objects" )
+
+        now = datetime.datetime.now( tz=datetime.timezone.utc )
+        rows = [ ( f['diaforcedsource_id'], f['diaobject_id'], season, 0, f['midpointtai'], f['filtername'],
+                   f['psflux'], f['psfluxerr'], processing_version, 1, now )
+                 for f in forced ]
+        added = execute_values( fcursor,
+                                "INSERT INTO dia_forced_source(uuid,dia_forced_source,dia_object,season,fake_id,"
+                                "  mid_point_tai,filter_name,ps_flux,ps_flux_err,processing_version,valid_flag,"
+                                "  insert_time) VALUES %s ON CONFLICT DO NOTHING RETURNING dia_forced_source",
+                                rows, template="(gen_random_uuid(),%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)",
+                                page_size=10000, fetch=True )
+        rows = [ ( processing_version, snapshot, f['diaforcedsource_id'], 1, now ) for f in forced ]
+        execute_values( fcursor,
+                        "INSERT INTO dfs_to_pv_to_ss(processing_version,snapshot_name,dia_forced_source,"
+                        "  valid_flag,insert_time) VALUES %s ON CONFLICT DO NOTHING",
+                        rows, page_size=10000 )
+        execute_values( fcursor,
+                        "INSERT INTO dia_object_forced_source_watermark(dia_object,processing_version,through_mjd) "
+                        "VALUES %s ON CONFLICT (dia_object,processing_version) DO UPDATE "
+                        "  SET through_mjd=GREATEST(dia_object_forced_source_watermark.through_mjd,"
+                        "                           excluded.through_mjd)",
+                        [ ( w[0], processing_version, w[2] ) for w in windows ], page_size=10000 )
+
+        return len( added )
+
+    def classifier_id( self, fcursor, broker_name, broker_version, classifier_name, classifier_params ):
+        """Get the classifier_id of a classifier, creating it if necessary.
+
+        Known classifiers are kept in self._classifiers, so this only goes
+        to the database for classifiers it hasn't seen before.
+
+        """
+        key = ( broker_name, broker_version, classifier_name, classifier_params )
+        if key not in self._classifiers:
+            subdict = { 'bn': broker_name, 'bv': broker_version, 'cn': classifier_name, 'cp': classifier_params }
+            fcursor.execute( "SELECT classifier_id FROM broker_classifier "
+                             "WHERE broker_name=%(bn)s AND broker_version IS NOT DISTINCT FROM %(bv)s "
+                             "  AND classifier_name=%(cn)s AND classifier_params IS NOT DISTINCT FROM %(cp)s "
+                             "ORDER BY classifier_id LIMIT 1", subdict )
+            row = fcursor.fetchone()
+            if row is None:
+                fcursor.execute( "INSERT INTO broker_classifier(broker_name,broker_version,classifier_name,"
+                                 "                              classifier_params,insert_time) "
+                                 "VALUES (%(bn)s,%(bv)s,%(cn)s,%(cp)s,NOW()) RETURNING classifier_id", subdict )
+                row = fcursor.fetchone()
+            self._classifiers[ key ] = row[0]
+        return self._classifiers[ key ]
+
+    def load_bulk( self, conn, brokerstodo, last_update_time, current_datetime,
+                   season, snapshot, processing_version, batch_size ):
+        """Load broker messages and sources in batches.
+
+        Broker messages are pulled from mongo batch_size at a time, and
+        each batch is written to broker_classification with one
+        execute_values.  Then the unique sources are done batch_size at a
+        time: one = ANY query per PPDB table gets everything needed for
+        the batch, and each FASTDB table is written with execute_values.
+        Each batch is committed separately.
+
+        last_update_time is only saved once everything is done, and there's
+        no unique constraint that would catch a broker message being loaded
+        twice.  So, if this fails partway through (e.g. in a source batch),
+        running it again will insert every broker message that was already
+        committed into broker_classification again.  (Sources, objects and
+        forced sources that already exist are skipped.)
+
+        Does the same thing as load_row_by_row, except:
+          * dia_object.nobs only counts sources that were actually added
+          * sources that already exist for this processing version are
+            skipped rather than being an error
+          * sources whose object isn't in the PPDB are logged and skipped
+          * ra_dec_tai of a new object is the earliest of its sources in
+            the batch
+
+        """
+        self._classifiers = { ( c.broker_name, c.broker_version, c.classifier_name, c.classifier_params ):
+                              c.classifier_id
+                              for c in BrokerClassifier.objects.order_by( '-classifier_id' ) }
+
+        # Doing our own transactions on django's connection
+        fconn = django.db.connection.cursor().connection
+        origautocommit = fconn.autocommit
+        fconn.autocommit = False
+        fcursor = fconn.cursor()
+        pcursor = conn.cursor( cursor_factory=psycopg2.extras.RealDictCursor )
+        try:
+            # Broker messages -> broker_classification
+
+            nmsgs = 0
+            for name in brokerstodo:
+                self.logger.debug( f"Doing broker {name} "
+                                   f"{f'({self.brokerNames[name]})' if name in self.brokerNames else ''}" )
+                collection = self.db[self.mongodb_collections[name]]
+                results = collection.find( self.mongo_query( self.brokerNames[name], last_update_time,
+                                                             current_datetime ),
+                                           projection=self.mongo_projection ).batch_size( batch_size )
+                while True:
+                    batch = list( itertools.islice( results, batch_size ) )
+                    if len( batch ) == 0:
+                        break
+                    now = datetime.datetime.now( tz=datetime.timezone.utc )
+                    rows = []
+                    for r in batch:
+                        msg = r['msg']
+                        timestamp = r['timestamp']
+                        if not isinstance( timestamp, datetime.datetime ):
+                            raise TypeError( f"r['timestamp'] is a {type(timestamp)}, "
+                                             f"expected datetime.datetime" )
+                        if timestamp.tzinfo is None:
+                            timestamp = pytz.utc.localize( timestamp )
+                        cfer = self.classifier_id( fcursor, msg['brokerName'], msg['brokerVersion'],
+                                                   msg['classifierName'], msg['classifierParams'] )
+                        rows.append( ( msg['alertId'], msg['diaSourceId'], r['topic'], now, timestamp,
+                                       cfer, psycopg2.extras.Json( msg['classifications'] ), now ) )
+                    execute_values( fcursor,
+                                    "INSERT INTO broker_classification(alert_id,dia_source,topic_name,"
+                                    "  desc_ingest_timestamp,broker_ingest_timestamp,classifier,"
+                                    "  classifications,insert_time) VALUES %s",
+                                    rows, page_size=10000 )
+                    fconn.commit()
+                    nmsgs += len( rows )
+                    self.logger.info( f"Loaded {nmsgs} broker messages from {name}" )
+
+            brokercount = self.source_broker_counts( brokerstodo, last_update_time, current_datetime )
+            self.logger.info( "Number of Unique Source Ids %s" % len(brokercount) )
+
+            # Sources
+
+            sourceids = list( brokercount.keys() )
+            totals = collections.Counter()
+            for i in range( 0, len(sourceids), batch_size ):
+                counts = self.load_source_batch( pcursor, fcursor, sourceids[ i : i+batch_size ], brokercount,
+                                                 season, snapshot, processing_version )
+                fconn.commit()
+                totals.update( counts )
+                self.logger.info( f"Did {min( i+batch_size, len(sourceids) )} of {len(sourceids)} sources; "
+                                  f"so far: {dict(totals)}" )
+
+        except Exception:
+            fconn.rollback()
+            raise
+        finally:
+            pcursor.close()
+            fcursor.close()
+            fconn.autocommit = origautocommit
+            conn.rollback()
+
+    def load_source_batch( self, pcursor, fcursor, sourceids, brokercount, season, snapshot, processing_version ):
+        """Load one batch of sources, their objects, and the forced sources that go with them.
+
+        Returns a dict of counts of rows added to each table.
+
+        """
+        counts = {}
+        now = datetime.datetime.now( tz=datetime.timezone.utc )
+
+        pcursor.execute( "SELECT diasource_id, diaobject_id, midpointtai, filtername, ra, decl, "
+                         "       psflux, psfluxerr, snr "
+                         "FROM elasticc2_ppdbdiasource WHERE diasource_id = ANY(%(ids)s)",
+                         { 'ids': sourceids } )
+        sources = pcursor.fetchall()
+        missing = set( sourceids ) - set( s['diasource_id'] for s in sources )
+        for d in missing:
+            self.logger.error( f"source {d} not known in PPDB!" )
+
+        # Objects: create the ones FASTDB doesn't know about yet
+
+        objids = list( set( s['diaobject_id'] for s in sources ) )
+        fcursor.execute( "SELECT dia_object FROM dia_object WHERE dia_object = ANY(%(ids)s)", { 'ids': objids } )
+        known = set( row[0] for row in fcursor.fetchall() )
+        newobjids = [ o for o in objids if o not in known ]
+        if len( newobjids ) > 0:
+            self.logger.info( f"{len(newobjids)} DiaObjects not in FASTDB. Creating new entries." )
+            pcursor.execute( "SELECT diaobject_id, ra, decl FROM elasticc2_ppdbdiaobject "
+                             "WHERE diaobject_id = ANY(%(ids)s)", { 'ids': newobjids } )
+            ppdbobjs = { row['diaobject_id']: row for row in pcursor.fetchall() }
+            for o in newobjids:
+                if o not in ppdbobjs:
+                    self.logger.error( f"object {o} not known in PPDB!  Skipping its sources." )
+            firsttai = {}
+            for s in sources:
+                o = s['diaobject_id']
+                firsttai[o] = s['midpointtai'] if o not in firsttai else min( firsttai[o], s['midpointtai'] )
+            # nobs gets incremented below as sources are added
+            rows = [ ( o, now, season, 0, ppdbobjs[o]['ra'], 0.00001, ppdbobjs[o]['decl'], 0.00001,
+                       firsttai[o], 0, now )
+                     for o in newobjids if o in ppdbobjs ]
+            execute_values( fcursor,
+                            "INSERT INTO dia_object(dia_object,validity_start,season,fake_id,ra,ra_sigma,"
+                            "  decl,decl_sigma,ra_dec_tai,nobs,insert_time) VALUES %s "
+                            "ON CONFLICT DO NOTHING", rows, page_size=10000 )
+            counts['dia_object'] = len( rows )
+            known.update( o for o in newobjids if o in ppdbobjs )
+        sources = [ s for s in sources if s['diaobject_id'] in known ]
+        objids = [ o for o in objids if o in known ]
+
+        fcursor.execute( "SELECT dia_object, season, fake_id FROM dia_object WHERE dia_object = ANY(%(ids)s)",
+                         { 'ids': objids } )
+        objinfo = { row[0]: row for row in fcursor.fetchall() }
+
+        # Sources
+
+        rows = [ ( s['diasource_id'], s['diaobject_id'], objinfo[s['diaobject_id']][1],
+                   objinfo[s['diaobject_id']][2], s['midpointtai'], s['filtername'], s['ra'], s['decl'],
+                   s['psflux'], s['psfluxerr'], s['snr'], processing_version, brokercount[s['diasource_id']],
+                   1, now )
+                 for s in sources ]
+        added = execute_values( fcursor,
+                                "INSERT INTO dia_source(uuid,dia_source,dia_object,season,fake_id,mid_point_tai,"
+                                "  filter_name,ra,decl,ps_flux,ps_flux_err,snr,processing_version,broker_count,"
+                                "  valid_flag,insert_time) VALUES %s "
+                                "ON CONFLICT DO NOTHING RETURNING dia_object",
+                                rows, template="(gen_random_uuid(),%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)",
+                                page_size=10000, fetch=True )
+        counts['dia_source'] = len( added )
+
+        nobs = collections.Counter( row[0] for row in added )
+        execute_values( fcursor,
+                        "UPDATE dia_object SET nobs=dia_object.nobs+v.n FROM (VALUES %s) AS v(id,n) "
+                        "WHERE dia_object.dia_object=v.id",
+                        list( nobs.items() ), page_size=10000 )
+
+        rows = [ ( processing_version, snapshot, s['diasource_id'], 1, now ) for s in sources ]
+        execute_values( fcursor,
+                        "INSERT INTO ds_to_pv_to_ss(processing_version,snapshot_name,dia_source,"
+                        "  valid_flag,insert_time) VALUES %s ON CONFLICT DO NOTHING",
+                        rows, page_size=10000 )
+
+        # Forced sources through each object's latest source
+        counts['dia_forced_source'] = self.sync_forced_sources( pcursor, fcursor, objids,
+                                                                season, snapshot, processing_version )
+
+        return counts
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.7 on 2026-10-18 16:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fastdb_dev', '0003_partitioning_v1_1a'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DiaObjectForcedSourceWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dia_object', models.BigIntegerField(db_comment='Local copy of dia_object to circumvent Django')),
+                ('processing_version', models.TextField(db_comment='Local copy of Processing version to circumvent Django')),
+                ('through_mjd', models.FloatField(db_comment='Forced sources through this midPointTai have been imported')),
+            ],
+            options={
+                'db_table': 'dia_object_forced_source_watermark',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='diaobjectforcedsourcewatermark',
+            constraint=models.UniqueConstraint(fields=('dia_object', 'processing_version'), name='unique_dfs_watermark'),
+        ),
+    ]
@@ -200,6 +200,23 @@ class DFStoPVtoSS(PostgresPartitionedModel):
     dia_forced_source = models.BigIntegerField(db_comment="Local copy of dia_source to circumvent Django")
     valid_flag = models.IntegerField(db_comment='Valid data flag', default=1)
     insert_time =  models.DateTimeField(default=timezone.now)
+
+# load_fastdb imports the forced sources of an object from the PPDB
+# through the time of the object's latest source (and no further, so as
+# not to import the future).  This records how far it got, so that the
+# next time the object gets a new source, only the forced sources after
+# this need to be imported.
+
+class DiaObjectForcedSourceWatermark(models.Model):
+
+    class Meta:
+        app_label = 'fastdb_dev'
+        db_table = 'dia_object_forced_source_watermark'
+        constraints = [models.UniqueConstraint(fields=['dia_object','processing_version'],name='unique_dfs_watermark')]
+
+    dia_object = models.BigIntegerField(db_comment="Local copy of dia_object to circumvent Django")
+    processing_version =  models.TextField(db_comment="Local copy of Processing version to circumvent Django")
+    through_mjd = models.FloatField(db_comment="Forced sources through this midPointTai have been imported")
     
 # Broker information
 